@@ -18,14 +18,34 @@ import mqtt_client
 # Setup
 #
 state = True
-mqttClient = mqtt_client.MqttClient(address=config['MQTT']['address'],
-                                    port=int(config['MQTT']['port']),
-                                    username=config['MQTT']['username'],
-                                    password=config['MQTT']['password'],
-                                    keepAlive=int(config['MQTT']['keepalive']),
-                                    topic_detection=config['MQTT']['topic_detection'],
-                                    topic_state=config['MQTT']['topic_control_state'],
-                                    lastWill=config['MQTT']['topic_lastwill'])
+
+
+@st.cache(allow_output_mutation=True)
+def getMqttClient():
+  """ One connected MQTT client for all script runs, its frame ring survives the reruns
+
+  Returns:
+      (obj): mqtt_client.MqttClient object
+  """
+  client = mqtt_client.MqttClient(address=config['MQTT']['address'],
+                                  port=int(config['MQTT']['port']),
+                                  username=config['MQTT']['username'],
+                                  password=config['MQTT']['password'],
+                                  keepAlive=int(config['MQTT']['keepalive']),
+                                  topic_detection=config['MQTT']['topic_detection'],
+                                  topic_state=config['MQTT']['topic_control_state'],
+                                  lastWill=config['MQTT']['topic_lastwill'],
+                                  ring_size=int(config['APP']['ring_size']))
+  # Connect MQTT
+  try:
+    client.createConnection()
+  except Exception:
+    print("Unable to connect to MQTT broker!")
+    raise SystemExit
+  return client
+
+
+mqttClient = getMqttClient()
 
 
 ###############################################################################
@@ -54,16 +74,11 @@ else:
 
 st.subheader("Image")
 st_image = st.image(np.random.randint(0, 100, size=(480, 640)), caption=" No image received yet", use_column_width=True)
+st_warning = st.empty()
 st.subheader("Detection")
 st_json = st.json(mqttClient.detection)
-mqttClient.setHandlers(st_image, st_json)
-people_detected = 0
-for key in mqttClient.detection:
-  if mqttClient.detection[key] == "person":
-    people_detected += 1
-
-if people_detected > 0:
-  st.warning("Warning {} people detected".format(people_detected))
+st.subheader("Locations")
+st_locations = st.empty()
 
 ###############################################################################
 # Footer
@@ -72,19 +87,27 @@ st.markdown("---")
 st.markdown("Made with :heart: by [{}]({})".format(author, author_url))
 st.markdown("Sourcecode on [{}]({})".format(repo, repo_url))
 
-# Connect MQTT
-try:
-  mqttClient.createConnection()
-except Exception:
-  print("Unable to connect to MQTT broker!")
-  raise SystemExit
-
 ###############################################################################
 # Execution
 #
 mqttClient.publishState(int(state))
 
-#while True:
-#  pass
-st_image.image(mqttClient.filename, caption="Detection at {}".format(mqttClient.location), use_column_width=True)
-st_json.write(mqttClient.detection)
+# Update the placeholders from the in memory ring until the next rerun,
+# frames arriving faster than the browser renders are skipped
+seq = 0
+while True:
+  frame = mqttClient.waitFrame(seq, timeout=1.0)
+  if frame is None:
+    continue
+  seq = frame['seq']
+  if len(frame['image']) > 0:
+    # empty if the detection image could not be rendered
+    st_image.image(frame['image'], caption="Detection at {}".format(frame['location']), use_column_width=True)
+  st_json.json(frame['detections'])
+  people_detected = sum(1 for detection in frame['detections'] if detection.get('labels') == "person")
+  if people_detected > 0:
+    st_warning.warning("Warning {} people detected".format(people_detected))
+  else:
+    st_warning.empty()
+  st_locations.table([{'location': location, 'time': datetime.datetime.fromtimestamp(latest['time']).strftime("%H:%M:%S"), 'detections': len(latest['detections'])}
+                      for location, latest in sorted(mqttClient.latestFrames().items())])
@@ -17,6 +17,8 @@ import os
 import platform
 import logging
 import base64
+import json
+import struct
 from datetime import datetime
 import cv2
 from PIL import Image
@@ -30,6 +32,9 @@ from rich.console import Console
 #
 
 
+# Prefix of the binary detection messages, legacy json messages start with '{'
+DETECTION_MAGIC = b"EPU1"
+
 ###############################################################################
 # Logging Functions
 #
@@ -129,4 +134,26 @@ def convertFileToBase64(image_path):
     with open(image_path, "rb") as image_file:
       return base64.b64encode(image_file.read()).decode('utf-8')
   else:
-    return -1
\ No newline at end of file
+    return -1
+
+
+def unpackDetections(payload):
+  """ Unpack a binary detection message
+
+  Args:
+      payload (bytes): message starting with DETECTION_MAGIC
+  Returns:
+      (tuple): tuple containing:
+
+          header (dict): location and one entry per frame with its detections
+          images (list): jpeg image bytes per frame
+  """
+  (length,) = struct.unpack_from('<I', payload, len(DETECTION_MAGIC))
+  start = len(DETECTION_MAGIC) + 4
+  header = json.loads(payload[start:start + length].decode())
+  images = []
+  offset = start + length
+  for frame in header['frames']:
+    images.append(payload[offset:offset + frame['image']])
+    offset += frame['image']
+  return (header, images)
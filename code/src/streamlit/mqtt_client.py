@@ -17,6 +17,8 @@ from functions import *
 import helpers
 import json
 import os
+import threading
+from collections import deque
 
 
 class MqttClient:
@@ -33,6 +35,7 @@ class MqttClient:
     topic_detection (str): Default="yolo/detection". Topic were detection are published
     topic_state (str): Default="yolo/state". Topic were state outputs are published
     lastWill (str): Default="yolo/control/status". Topic were the last will is published
+    ring_size (int): Default=32. Number of recent frames kept in memory
   Returns:
     None
   """
@@ -47,7 +50,8 @@ class MqttClient:
                packetsize=3000,
                topic_detection="yolo/detection",
                topic_state="yolo/state",
-               lastWill="yolo/control/status"
+               lastWill="yolo/control/status",
+               ring_size=32
                ):
     # default config, no address given as we don't want to spread code everywhere
     self.address = address
@@ -68,7 +72,10 @@ class MqttClient:
     self.location = None
     self.st_image = None
     self.st_json = None
-    self.filename = "latest_detection.jpg"
+    # recent frames {'seq', 'time', 'location', 'detections', 'image'}, the oldest fall out
+    self.ring = deque(maxlen=ring_size)
+    self.seq = 0
+    self.received = threading.Condition()
 
   def setHandlers(self, st_image, st_json):
     self.st_image = st_image
@@ -108,18 +115,47 @@ class MqttClient:
         msg ([type]): [description]
     """
     try:
+      if msg.payload[:len(helpers.DETECTION_MAGIC)] == helpers.DETECTION_MAGIC:
+        # binary format, possibly a batch of several frames of several cameras
+        (header, images) = helpers.unpackDetections(msg.payload)
+        frames = [(frame.get('time', time.time()), frame.get('location', header['location']), frame['detections'], image) for frame, image in zip(header['frames'], images)]
+      else:
         detection = json.loads(msg.payload)
-        self.location = detection['location']
-        self.detection = detection['detections']
-        self.image = helpers.convertBase64toImage(detection['image'])
+        frames = [(time.time(), detection['location'], detection['detections'], helpers.convertBase64toImage(detection['image']))]
     except:
       self.log.error("The message is not properly formatted.. Value: %s, type: %s" % (msg.payload, type(msg.payload)))
+      return
 
-    with open(self.filename, 'wb') as f:
-      f.write(self.image)
+    with self.received:
+      for (timestamp, location, detections, image) in frames:
+        self.seq += 1
+        self.ring.append({'seq': self.seq, 'time': timestamp, 'location': location, 'detections': detections, 'image': image})
+      (self.location, self.detection, self.image) = frames[-1][1:]
+      self.received.notify_all()
 
-    #self.st_image.image(self.filename, caption="Detection at {}".format(self.location), use_column_width=True)
-    #self.st_json.write(self.detection)
+  def waitFrame(self, seq=0, timeout=None):
+    """Wait for a frame newer than seq
+
+    Args:
+        seq (int): sequence number of the last frame shown
+        timeout (float): max seconds to wait, None to wait forever
+    Returns:
+        (dict): newest frame, None on timeout
+    """
+    with self.received:
+      self.received.wait_for(lambda: self.seq > seq, timeout)
+      if self.seq > seq and len(self.ring) > 0:
+        return self.ring[-1]
+    return None
+
+  def latestFrames(self):
+    """Newest frame of every location still in the ring
+
+    Returns:
+        (dict): frame by location
+    """
+    with self.received:
+      return dict((frame['location'], frame) for frame in self.ring)
 
   def on_connect(self, client, userdata, flags, rc):
     """Connection callback on connection. Used as a feedback.
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - adaptive
+
+Adaptive capture interval: slow sampling of an empty scene, maximal frame rate while people are detected.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import os
+import csv
+import time
+import atexit
+from datetime import datetime
+import numpy as np
+import helpers
+
+
+###############################################################################
+# AdaptiveInterval Class
+#
+class AdaptiveInterval:
+  """ Capture interval following the detection state and the measured latency
+
+      * active: a watched class was detected by the last frame, min_interval (maximal frame rate)
+      * hold: no detection for less than hold seconds, min_interval
+      * decay: the interval grows by the decay factor per capture cycle
+      * idle: the interval of an empty scene reached its cap, max_interval resp. latency_budget - latency
+
+      Latency budget, from the rolling p95 of the timer stages:
+
+      * the interval of an empty scene is capped to latency_budget - latency, so a person entering
+        the scene is published within the budget, max_interval is clamped to latency_budget
+      * while the latency exceeds the budget the interval is at least the processing time per frame,
+        the frames don't queue up in front of the neural net
+
+      Every decision changing the state or the interval is written to a csv file for the energy analysis.
+  """
+
+  def __init__(self, timer, min_interval=0.0, max_interval=5.0, hold=10.0, decay=1.5, latency_budget=3.0,
+               latency_stage="Latency", processing_stages=("Detection per Frame", "Pipeline Frame Period"), file=None, refresh=1.0):
+    """ Constructor for the adaptive interval
+
+    Args:
+        timer (obj): timer.Timer object with the stage durations
+        min_interval (float, optional): seconds between two captures while people are detected. Defaults to 0.0.
+        max_interval (float, optional): seconds between two captures of an empty scene, at most latency_budget. Defaults to 5.0.
+        hold (float, optional): seconds min_interval is kept after the last detection. Defaults to 10.0.
+        decay (float, optional): interval growth factor per capture cycle after the hold time. Defaults to 1.5.
+        latency_budget (float, optional): max seconds from a person entering the scene to the published detection. Defaults to 3.0.
+        latency_stage (str, optional): prefix of the timer stages with the capture to publish latency. Defaults to "Latency".
+        processing_stages (tuple, optional): timer stages with the processing time per frame, the first one measured is used. Defaults to ("Detection per Frame", "Pipeline Frame Period").
+        file (str, optional): csv file for the decisions, None to only log them. Defaults to None.
+        refresh (float, optional): seconds between two reads of the timer statistics. Defaults to 1.0.
+    """
+    self.log = helpers.createLogger(__name__)
+    if max_interval > latency_budget:
+      self.log.warning("Max capture interval %.2f s exceeds the latency budget %.2f s, clamped to the budget" % (max_interval, latency_budget))
+      max_interval = latency_budget
+    self.timer = timer
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.hold = hold
+    self.decay = decay
+    self.latency_budget = latency_budget
+    self.latency_stage = latency_stage
+    self.processing_stages = processing_stages
+    self.refresh = refresh
+    self.state = "idle"
+    self.interval = max_interval
+    self.detected = False
+    self.last_detection = None
+    self.latency = None
+    self.processing = None
+    self.measured = None
+    self.decisions = 0
+    self.file = None
+    self.writer = None
+    if file is not None:
+      new = not os.path.isfile(file)
+      self.file = open(file, 'a', newline='')
+      self.writer = csv.writer(self.file)
+      if new:
+        self.writer.writerow(["time", "state", "interval", "detected", "latency_p95", "processing_p95"])
+      atexit.register(self.close)
+
+  def update(self, detected):
+    """ Report the detection state of the last processed frames
+
+    Args:
+        detected (bool): True if a watched class was detected
+    """
+    self.detected = detected
+    if detected:
+      self.last_detection = time.monotonic()
+
+  def measure(self, now):
+    """ Refresh the p95 latency and processing time from the timer, at most every refresh seconds
+
+    Args:
+        now (float): current monotonic time
+    """
+    if self.measured is not None and now - self.measured < self.refresh:
+      return
+    self.measured = now
+    stages = [stage for stage in list(self.timer.stage_names) if stage.startswith(self.latency_stage)]
+    latencies = np.concatenate([self.timer.durations(stage) for stage in stages]) if stages else np.zeros(0)
+    self.latency = float(np.percentile(latencies, 95)) if latencies.size > 0 else None
+    self.processing = None
+    for stage in self.processing_stages:
+      durations = self.timer.durations(stage)
+      if durations.size > 0:
+        self.processing = float(np.percentile(durations, 95))
+        break
+
+  def next(self):
+    """ Interval before the next capture, called once per capture cycle
+
+    Returns:
+        (float): seconds to wait
+    """
+    now = time.monotonic()
+    self.measure(now)
+    if self.last_detection is not None and (self.detected or now - self.last_detection < self.hold):
+      state = "active" if self.detected else "hold"
+      interval = self.min_interval
+    else:
+      # the state follows the capped interval, idle once the cap is reached
+      cap = self.max_interval
+      if self.latency is not None:
+        cap = min(cap, max(self.latency_budget - self.latency, self.min_interval))
+      # grow from at least 100 ms, a zero interval would never decay
+      interval = min(cap, max(self.interval, self.min_interval, 0.1) * self.decay)
+      state = "idle" if interval >= cap else "decay"
+    if self.latency is not None and self.latency > self.latency_budget and self.processing is not None:
+      interval = max(interval, self.processing)
+
+    if state != self.state:
+      self.log.info("Capture interval %s: %.2f s (latency p95 %s, processing p95 %s)" % (state, interval, self.format(self.latency) or "-", self.format(self.processing) or "-"))
+    if state != self.state or abs(interval - self.interval) > 1e-3:
+      self.decisions += 1
+      if self.writer is not None:
+        self.writer.writerow([datetime.now().isoformat(), state, round(interval, 3), int(self.detected), self.format(self.latency), self.format(self.processing)])
+        self.file.flush()
+    self.state = state
+    self.interval = interval
+    return interval
+
+  def format(self, value):
+    """ Seconds with ms precision for the log and the csv file
+
+    Args:
+        value (float): seconds or None
+
+    Returns:
+        (str): formatted value, empty if not measured
+    """
+    return "" if value is None else "%.3f" % value
+
+  def close(self):
+    """ Close the decision file
+    """
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+      self.writer = None
+      self.log.info("Capture interval: %d decisions" % self.decisions)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - async loop
+
+Asyncio main loop of the people detection: capture, inference and publishing run as cooperating tasks.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import helpers
+
+# Marker passed through the queues at the end of the input
+_END = object()
+
+
+###############################################################################
+# DetectionLoop Class
+#
+class DetectionLoop:
+  """ Event loop with one task per step, connected by bounded asyncio queues (backpressure)
+
+      * capture: waits for the running state, captures a batch of frames every interval seconds, the interval
+        can be a function called once per capture
+      * inference: runs the neural net on the batches
+      * publish: sends the detections
+
+      The blocking functions run in one single threaded executor per step, so the neural net and the
+      mqtt client are never used from two threads at once. While not running the loop waits on an
+      event and uses no CPU.
+  """
+
+  def __init__(self, capture, detect, publish, interval=1.0, maxsize=2):
+    """ Constructor for the detection loop
+
+    Args:
+        capture (function): capture() returns a list of frames, None at the end of the input, empty lists are dropped
+        detect (function): detect(frames) returns a list of results to publish
+        publish (function): publish(result)
+        interval (float|function, optional): seconds between two captures, -1 for none, or interval() returning them. Defaults to 1.0.
+        maxsize (int, optional): max number of batches resp. results waiting in front of a step. Defaults to 2.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.capture = capture
+    self.detect = detect
+    self.publish = publish
+    self.interval = interval
+    self.maxsize = maxsize
+    self.running = False
+    self.loop = None
+    self.running_event = None
+    self.stop_event = None
+    self.executors = {}
+    # frames and results queues while running, read by the metrics
+    self.queues = {}
+
+  def setRunning(self, running):
+    """ Change the running state, thread safe, e.g. from the mqtt network thread
+
+    Args:
+        running (bool): True to capture frames
+    """
+    self.running = running
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.applyState)
+
+  def applyState(self):
+    """ Apply the running state to the event, in the event loop
+    """
+    if self.running:
+      self.log.info("Starting YOLO detection")
+      self.running_event.set()
+    else:
+      self.log.info("Stopping YOLO detection")
+      self.running_event.clear()
+
+  def stop(self):
+    """ Stop the loop, thread safe
+    """
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.stop_event.set)
+
+  async def execute(self, step, func, *args):
+    """ Run a blocking function in the executor of a step
+
+    Args:
+        step (str): step name
+        func (function): blocking function
+
+    Returns:
+        (obj): return value of func
+    """
+    return await self.loop.run_in_executor(self.executors[step], func, *args)
+
+  async def captureTask(self, frames):
+    """ Capture batches of frames while running, blocks on the full frame queue
+    """
+    while True:
+      await self.running_event.wait()
+      batch = await self.execute('capture', self.capture)
+      if batch is None:
+        self.log.debug("End of input")
+        await frames.put(_END)
+        return
+      if batch:
+        await frames.put(batch)
+      interval = self.interval() if callable(self.interval) else self.interval
+      if interval >= 0:
+        await asyncio.sleep(interval)
+
+  async def inferenceTask(self, frames, results):
+    """ Run the neural net on the captured batches, blocks on the full result queue
+    """
+    while True:
+      batch = await frames.get()
+      if batch is _END:
+        await results.put(_END)
+        return
+      for result in await self.execute('inference', self.detect, batch):
+        await results.put(result)
+
+  async def publishTask(self, results):
+    """ Publish the results
+    """
+    while True:
+      result = await results.get()
+      if result is _END:
+        return
+      await self.execute('publish', self.publish, result)
+
+  async def main(self):
+    """ Run the tasks until the end of the input or stop()
+    """
+    self.running_event = asyncio.Event()
+    self.stop_event = asyncio.Event()
+    if self.running:
+      self.running_event.set()
+    self.loop = asyncio.get_event_loop()
+    frames = asyncio.Queue(maxsize=self.maxsize)
+    results = asyncio.Queue(maxsize=self.maxsize)
+    self.queues = {'frames': frames, 'results': results}
+    tasks = [asyncio.ensure_future(self.captureTask(frames)),
+             asyncio.ensure_future(self.inferenceTask(frames, results)),
+             asyncio.ensure_future(self.publishTask(results))]
+    stopper = asyncio.ensure_future(self.stop_event.wait())
+    pending = set(tasks + [stopper])
+    while True:
+      (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      # the publish task ends last at the end of the input, a failed task stops the loop
+      if stopper in done or tasks[-1] in done or any(task.exception() is not None for task in done):
+        break
+    for task in tasks + [stopper]:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+      if not task.cancelled() and task.exception() is not None:
+        self.log.error("Task failed: %r" % task.exception())
+
+  def run(self):
+    """ Run the event loop in the calling thread until the end of the input or stop()
+    """
+    self.executors = dict((step, ThreadPoolExecutor(max_workers=1, thread_name_prefix=step)) for step in ['capture', 'inference', 'publish'])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+      loop.run_until_complete(self.main())
+    finally:
+      self.loop = None
+      for executor in self.executors.values():
+        executor.shutdown(wait=True)
+      loop.close()
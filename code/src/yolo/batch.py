@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - batch
+
+Offline detection over archived image folders, run with ``python batch.py [input_folder] [output.jsonl]``
+
+* YoloSW: one neural net per worker process
+* YoloHW: the pipelined stages of pipeline.createYoloHWPipeline
+
+Every image gives one json line in the output file, which is also the checkpoint:
+images already in the output file are skipped when a run is restarted.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+from config import *
+import helpers
+import os
+import sys
+import json
+import time
+import multiprocessing
+import numpy as np
+import nms
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+# Create log modules, not queued as the worker processes log too
+handler = helpers.createHandler(dev_mode, config['PATH']['log_path'], config['APP']['log_level'], queued=False)
+log = helpers.createLogger(__name__)
+
+# YoloSW object of a worker process
+_yolo_sw_nn = None
+
+
+###############################################################################
+# Checkpoint Functions
+#
+def listImages(input_folder):
+  """ All image files below a folder, sorted
+
+  Args:
+      input_folder (str): folder with the archived images
+
+  Returns:
+      (list): absolute file paths
+  """
+  files = [os.path.abspath(f) for f in helpers.getListOfFiles(input_folder, True)]
+  return sorted(f for f in files if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+
+
+def loadCheckpoint(output):
+  """ Images already processed by a previous run
+
+      A line cut off by a crash is ignored, images with an error are processed again.
+
+  Args:
+      output (str): jsonl output file
+
+  Returns:
+      (set): file paths already done
+  """
+  done = set()
+  if not os.path.isfile(output):
+    return done
+  with open(output, 'r') as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      if 'error' not in record:
+        done.add(record['fpath'])
+  return done
+
+
+###############################################################################
+# YoloSW Worker Functions
+#
+def initYoloSW(darknet_path, darknet_cfg, darknet_weights, suppressor=None):
+  """ Worker process initializer, loads the neural net once per process
+
+  Args:
+      darknet_path (str): Path to darknet library
+      darknet_cfg (str): Path to darknet configuration file
+      darknet_weights (str): Path to darknet neural net weights
+      suppressor (obj, optional): nms.NonMaxSuppression. Defaults to class aware greedy NMS.
+  """
+  global _yolo_sw_nn
+  import yolo_sw
+  import cv2
+  # one process per core, opencv must not spawn its own threads on top
+  cv2.setNumThreads(1)
+  _yolo_sw_nn = yolo_sw.YoloSW(darknet_path, darknet_cfg, darknet_weights, suppressor)
+
+
+def detectYoloSW(fpath):
+  """ Detect the objects of one image in a worker process
+
+  Args:
+      fpath (str): image file
+
+  Returns:
+      (dict): output record
+  """
+  try:
+    (image, layer_outputs) = _yolo_sw_nn.loadFile(fpath)
+    # the boxes are already suppressed
+    (boxes, confidences, class_ids) = _yolo_sw_nn.execute_yolo_sw(image)
+    return {'fpath': fpath,
+            'classes': [_yolo_sw_nn.labels[class_id] for class_id in class_ids],
+            'confidences': confidences,
+            'boxes': boxes}
+  except Exception as e:
+    return {'fpath': fpath, 'error': repr(e)}
+
+
+###############################################################################
+# Batch Functions
+#
+def runYoloSW(files, workers=0, chunksize=4):
+  """ Detect the objects of all images with a YoloSW process pool
+
+  Args:
+      files (list): image files
+      workers (int, optional): number of processes, 0 for one per cpu core. Defaults to 0.
+      chunksize (int, optional): images sent to a worker at once. Defaults to 4.
+
+  Returns:
+      (generator): output records in the order of files
+  """
+  workers = workers if workers > 0 else multiprocessing.cpu_count()
+  log.info("YoloSW batch with %d processes" % workers)
+  with multiprocessing.Pool(workers, initYoloSW, (config['DARKNET_SW']['darknet_path'],
+                                                  config['DARKNET_SW']['darknet_cfg_path'],
+                                                  config['DARKNET_SW']['darknet_weights_path'],
+                                                  nms.createSuppressor(config['NMS']))) as pool:
+    for record in pool.imap(detectYoloSW, files, chunksize):
+      yield record
+
+
+def runYoloHW(files):
+  """ Detect the objects of all images with the pipelined YoloHW stages, or the YoloRef NumPy engine
+
+  Args:
+      files (list): image files
+
+  Returns:
+      (generator): output records in the order of files
+  """
+  import pipeline
+  if use_yolo_ref:
+    import yolo_ref
+    params_path = config['DARKNET_HW']['params_path'] or None
+    yolo_hw_nn = yolo_ref.YoloRef(params_path,
+                                  weights_cache=config['DARKNET_HW']['weights_cache'] if params_path else None,
+                                  suppressor=nms.createSuppressor(config['NMS']))
+  else:
+    import yolo_hw
+    yolo_hw_nn = yolo_hw.YoloHW(config['PYTHON']['python_path'], config['DARKNET_HW']['darknet_path'], config['DARKNET_HW']['weights_cache'], conv0_numpy, nms.createSuppressor(config['NMS']))
+  yolo_pipeline = pipeline.createYoloHWPipeline(yolo_hw_nn, config['PATH']['detection_image_path'], maxsize=pipeline_queue_size, region_numpy=True).start()
+
+  def record(frame):
+    if 'error' in frame:
+      return {'fpath': frame['fpath'], 'error': repr(frame['error'])}
+    return {'fpath': frame['fpath'], 'classes': frame['classes'], 'confidences': frame['confidences'], 'boxes': frame['boxes']}
+
+  try:
+    for fpath in files:
+      # blocks while the first stage is busy
+      yolo_pipeline.put({'fpath': fpath})
+      frame = yolo_pipeline.get(block=False)
+      while frame is not None:
+        yield record(frame)
+        frame = yolo_pipeline.get(block=False)
+  except BaseException:
+    yolo_pipeline.stop()
+    raise
+  # frames still in flight
+  for frame in yolo_pipeline.stop():
+    yield record(frame)
+
+
+def runBatch(input_folder, output, workers=0):
+  """ Detect the objects of all images below a folder, resume from the output file
+
+  Args:
+      input_folder (str): folder with the archived images
+      output (str): jsonl output file, appended
+      workers (int, optional): YoloSW processes, 0 for one per cpu core. Defaults to 0.
+
+  Returns:
+      (int): number of images processed
+  """
+  files = listImages(input_folder)
+  done = loadCheckpoint(output)
+  todo = [f for f in files if f not in done]
+  log.info("Batch detection: %d images found, %d already done, %d to process" % (len(files), len(files) - len(todo), len(todo)))
+  if not todo:
+    return 0
+
+  if use_yolo_hw:
+    records = runYoloHW(todo)
+  else:
+    records = runYoloSW(todo, workers)
+
+  count = 0
+  errors = 0
+  start = time.perf_counter()
+  last_report = start
+  with open(output, 'a') as f:
+    for record in records:
+      # one line per image, flushed so a crash loses at most the images in flight
+      f.write(json.dumps(record) + "\n")
+      f.flush()
+      count += 1
+      if 'error' in record:
+        errors += 1
+        log.warning("Detection failed on %s: %s" % (record['fpath'], record['error']))
+      now = time.perf_counter()
+      if now - last_report > 10:
+        last_report = now
+        log.info("%d of %d images, %.2f images/sec" % (count, len(todo), count / (now - start)))
+  duration = time.perf_counter() - start
+  log.info("Batch detection done: %d images (%d errors) in %.1f s, %.2f images/sec" % (count, errors, duration, count / duration if duration > 0 else 0.0))
+  return count
+
+
+###############################################################################
+# Main
+#
+if __name__ == "__main__":
+  # config changed into the script folder, the arguments are relative to the calling folder
+  input_folder = os.path.join(CWD, sys.argv[1]) if len(sys.argv) > 1 else config['PATH']['input_image_path']
+  output = os.path.join(CWD, sys.argv[2]) if len(sys.argv) > 2 else config['BATCH']['output']
+  runBatch(input_folder, output, int(config['BATCH']['workers']))
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - benchmark
+
+Micro-benchmarks of the hot stages, run with ``python benchmark.py [recorded.npz] [params_path bundle]``
+
+compareAccelerator checks the FPGA layers against the YoloRef NumPy golden model on the PYNQ.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import sys
+import platform
+import time
+import os
+import threading
+import numpy as np
+import yolo_sw
+import weights
+import conv
+import nms
+
+
+###############################################################################
+# Common Functions
+#
+def measure(func, repeat=100):
+  """ Measure the mean execution time of a function
+
+  Args:
+      func (function): function without arguments to measure
+      repeat (int, optional): number of executions. Defaults to 100.
+
+  Returns:
+      (tuple): tuple containing:
+
+          mean (float): mean execution time in seconds
+          result (obj): return value of the last execution
+  """
+  result = func()
+  start = time.perf_counter()
+  for i in range(repeat):
+    result = func()
+  return ((time.perf_counter() - start) / repeat, result)
+
+
+def printResult(title, reference, optimized):
+  """ Print the comparison of two measured execution times
+
+  Args:
+      title (str): name of the benchmark
+      reference (float): mean time of the reference implementation in seconds
+      optimized (float): mean time of the optimized implementation in seconds
+  """
+  print("{} on {} ({}): reference {:.3f} ms, optimized {:.3f} ms, speedup {:.1f}x".format(
+        title, platform.node(), platform.machine(), reference * 1000, optimized * 1000, reference / optimized))
+
+
+###############################################################################
+# YoloSW output decoding
+#
+def decodeOutputsLoop(layer_outputs, w, h, threshold=0.3):
+  """ Reference implementation of yolo_sw.decodeOutputs looping over every detection
+  """
+  boxes = []
+  confidences = []
+  class_ids = []
+  for output in layer_outputs:
+    for detection in output:
+      scores = detection[5:]
+      class_id = np.argmax(scores).item()
+      confidence = scores[class_id].item()
+      if confidence > threshold:
+        box = detection[0:4] * np.array([w, h, w, h])
+        center_x, center_y, width, height = box.astype(int).tolist()
+        x = center_x - width//2
+        y = center_y - height//2
+        boxes.append([x, y, width, height])
+        confidences.append(confidence)
+        class_ids.append(class_id)
+  return (boxes, confidences, class_ids)
+
+
+def randomLayerOutputs(classes=80, seed=0):
+  """ Generate yolov3-tiny shaped layer outputs (13x13 and 26x26 grid, 3 anchors)
+
+  Args:
+      classes (int, optional): number of classes. Defaults to 80.
+      seed (int, optional): random seed. Defaults to 0.
+
+  Returns:
+      (list): list of float32 arrays
+  """
+  rng = np.random.RandomState(seed)
+  layer_outputs = []
+  for grid in [13, 26]:
+    output = rng.rand(grid * grid * 3, 5 + classes).astype(np.float32)
+    # sparse class scores like a real scene
+    output[:, 5:] *= rng.rand(grid * grid * 3, classes) > 0.995
+    layer_outputs.append(output)
+  return layer_outputs
+
+
+def benchmarkDecode(recorded=None, w=640, h=480, repeat=100):
+  """ Compare the vectorized yolo_sw.decodeOutputs with the loop implementation
+
+  Args:
+      recorded (str, optional): .npz file with recorded layer outputs (np.savez(file, *layer_outputs)). Defaults to random outputs.
+      w (int, optional): image width. Defaults to 640.
+      h (int, optional): image height. Defaults to 480.
+      repeat (int, optional): number of executions. Defaults to 100.
+  """
+  if recorded is not None:
+    with np.load(recorded) as data:
+      layer_outputs = [data[key] for key in sorted(data.files, key=lambda k: int(k.split('_')[-1]))]
+  else:
+    layer_outputs = randomLayerOutputs()
+  (reference, expected) = measure(lambda: decodeOutputsLoop(layer_outputs, w, h), repeat)
+  (optimized, result) = measure(lambda: yolo_sw.decodeOutputs(layer_outputs, w, h), repeat)
+  assert result == expected, "vectorized decoding differs from the reference"
+  printResult("YoloSW output decoding ({} detections)".format(len(result[0])), reference, optimized)
+
+
+###############################################################################
+# Non maximum suppression
+#
+def nmsLoop(boxes, scores, class_ids, threshold=0.45):
+  """ Reference implementation of the former region.nms, one iou vector per kept box over all boxes
+  """
+  offset = class_ids[:, np.newaxis] * (np.max(boxes) + 1.0)
+  shifted = boxes + offset
+  order = np.argsort(-scores, kind="stable")
+  keep = []
+  while order.size > 0:
+    i = order[0]
+    keep.append(i)
+    order = order[1:][nms.iouMatrix(shifted[i:i + 1], shifted[order[1:]])[0] <= threshold]
+  return np.array(keep, dtype=int)
+
+
+def randomDetections(objects=20, boxes_per_object=50, classes=3, seed=0):
+  """ Clusters of jittered boxes around random objects, like the raw detections of a crowded scene
+
+  Args:
+      objects (int, optional): number of objects. Defaults to 20.
+      boxes_per_object (int, optional): raw detections per object. Defaults to 50.
+      classes (int, optional): number of classes. Defaults to 3.
+      seed (int, optional): random seed. Defaults to 0.
+
+  Returns:
+      (tuple): corners (n, 4), scores (n,) and class ids (n,)
+  """
+  rng = np.random.RandomState(seed)
+  centers = rng.rand(objects, 2) * np.array([640, 480])
+  sizes = rng.rand(objects, 2) * 150 + 30
+  n = objects * boxes_per_object
+  xy = np.repeat(centers, boxes_per_object, axis=0) + rng.randn(n, 2) * 8
+  wh = np.repeat(sizes, boxes_per_object, axis=0) * (1 + rng.randn(n, 2) * 0.05)
+  corners = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1).astype(np.float32)
+  scores = rng.rand(n).astype(np.float32) * 0.7 + 0.3
+  class_ids = np.repeat(rng.randint(0, classes, objects), boxes_per_object)
+  return (corners, scores, class_ids)
+
+
+def benchmarkNms(repeat=50):
+  """ Cost of the nms methods against cv2.dnn.NMSBoxes and the former per box loop
+
+  Args:
+      repeat (int, optional): number of executions. Defaults to 50.
+  """
+  import cv2
+  # raw detections of a usual frame and of a crowded scene, the top_k pruning drops boxes of the crowded scene
+  for (objects, boxes_per_object) in [(5, 20), (20, 50)]:
+    (corners, scores, class_ids) = randomDetections(objects, boxes_per_object)
+    xywh = np.concatenate([corners[:, 0:2], corners[:, 2:4] - corners[:, 0:2]], axis=1)
+    (opencv, kept) = measure(lambda: cv2.dnn.NMSBoxes(xywh.tolist(), scores.tolist(), 0.3, 0.45), repeat)
+    print("NMS cv2.dnn.NMSBoxes: {:.3f} ms, {} of {} boxes kept".format(opencv * 1000, len(np.array(kept).flatten()), len(scores)))
+    (reference, expected) = measure(lambda: nmsLoop(corners, scores, class_ids), repeat)
+    print("NMS per box loop: {:.3f} ms, {} of {} boxes kept".format(reference * 1000, len(expected), len(scores)))
+    results = {}
+    for (method, top_k) in [("greedy", 0), ("class", 0), ("class", 200), ("soft", 200)]:
+      suppressor = nms.NonMaxSuppression(method, top_k=top_k)
+      (results[(method, top_k)], (keep, kept_scores)) = measure(lambda: suppressor(corners, scores, class_ids), repeat)
+      print("NMS {} top_k {}: {:.3f} ms, {} of {} boxes kept".format(method, top_k or "all", results[(method, top_k)] * 1000, len(keep), len(scores)))
+    assert np.array_equal(nms.NonMaxSuppression("class", top_k=0)(corners, scores, class_ids)[0], expected), "class aware nms differs from the reference"
+    printResult("NMS class aware of {} boxes".format(len(scores)), reference, results[("class", 200)])
+
+
+###############################################################################
+# YoloHW weight loading
+#
+def loadParamsNpy(params_path):
+  """ Reference implementation of the weight loading in YoloHW.__init__ without bundle
+  """
+  arrays = {}
+  for name, (fname, axes) in weights.PARAMS.items():
+    array = np.load(os.path.join(params_path, fname), encoding="latin1", allow_pickle=True)
+    arrays[name] = np.transpose(array, axes=axes) if axes is not None else array
+  return arrays
+
+
+def benchmarkWeights(params_path, bundle, repeat=10):
+  """ Compare the startup weight loading from the npy files with the memory mapped bundle
+
+  Args:
+      params_path (str): folder containing the tinier-yolo npy files
+      bundle (str): path of the bundle file, compiled if missing
+      repeat (int, optional): number of executions. Defaults to 10.
+  """
+  (reference, expected) = measure(lambda: loadParamsNpy(params_path), repeat)
+  weights.loadCachedWeights(params_path, bundle)
+  (optimized, result) = measure(lambda: weights.loadCachedWeights(params_path, bundle), repeat)
+  for name in expected:
+    assert np.array_equal(expected[name], result[name]), "bundle differs from the npy files"
+  printResult("YoloHW weight loading", reference, optimized)
+
+
+###############################################################################
+# YoloHW conv0
+#
+def conv0Direct(npimg, w, b, stride=2, padding=1):
+  """ Direct convolution in the layout of conv.Conv0, summing over the kernel offsets, used if qnn is missing
+  """
+  (ka, kb, c, f) = w.shape
+  x = np.pad(npimg, ((padding, padding), (padding, padding), (0, 0)))
+  out_a = (npimg.shape[0] + 2 * padding - ka) // stride + 1
+  out_b = (npimg.shape[1] + 2 * padding - kb) // stride + 1
+  out = np.zeros((f, out_b, out_a), dtype=np.float64)
+  for i in range(ka):
+    for j in range(kb):
+      window = x[i:i + stride * out_a:stride, j:j + stride * out_b:stride]
+      out += np.einsum('abc,cf->fba', window, w[i, j].astype(np.float64))
+  out += b[:, np.newaxis, np.newaxis]
+  return out[np.newaxis]
+
+
+def benchmarkConv0(weights_path=None, repeat=10):
+  """ Compare conv.Conv0 with the qnn.utils.conv_layer path of YoloHW.execute_yolo_sw_firstlayer
+
+      Without qnn the direct convolution is used as reference, then only the number of differing
+      quantization levels is reported as the float summation order differs.
+
+  Args:
+      weights_path (str, optional): folder containing the tinier-yolo npy files. Defaults to random weights.
+      repeat (int, optional): number of executions. Defaults to 10.
+  """
+  rng = np.random.RandomState(0)
+  if weights_path is not None:
+    params = weights.loadParams(weights_path)
+    (w, b) = (params['conv0_weights'], params['conv0_bias'])
+  else:
+    w = (rng.randn(3, 3, 3, 16) * 0.5).astype(np.float32)
+    b = (rng.randn(16) * 0.1).astype(np.float32)
+  npimg = rng.rand(416, 416, 3).astype(np.float32)
+  kernel = conv.Conv0(w, b)
+  (optimized, result) = measure(lambda: kernel(npimg).copy(), repeat)
+  try:
+    from qnn import utils
+    bias = np.broadcast_to(b[:, np.newaxis], (16, 208 * 208))
+    (reference, expected) = measure(lambda: utils.quantize(utils.conv_layer(npimg[np.newaxis], w, b=bias, stride=2, padding=1).clip(0.0, 4.0) / 4, 3), repeat)
+    assert np.array_equal(result.ravel(), np.asarray(expected).ravel()), "conv0 differs from qnn.utils.conv_layer"
+  except ImportError:
+    (reference, expected) = measure(lambda: conv0Direct(npimg, w, b), repeat)
+    expected = np.rint(np.clip(expected, 0.0, 4.0) / 4 * 7)
+    print("conv0 without qnn: {} of {} quantized outputs differ from the direct convolution".format(int(np.sum(np.rint(result * 7) != expected)), result.size))
+  printResult("YoloHW conv0", reference, optimized)
+
+
+###############################################################################
+# YoloRef NumPy engine
+#
+def benchmarkReference(params_path=None, repeat=5):
+  """ Frame rate of the YoloRef NumPy engine per stage
+
+  Args:
+      params_path (str, optional): folder containing the tinier-yolo npy files. Defaults to random weights.
+      repeat (int, optional): number of frames. Defaults to 5.
+  """
+  import yolo_ref
+  nn = yolo_ref.YoloRef(params_path)
+  image = np.random.RandomState(0).randint(0, 255, size=(480, 640, 3), dtype=np.uint8)
+  stages = [("Image Loading", lambda: nn.getImage(image)),
+            ("Conv Layer 0", nn.execute_yolo_sw_firstlayer),
+            ("Conv Layers 1-7", nn.execute_yolo_hw),
+            ("Conv Layer 8", nn.execute_yolo_sw_lastlayer),
+            ("Decode Detections", nn.region_detection)]
+  total = 0.0
+  for (title, stage) in stages:
+    (duration, result) = measure(stage, repeat)
+    total += duration
+    print("YoloRef {}: {:.3f} ms".format(title, duration * 1000))
+  print("YoloRef on {} ({}): {:.1f} ms per frame, {:.2f} fps".format(platform.node(), platform.machine(), total * 1000, 1.0 / total))
+
+
+def compareAccelerator(yolo_hw_nn, yolo_ref_nn, frames=10, seed=0):
+  """ Regression of the accelerator against the YoloRef golden model, on the PYNQ
+
+      Both get the same random conv0 activations, the conv1-7 outputs and the decoded detections are compared.
+
+  Args:
+      yolo_hw_nn (obj): yolo_hw.YoloHW object
+      yolo_ref_nn (obj): yolo_ref.YoloRef object with the same params
+      frames (int, optional): number of random inputs. Defaults to 10.
+      seed (int, optional): random seed. Defaults to 0.
+
+  Returns:
+      (int): number of differing conv7 activations over all frames
+  """
+  rng = np.random.RandomState(seed)
+  in_ch = yolo_ref_nn.net['conv1']['input'][0]
+  in_dim = yolo_ref_nn.net['conv1']['input'][1]
+  mismatches = 0
+  for i in range(frames):
+    conv0_output_quant = rng.randint(0, 8, size=(1, in_ch, in_dim, in_dim)).astype(np.float32) / 7
+    start = time.perf_counter()
+    hw = np.asarray(yolo_hw_nn.execute_yolo_hw(conv0_output_quant)).reshape(yolo_ref_nn.layers[-1].out_shape)
+    hw_time = time.perf_counter() - start
+    start = time.perf_counter()
+    ref = yolo_ref_nn.execute_yolo_hw(conv0_output_quant)
+    ref_time = time.perf_counter() - start
+    differ = int(np.sum(np.rint(hw * 7) != np.rint(ref * 7)))
+    mismatches += differ
+    hw_detections = yolo_hw_nn.region_detection(yolo_hw_nn.execute_yolo_sw_lastlayer(hw), (416, 416))
+    ref_detections = yolo_ref_nn.region_detection(yolo_ref_nn.execute_yolo_sw_lastlayer(ref), (416, 416))
+    print("Frame {}: {} of {} conv7 activations differ, detections {}, accelerator {:.1f} ms, NumPy {:.1f} ms".format(
+          i, differ, ref.size, "match" if hw_detections == ref_detections else "differ", hw_time * 1000, ref_time * 1000))
+  return mismatches
+
+
+def benchmarkLogging(repeat=20):
+  """ Logging cost of the YoloRef stages at the log levels DEBUG and INFO, written directly resp. by a QueueListener
+
+      The stages are timed by a reporting timer.Timer like in the people detection, the log goes to a temporary file.
+      The time spent in the root handler is measured on the inference thread, the frame time itself varies more
+      than the logging costs.
+
+  Args:
+      repeat (int, optional): number of frames per configuration. Defaults to 20.
+  """
+  import logging
+  import logging.handlers
+  import queue
+  import tempfile
+  import yolo_ref
+  import timer
+  nn = yolo_ref.YoloRef()
+  frame_timer = timer.Timer(report=True, filewrite=False)
+  image = np.random.RandomState(0).randint(0, 255, size=(480, 640, 3), dtype=np.uint8)
+  stages = [("Image Loading", lambda: nn.getImage(image)),
+            ("Conv Layer 0", nn.execute_yolo_sw_firstlayer),
+            ("Conv Layers 1-7", nn.execute_yolo_hw),
+            ("Conv Layer 8", nn.execute_yolo_sw_lastlayer),
+            ("Decode Detections", nn.region_detection)]
+
+  def detect():
+    for (title, stage) in stages:
+      start = time.perf_counter()
+      stage()
+      frame_timer.add(time.perf_counter() - start, title)
+
+  root = logging.getLogger()
+  handlers = root.handlers[:]
+  levels = dict((logger, logger.level) for logger in (nn.log, frame_timer.log))
+  results = {}
+  with tempfile.TemporaryDirectory() as folder:
+    for queued in (False, True):
+      for level in ("DEBUG", "INFO"):
+        handler = logging.FileHandler(os.path.join(folder, "benchmark.log"))
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s'))
+        listener = None
+        if queued:
+          root_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+          root_handler.setFormatter(logging.Formatter('%(message)s'))
+          listener = logging.handlers.QueueListener(root_handler.queue, handler)
+          listener.start()
+          root.handlers = [root_handler]
+        else:
+          root_handler = handler
+          root.handlers = [handler]
+        spent = [0.0, 0]
+        handle = root_handler.handle
+
+        def timedHandle(record):
+          start = time.perf_counter()
+          result = handle(record)
+          spent[0] += time.perf_counter() - start
+          spent[1] += 1
+          return result
+        root_handler.handle = timedHandle
+        for logger in levels:
+          logger.setLevel(level)
+        (duration, result) = measure(detect, repeat)
+        if listener is not None:
+          listener.stop()
+        handler.close()
+        # measure() runs one more frame to warm up
+        results[(level, queued)] = spent[0] / (repeat + 1)
+        print("Logging {} {}: frame {:.3f} ms, {} records, {:.3f} ms logging per frame on the inference thread".format(
+              level, "queued" if queued else "direct", duration * 1000, spent[1] // (repeat + 1), results[(level, queued)] * 1000))
+  root.handlers = handlers
+  for (logger, level) in levels.items():
+    logger.setLevel(level)
+  printResult("Logging per frame DEBUG direct vs INFO queued", results[("DEBUG", False)], results[("INFO", True)])
+
+
+###############################################################################
+# MQTT detection publishing
+#
+class PublishInfo:
+  """ Stand-in for paho MQTTMessageInfo
+  """
+
+  def __init__(self, mid, rc=0):
+    self.mid = mid
+    self.rc = rc
+
+  def is_published(self):
+    return self.rc == 0
+
+
+class LocalBroker:
+  """ Stand-in for the paho client and broker, records the published payload sizes
+
+      The messages are acknowledged at once to the mqtt client. While offline the messages are held like the
+      paho client does with the qos 1 messages of a lost connection, they are delivered first after the reconnect.
+  """
+
+  def __init__(self, owner=None):
+    self.owner = owner
+    self.messages = 0
+    self.bytes = 0
+    self.mid = 0
+    self.online = True
+    self.held = []
+    self.delivered = []
+    self.lock = threading.Lock()
+
+  def publish(self, topic, payload=None, qos=0, retain=False):
+    with self.lock:
+      self.mid += 1
+      if not self.online:
+        self.held.append((self.mid, payload))
+        return PublishInfo(self.mid, 4)
+      self.deliver(self.mid, topic, payload)
+    return PublishInfo(self.mid)
+
+  def deliver(self, mid, topic, payload):
+    self.messages += 1
+    self.bytes += len(payload) + len(topic)
+    self.delivered.append(payload[:8])
+    if self.owner is not None:
+      self.owner.on_publish(self, None, mid)
+
+  def goOffline(self):
+    with self.lock:
+      self.online = False
+    if self.owner is not None:
+      self.owner.on_disconnect(self, None, 1)
+
+  def goOnline(self):
+    with self.lock:
+      for (mid, payload) in self.held:
+        self.deliver(mid, "", payload)
+      self.held = []
+      self.online = True
+    if self.owner is not None:
+      self.owner.on_connect(self, None, None, 0)
+
+  def subscribe(self, topic):
+    pass
+
+  def disconnect(self):
+    pass
+
+  def loop_stop(self):
+    pass
+
+
+def connectLocal(client):
+  """ Connect a mqtt client to a LocalBroker
+
+  Args:
+      client (obj): mqtt_client.MqttClient object
+
+  Returns:
+      (obj): LocalBroker object
+  """
+  client.client = LocalBroker(client)
+  client.startSender()
+  client.on_connect(client.client, None, None, 0)
+  return client.client
+
+
+def benchmarkMqtt(image_path=None, detections=3, repeat=50):
+  """ Compare bytes on the wire and publish latency of the json and binary detection format
+
+  Args:
+      image_path (str, optional): image to publish. Defaults to a random 640x480 image.
+      detections (int, optional): number of detections per frame. Defaults to 3.
+      repeat (int, optional): number of publishes. Defaults to 50.
+  """
+  import cv2
+  import mqtt_client
+  if image_path is not None:
+    image = cv2.imread(image_path)
+  else:
+    image = np.random.RandomState(0).randint(0, 255, size=(480, 640, 3), dtype=np.uint8)
+  labels = ["person"] * detections
+  confidences = [0.9] * detections
+  boxes = [[10, 20, 100, 200]] * detections
+  results = {}
+  for (wire_format, batch_size) in [("json", 1), ("binary", 1), ("binary", 8)]:
+    client = mqtt_client.MqttClient(location="benchmark", wire_format=wire_format, batch_window=60 if batch_size > 1 else 0, batch_size=batch_size, topic_status="")
+    connectLocal(client)
+    (latency, result) = measure(lambda: client.publishDetection(labels, confidences, boxes, image=image), repeat)
+    client.disconnect()
+    results[(wire_format, batch_size)] = latency
+    print("MQTT {} batch {}: {} messages, {:.0f} bytes per frame, publish {:.3f} ms".format(
+          wire_format, batch_size, client.client.messages, client.client.bytes / (repeat + 1), latency * 1000))
+  printResult("MQTT binary vs json publish", results[("json", 1)], results[("binary", 1)])
+
+
+def benchmarkOutbox(address=None, port=1883, messages=2000, size=20000, rate=1000, outages=3, outage=0.5, queue_size=200):
+  """ Throughput and memory of the mqtt outbox with disconnects during the publishing
+
+      Without address the LocalBroker goes offline, with the address of a local broker (e.g. mosquitto) the
+      socket of the client is shut down and paho reconnects. A second client subscribes and checks the order.
+
+  Args:
+      address (str, optional): address of a local mqtt broker, None for the LocalBroker. Defaults to None.
+      port (int, optional): port of the broker. Defaults to 1883.
+      messages (int, optional): number of published messages. Defaults to 2000.
+      size (int, optional): payload bytes per message, about a detection image. Defaults to 20000.
+      rate (float, optional): published messages per second. Defaults to 1000.
+      outages (int, optional): number of disconnects spread over the publishing. Defaults to 3.
+      outage (float, optional): seconds offline per disconnect. Defaults to 0.5.
+      queue_size (int, optional): messages in memory, the following ones are spilled to disk. Defaults to 200.
+  """
+  import socket
+  import struct
+  import tempfile
+  import tracemalloc
+  import paho.mqtt.client as mqtt
+  import mqtt_client
+  topic = "yolo/benchmark/outbox"
+  received = []
+  with tempfile.TemporaryDirectory() as folder:
+    client = mqtt_client.MqttClient(address=address, port=port, topic_status="", queue_size=queue_size, queue_bytes=queue_size * size,
+                                    spool_path=os.path.join(folder, "spool"))
+    if address is None:
+      broker = connectLocal(client)
+    else:
+      subscriber = mqtt.Client()
+      subscriber.on_message = lambda c, u, msg: received.append(msg.payload[:8])
+      subscriber.connect(address, port)
+      subscriber.subscribe(topic, qos=1)
+      subscriber.loop_start()
+      client.client.reconnect_delay_set(min_delay=1, max_delay=1)
+      client.createConnection()
+      client.drain(5.0)
+    padding = b"\0" * (size - 8)
+    offline = set(int(messages * (i + 1) / (outages + 1)) for i in range(outages))
+    tracemalloc.start()
+    peak_pending = 0
+    start = time.perf_counter()
+    for i in range(messages):
+      if i in offline:
+        if address is None:
+          broker.goOffline()
+          threading.Timer(outage, broker.goOnline).start()
+        else:
+          # paho sees a broken connection and reconnects after reconnect_delay
+          client.client.socket().shutdown(socket.SHUT_RDWR)
+      client.publishMessage(struct.pack("!Q", i) + padding, topic, retain=False)
+      peak_pending = max(peak_pending, len(client.outbox))
+      time.sleep(max(0.0, start + (i + 1) / rate - time.perf_counter()))
+    client.drain(30.0)
+    duration = time.perf_counter() - start
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = client.outbox.stats()
+    client.disconnect()
+    if address is None:
+      received = broker.delivered
+    else:
+      time.sleep(1.0)
+      subscriber.loop_stop()
+      subscriber.disconnect()
+  sequence = [struct.unpack("!Q", payload)[0] for payload in received]
+  unique = sorted(set(sequence))
+  # qos 1 may deliver twice, the first delivery of each message must be in order
+  first = []
+  seen = set()
+  for seq in sequence:
+    if seq not in seen:
+      seen.add(seq)
+      first.append(seq)
+  print("MQTT outbox {} on {}: {} of {} messages delivered, {} duplicates, {} out of order, {} spilled, {} dropped".format(
+        address or "local", platform.node(), len(unique), messages, len(sequence) - len(unique),
+        sum(1 for (a, b) in zip(first, first[1:]) if b < a), client.outbox.spilled, stats['dropped']))
+  print("MQTT outbox: {:.0f} messages/sec, {:.1f} MB/s, {} messages queued at most, peak python memory {:.1f} MB ({:.1f} MB in memory queue bound)".format(
+        messages / duration, messages * size / duration / 1e6, peak_pending, peak / 1e6, queue_size * size / 1e6))
+
+
+def benchmarkAdaptive(latency=0.5, cycles=20):
+  """ Steady state of the adaptive capture interval of an empty scene with a constant latency
+
+      The interval settles at min(max_interval, latency_budget - latency) in the idle state, also with a
+      max_interval above the budget, which is clamped to it.
+
+  Args:
+      latency (float, optional): seconds from the capture to the published detection. Defaults to 0.5.
+      cycles (int, optional): capture cycles without detection. Defaults to 20.
+  """
+  import adaptive
+  import timer
+  for max_interval in [2.5, 5.0]:
+    frame_timer = timer.Timer(filewrite=False)
+    for i in range(100):
+      frame_timer.add(latency, "Latency benchmark")
+    interval = adaptive.AdaptiveInterval(frame_timer, min_interval=0.0, max_interval=max_interval, hold=10.0, decay=1.5, latency_budget=3.0, refresh=0.0)
+    states = []
+    for i in range(cycles):
+      interval.update(False)
+      states.append((interval.next(), interval.state))
+    expected = max(min(interval.max_interval, interval.latency_budget - latency), interval.min_interval)
+    print("Adaptive interval max {} s, latency {} s: {:.2f} s {} after {} cycles, {} decisions".format(
+          max_interval, latency, states[-1][0], states[-1][1], cycles, interval.decisions))
+    assert all(abs(value - expected) < 1e-6 and state == "idle" for (value, state) in states[-cycles // 2:]), "empty scene not idle at the capped interval"
+
+
+###############################################################################
+# Main
+#
+if __name__ == "__main__":
+  benchmarkDecode(*sys.argv[1:2])
+  benchmarkNms()
+  benchmarkConv0(*sys.argv[2:3])
+  benchmarkReference(*sys.argv[2:3])
+  benchmarkLogging()
+  benchmarkMqtt()
+  benchmarkOutbox()
+  benchmarkAdaptive()
+  if len(sys.argv) > 3:
+    benchmarkWeights(sys.argv[2], sys.argv[3])
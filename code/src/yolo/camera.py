@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - camera
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import threading
+import time
+import numpy as np
+import cv2
+import helpers
+
+
+###############################################################################
+# Fake Capture
+#
+class ArrayCapture:
+  """ cv2.VideoCapture compatible capture backed by a list of frames or an image folder.
+      Used to run and test the capture thread without a webcam.
+  """
+
+  def __init__(self, frames, loop=True, fps=None):
+    """ Constructor for the fake capture
+
+    Args:
+        frames (list|str): list of image arrays or folder containing image files
+        loop (bool, optional): restart at the first frame after the last one. Defaults to True.
+        fps (float, optional): simulated camera frame rate, None for as fast as possible. Defaults to None.
+    """
+    if isinstance(frames, str):
+      frames = [cv2.imread(f) for f in sorted(helpers.getListOfFiles(frames, False, True))]
+    self.frames = list(frames)
+    self.loop = loop
+    self.period = None if fps is None else 1.0 / fps
+    self.index = 0
+    self.opened = len(self.frames) > 0
+
+  def isOpened(self):
+    return self.opened
+
+  def read(self):
+    """ Read the next frame, same signature as cv2.VideoCapture.read()
+
+    Returns:
+        (tuple): tuple containing:
+
+          ret (bool): True if a frame was read
+          frame (obj): image as numpy array or None
+    """
+    if not self.opened:
+      return (False, None)
+    if self.index >= len(self.frames):
+      if not self.loop:
+        return (False, None)
+      self.index = 0
+    if self.period is not None:
+      time.sleep(self.period)
+    frame = self.frames[self.index]
+    self.index += 1
+    return (True, frame.copy())
+
+  def release(self):
+    self.opened = False
+
+
+###############################################################################
+# Camera Class
+#
+class Camera:
+  """ Long-lived webcam capture with a background reader thread.
+      The reader thread keeps only the newest frame (drop-oldest), the consumer always gets the latest frame.
+  """
+
+  def __init__(self, camera=0, yolo_hw=False, capture=None, timeout=2.0, notify=None):
+    """ Constructor for the camera class, opens the device once
+
+    Args:
+        camera (int|str, optional): Identifier for camera to use, or video file path. Defaults to 0.
+        yolo_hw (bool, optional): running on the PYNQ, DirectShow backend is only used on the PC. Defaults to False.
+        capture (obj, optional): cv2.VideoCapture compatible object to use instead of opening a device. Defaults to None.
+        timeout (float, optional): max seconds to wait for a frame in read(). Defaults to 2.0.
+        notify (obj, optional): threading.Condition notified on every new frame, shared by several cameras. Defaults to None.
+    """
+    self.log = helpers.createLogger(__name__)
+    if capture is not None:
+      self.capture = capture
+    elif yolo_hw or isinstance(camera, str):
+      self.capture = cv2.VideoCapture(camera)
+    else:
+      self.capture = cv2.VideoCapture(camera, cv2.CAP_DSHOW)
+    if not self.capture.isOpened():
+      self.log.error("Unable to open camera %s" % camera)
+    self.camera = camera
+    self.timeout = timeout
+    self.frame = None
+    self.frame_id = 0
+    self.frame_time = None
+    self.dropped = 0
+    self.consumed_id = 0
+    self.lock = threading.Lock()
+    self.new_frame = threading.Event()
+    self.stopped = threading.Event()
+    self.notify = notify
+    self.thread = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+
+  def __del__(self):
+    self.release()
+
+  def start(self):
+    """ Start the background reader thread
+
+    Returns:
+        (obj): camera object
+    """
+    if self.thread is None:
+      self.stopped.clear()
+      self.thread = threading.Thread(target=self.update, name="camera-%s" % self.camera, daemon=True)
+      self.thread.start()
+      self.log.info("Camera %s capture thread started" % self.camera)
+    return self
+
+  def update(self):
+    """ Reader thread loop, grabs frames as fast as the device delivers them
+    """
+    while not self.stopped.is_set():
+      ret, frame = self.capture.read()
+      if not ret:
+        if not self.capture.isOpened():
+          self.log.error("Camera %s closed, stopping capture thread" % self.camera)
+          break
+        time.sleep(0.01)
+        continue
+      with self.lock:
+        if self.frame_id > self.consumed_id:
+          self.dropped += 1
+        self.frame = frame
+        self.frame_id += 1
+        self.frame_time = time.time()
+      self.new_frame.set()
+      if self.notify is not None:
+        with self.notify:
+          self.notify.notify_all()
+
+  def hasNewFrame(self):
+    """ Check for a frame not yet returned by read()
+
+    Returns:
+        (bool): True if a new frame is available
+    """
+    return self.frame_id > self.consumed_id
+
+  def read(self, timeout=None, timestamp=False):
+    """ Get the latest frame
+
+    Args:
+        timeout (float, optional): max seconds to wait for the first frame. Defaults to the constructor timeout.
+        timestamp (bool, optional): also return the capture time of the frame, taken under the same lock. Defaults to False.
+
+    Returns:
+        (tuple): tuple containing:
+
+          ret (bool): True if a frame is available
+          frame (obj): newest image as numpy array or None
+          frame_time (float): capture time in seconds since epoch or None, only if timestamp is set
+    """
+    if self.thread is None:
+      self.start()
+    if not self.new_frame.wait(self.timeout if timeout is None else timeout):
+      self.log.error("No frame received from camera %s" % self.camera)
+      return (False, None, None) if timestamp else (False, None)
+    with self.lock:
+      self.consumed_id = self.frame_id
+      return (True, self.frame, self.frame_time) if timestamp else (True, self.frame)
+
+  def release(self):
+    """ Stop the reader thread and release the device
+    """
+    if getattr(self, "stopped", None) is None or self.stopped.is_set():
+      return
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join(timeout=self.timeout)
+      self.thread = None
+    self.capture.release()
+    self.log.info("Camera %s released, %d frames captured, %d dropped" % (self.camera, self.frame_id, self.dropped))
+
+
+###############################################################################
+# CameraScheduler Class
+#
+class CameraScheduler:
+  """ Several cameras feeding one inference engine
+
+      Earliest deadline first: the deadline of a camera is its last served time plus min_interval.
+      Of the cameras with a new frame and a passed deadline, the one waiting longest is served next,
+      with equal intervals this is a fair round robin. Per camera frame rate and latency are tracked.
+  """
+
+  def __init__(self, cameras, locations, yolo_hw=False, min_interval=0.0, timeout=2.0, capture=None):
+    """ Constructor for the scheduler, opens all cameras
+
+    Args:
+        cameras (list): camera identifiers (int index or video file path)
+        locations (list): location tag of each camera
+        yolo_hw (bool, optional): running on the PYNQ. Defaults to False.
+        min_interval (float, optional): min seconds between two frames of the same camera. Defaults to 0.0.
+        timeout (float, optional): max seconds read() waits for a frame. Defaults to 2.0.
+        capture (list, optional): cv2.VideoCapture compatible objects instead of the devices. Defaults to None.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.locations = list(locations)
+    self.min_interval = min_interval
+    self.timeout = timeout
+    self.notify = threading.Condition()
+    self.cameras = [Camera(c, yolo_hw, capture[i] if capture is not None else None, timeout, self.notify) for i, c in enumerate(cameras)]
+    self.last_served = [0.0] * len(self.cameras)
+    self.served = [0] * len(self.cameras)
+    self.first_served = [None] * len(self.cameras)
+    self.latencies = [[] for c in self.cameras]
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+
+  def start(self):
+    """ Start the reader threads of all cameras
+
+    Returns:
+        (obj): scheduler object
+    """
+    for c in self.cameras:
+      c.start()
+    return self
+
+  def next(self, now):
+    """ Camera to serve next
+
+    Args:
+        now (float): current monotonic time
+
+    Returns:
+        (tuple): (camera index or None, seconds until the next deadline or None)
+    """
+    best = None
+    wait = None
+    for i, c in enumerate(self.cameras):
+      if not c.hasNewFrame():
+        continue
+      deadline = self.last_served[i] + self.min_interval
+      if deadline > now:
+        wait = deadline - now if wait is None else min(wait, deadline - now)
+      elif best is None or self.last_served[i] < self.last_served[best]:
+        best = i
+    return (best, wait)
+
+  def read(self, timeout=None):
+    """ Get the frame of the next camera, waits until a camera has a new frame
+
+    Args:
+        timeout (float, optional): max seconds to wait. Defaults to the constructor timeout.
+
+    Returns:
+        (tuple): tuple containing:
+
+          index (int): camera index or None on timeout
+          location (str): location of the camera
+          frame (obj): newest image of the camera as numpy array
+          timestamp (float): capture time in seconds since epoch
+    """
+    end = time.monotonic() + (self.timeout if timeout is None else timeout)
+    with self.notify:
+      while True:
+        now = time.monotonic()
+        (i, wait) = self.next(now)
+        if i is not None:
+          break
+        if now >= end:
+          self.log.error("No frame received from any camera")
+          return (None, None, None, None)
+        self.notify.wait(min(end - now, wait) if wait is not None else end - now)
+    # the frame and its timestamp are read together, the reader thread may replace the frame meanwhile
+    (ret, frame, frame_time) = self.cameras[i].read(timestamp=True)
+    self.last_served[i] = now
+    self.served[i] += 1
+    if self.first_served[i] is None:
+      self.first_served[i] = now
+    return (i, self.locations[i], frame, frame_time)
+
+  def addLatency(self, index, latency):
+    """ Record the capture to publish latency of a served frame
+
+    Args:
+        index (int): camera index
+        latency (float): seconds
+    """
+    self.latencies[index].append(latency)
+    # keep the last 1000 values
+    if len(self.latencies[index]) > 2000:
+      del self.latencies[index][:1000]
+
+  def stats(self):
+    """ Frame rate and latency per camera
+
+    Returns:
+        (dict): {camera index: {'location', 'frames', 'fps', 'latency_mean', 'latency_p95', 'dropped'}}, locations may repeat
+    """
+    now = time.monotonic()
+    stats = {}
+    for i, location in enumerate(self.locations):
+      duration = now - self.first_served[i] if self.first_served[i] is not None else 0.0
+      latencies = self.latencies[i][-1000:]
+      stats[i] = {'location': location,
+                  'frames': self.served[i],
+                  'fps': self.served[i] / duration if duration > 0 else 0.0,
+                  'latency_mean': float(np.mean(latencies)) if latencies else 0.0,
+                  'latency_p95': float(np.percentile(latencies, 95)) if latencies else 0.0,
+                  'dropped': self.cameras[i].dropped}
+    return stats
+
+  def report(self):
+    """ Log the frame rate and latency of every camera
+    """
+    for i, s in self.stats().items():
+      self.log.info("Camera %d (%s): %d frames, %.2f fps, latency mean %.3f s, p95 %.3f s, %d dropped" % (i, s['location'], s['frames'], s['fps'], s['latency_mean'], s['latency_p95'], s['dropped']))
+
+  def release(self):
+    """ Release all cameras
+    """
+    for c in self.cameras:
+      c.release()
@@ -39,10 +39,35 @@ static_images = config['APP']['static_images'].lower() in ['true', '1', 'y', 'ye
 save_images = config['APP']['save_images'].lower() in ['true', '1', 'y', 'yes']
 show_images = config['APP']['show_images'].lower() in ['true', '1', 'y', 'yes']
 use_yolo_hw = config['APP']['yolo_hw'].lower() in ['true', '1', 'y', 'yes']
+conv0_numpy = config['DARKNET_HW']['conv0_numpy'].lower() in ['true', '1', 'y', 'yes']
+use_pipeline = config['APP']['pipeline'].lower() in ['true', '1', 'y', 'yes']
+pipeline_queue_size = int(config['APP']['pipeline_queue_size'])
+region_numpy = config['APP']['region_numpy'].lower() in ['true', '1', 'y', 'yes']
+# tinier-yolo in NumPy instead of the FPGA, it has no darknet drawing
+use_yolo_ref = use_yolo_hw and config['DARKNET_HW']['engine'].strip().lower() == 'numpy'
+if use_yolo_ref:
+  region_numpy = True
+use_asyncio = config['APP']['asyncio'].lower() in ['true', '1', 'y', 'yes']
+use_motion_gate = config['MOTION']['enabled'].lower() in ['true', '1', 'y', 'yes']
+use_store = config['STORE']['enabled'].lower() in ['true', '1', 'y', 'yes']
+use_roi = config['ROI']['enabled'].lower() in ['true', '1', 'y', 'yes']
+use_adaptive_interval = config['ADAPTIVE']['enabled'].lower() in ['true', '1', 'y', 'yes']
+use_metrics = config['METRICS']['enabled'].lower() in ['true', '1', 'y', 'yes']
+# frames per YoloSW forward pass, the YoloHW stages overlap consecutive frames instead
+sw_batch_size = max(1, int(config['DARKNET_SW']['batch_size'])) if not use_yolo_hw else 1
+sw_batch_timeout = float(config['DARKNET_SW']['batch_timeout'])
+# one location tag per camera, a single tag is numbered for several cameras
+cameras = [int(c) if c.strip().isdigit() else c.strip() for c in config['APP']['camera'].split(',')]
+locations = [location.strip() for location in config['APP']['location'].split(',')]
+if len(locations) < len(cameras):
+  locations = [locations[0] + "_" + str(i + 1) for i in range(len(cameras))]
 
 config['PYTHON']['python_path'] = os.path.realpath(config['PYTHON']['python_path'])
 config['DARKNET_HW']['darknet_path'] = os.path.realpath(config['DARKNET_HW']['darknet_path'])
 config['DARKNET_HW']['darknet_path_python'] = os.path.realpath(config['DARKNET_HW']['darknet_path_python'])
+config['DARKNET_HW']['weights_cache'] = os.path.realpath(config['DARKNET_HW']['weights_cache'])
+if config['DARKNET_HW']['params_path']:
+  config['DARKNET_HW']['params_path'] = os.path.realpath(config['DARKNET_HW']['params_path'])
 config['DARKNET_SW']['darknet_path'] = os.path.realpath(config['DARKNET_SW']['darknet_path'])
 config['DARKNET_SW']['darknet_cfg_path'] = os.path.realpath(config['DARKNET_SW']['darknet_cfg_path'])
 config['DARKNET_SW']['darknet_weights_path'] = os.path.realpath(config['DARKNET_SW']['darknet_weights_path'])
@@ -53,6 +78,8 @@ config['PATH']['output_path'] = os.path.realpath(config['PATH']['output_path'])
 config['PATH']['raw_image_path'] = os.path.realpath(config['PATH']['raw_image_path'])
 config['PATH']['input_image_path'] = os.path.realpath(config['PATH']['input_image_path'])
 config['PATH']['detection_image_path'] = os.path.realpath(config['PATH']['detection_image_path'])
+config['BATCH']['output'] = os.path.realpath(config['BATCH']['output'])
+config['STORE']['path'] = os.path.realpath(config['STORE']['path'])
 
 ###############################################################################
 # create folders
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - conv
+
+NumPy implementation of the first convolutional layer of tinier-yolo (conv0) with quantized output.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+###############################################################################
+# Conv0 Class
+#
+class Conv0:
+  """ im2col convolution with a preallocated workspace and a single GEMM, clip and quantization in place
+
+      Same layouts as qnn.utils.conv_layer in YoloHW:
+
+      * input (A, B, C) image as returned by YoloHW.loadFile
+      * weights (KA, KB, C, F) conv0_weights_correct
+      * output (1, F, Bout, Aout), the spatial axes are swapped like in the darknet layout
+  """
+
+  def __init__(self, weights, bias, in_shape=(416, 416, 3), stride=2, padding=1, bits=3, clip=4.0):
+    """ Constructor for the conv0 kernel, allocates all buffers
+
+    Args:
+        weights (obj): weights (KA, KB, C, F)
+        bias (obj): bias (F,)
+        in_shape (tuple, optional): input image shape (A, B, C). Defaults to (416, 416, 3).
+        stride (int, optional): convolution stride. Defaults to 2.
+        padding (int, optional): zero padding. Defaults to 1.
+        bits (int, optional): quantization bits of the output. Defaults to 3.
+        clip (float, optional): activation clip value before the quantization. Defaults to 4.0.
+    """
+    (ka, kb, c, f) = weights.shape
+    (a, b, c_in) = in_shape
+    assert c == c_in, "input channels do not match the weights"
+    self.dtype = np.result_type(weights.dtype, np.float32)
+    self.stride = stride
+    self.padding = padding
+    self.levels = 2**bits - 1
+    self.clip = clip
+    self.out_a = (a + 2 * padding - ka) // stride + 1
+    self.out_b = (b + 2 * padding - kb) // stride + 1
+    self.out_shape = (1, f, self.out_b, self.out_a)
+
+    # (F, K) with K in (ka, kb, c) order
+    self.w_col = np.ascontiguousarray(weights.reshape(ka * kb * c, f).T, dtype=self.dtype)
+    self.bias = np.ascontiguousarray(np.asarray(bias, dtype=self.dtype).reshape(f, 1))
+
+    # workspace, the border of the padded image stays zero
+    self.padded = np.zeros((a + 2 * padding, b + 2 * padding, c), dtype=self.dtype)
+    (sa, sb, sc) = self.padded.strides
+    self.windows = as_strided(self.padded, shape=(self.out_b, self.out_a, ka, kb, c),
+                              strides=(sb * stride, sa * stride, sa, sb, sc), writeable=False)
+    self.cols = np.empty((self.out_b, self.out_a, ka, kb, c), dtype=self.dtype)
+    self.cols_2d = self.cols.reshape(self.out_b * self.out_a, ka * kb * c)
+    self.out = np.empty((f, self.out_b * self.out_a), dtype=self.dtype)
+
+  def __call__(self, npimg, out=None):
+    """ Execute conv0 and quantize the output
+
+    Args:
+        npimg (obj): input image (A, B, C)
+        out (obj, optional): array receiving the quantization levels 0..2**bits-1, any shape of size F*Bout*Aout. Defaults to None.
+
+    Returns:
+        (obj): quantized output in [0, 1] (1, F, Bout, Aout), the internal buffer is reused by the next call
+    """
+    levels = self.quantize(self.conv(npimg))
+    if out is not None:
+      np.copyto(out.reshape(self.out.shape), levels, casting='unsafe')
+    levels /= self.levels
+    return levels.reshape(self.out_shape)
+
+  def conv(self, npimg):
+    """ Convolution with bias, im2col and one GEMM
+
+    Args:
+        npimg (obj): input image (A, B, C)
+
+    Returns:
+        (obj): convolution output (F, Bout * Aout), internal buffer
+    """
+    p = self.padding
+    self.padded[p:self.padded.shape[0] - p, p:self.padded.shape[1] - p] = npimg
+    np.copyto(self.cols, self.windows)
+    np.matmul(self.w_col, self.cols_2d.T, out=self.out)
+    self.out += self.bias
+    return self.out
+
+  def quantize(self, x):
+    """ clip(x, 0, clip) / clip quantized to 2**bits-1 levels, in place
+
+    Args:
+        x (obj): convolution output
+
+    Returns:
+        (obj): quantization levels as float 0..2**bits-1, same buffer as x
+    """
+    np.clip(x, 0.0, self.clip, out=x)
+    x /= self.clip
+    x *= self.levels
+    np.rint(x, out=x)
+    return x
+
+
+###############################################################################
+# Conv Class
+#
+class Conv:
+  """ im2col convolution on channels last activations with a preallocated workspace and a single GEMM
+
+      * input (Y, X, C)
+      * weights (KY, KX, C, F)
+      * output (Yout, Xout, F), 1x1 kernels without stride and padding skip the im2col copy
+  """
+
+  def __init__(self, weights, in_shape, stride=1, padding=None, bias=None, dtype=np.float32):
+    """ Constructor for the convolution, allocates all buffers
+
+    Args:
+        weights (obj): weights (KY, KX, C, F)
+        in_shape (tuple): input shape (Y, X, C)
+        stride (int, optional): convolution stride. Defaults to 1.
+        padding (int, optional): zero padding. Defaults to half the kernel size.
+        bias (obj, optional): bias (F,). Defaults to None.
+        dtype (obj, optional): computation data type. Defaults to np.float32.
+    """
+    (ky, kx, c, f) = weights.shape
+    (y, x, c_in) = in_shape
+    assert c == c_in, "input channels do not match the weights"
+    self.in_shape = tuple(in_shape)
+    self.padding = ky // 2 if padding is None else padding
+    self.out_y = (y + 2 * self.padding - ky) // stride + 1
+    self.out_x = (x + 2 * self.padding - kx) // stride + 1
+    self.out_shape = (self.out_y, self.out_x, f)
+
+    # (K, F) with K in (ky, kx, c) order
+    self.w_col = np.ascontiguousarray(weights.reshape(ky * kx * c, f), dtype=dtype)
+    self.bias = None if bias is None else np.asarray(bias, dtype=dtype).reshape(1, f)
+    self.direct = (ky, kx, stride, self.padding) == (1, 1, 1, 0)
+
+    if not self.direct:
+      # workspace, the border of the padded input stays zero
+      self.padded = np.zeros((y + 2 * self.padding, x + 2 * self.padding, c), dtype=dtype)
+      (sy, sx, sc) = self.padded.strides
+      self.windows = as_strided(self.padded, shape=(self.out_y, self.out_x, ky, kx, c),
+                                strides=(sy * stride, sx * stride, sy, sx, sc), writeable=False)
+      self.cols = np.empty((self.out_y, self.out_x, ky, kx, c), dtype=dtype)
+      self.cols_2d = self.cols.reshape(self.out_y * self.out_x, ky * kx * c)
+    self.out = np.empty((self.out_y * self.out_x, f), dtype=dtype)
+
+  def __call__(self, x):
+    """ Execute the convolution
+
+    Args:
+        x (obj): input (Y, X, C)
+
+    Returns:
+        (obj): output (Yout, Xout, F), the internal buffer is reused by the next call
+    """
+    if self.direct:
+      cols = x.reshape(-1, self.in_shape[2])
+    else:
+      p = self.padding
+      self.padded[p:p + self.in_shape[0], p:p + self.in_shape[1]] = x
+      np.copyto(self.cols, self.windows)
+      cols = self.cols_2d
+    np.matmul(cols, self.w_col, out=self.out)
+    if self.bias is not None:
+      self.out += self.bias
+    return self.out.reshape(self.out_shape)
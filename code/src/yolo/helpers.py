@@ -16,7 +16,12 @@ import random
 import os
 import platform
 import logging
+import logging.handlers
+import queue
+import atexit
 import base64
+import json
+import struct
 from datetime import datetime
 import cv2
 from PIL import Image
@@ -68,6 +73,9 @@ def randomword(length):
   return ''.join(random.choice(string.lowercase) for i in range(length))
 
 
+# Prefix of the binary detection messages, legacy json messages start with '{'
+DETECTION_MAGIC = b"EPU1"
+
 ###############################################################################
 # Logging Functions
 #
@@ -81,16 +89,37 @@ rich_config = {
 }
 
 
-def createHandler(dev_mode, base_path):
+# Level of the project loggers, set from the ini log_level by createHandler
+log_level = logging.DEBUG
+project_loggers = set()
+# Background thread of the queued handler
+log_listener = None
+
+
+def createHandler(dev_mode, base_path, level=None, queued=True):
   """ Create log handler
 
+      The handler runs in a QueueListener thread: the logging thread only puts the record into a queue,
+      the file resp. console output is written in the background. Processes forked after this call
+      (multiprocessing workers) have no listener thread, they need queued=False.
+
   Args:
       dev_mode (bool): developer mode or not
       base_path ([type]): path for logfile
+      level (str, optional): level of the project loggers, DEBUG < INFO < WARNING < ERROR < CRITICAL. Defaults to DEBUG.
+      queued (bool, optional): write the records in a background thread. Defaults to True.
 
   Returns:
       [obj]: handler object
   """
+  global log_level, log_listener
+  if level is not None:
+    log_level = logging.getLevelName(str(level).strip().upper())
+    if not isinstance(log_level, int):
+      raise ValueError("Unknown log level '%s'" % level)
+    for name in project_loggers:
+      logging.getLogger(name).setLevel(log_level)
+
   if not dev_mode:
     FORMAT = '%(asctime)s - %(name)s - %(message)s'
     handler = logging.FileHandler(os.path.abspath(os.path.join(base_path, datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + 'people_detection.log')),
@@ -98,10 +127,21 @@ def createHandler(dev_mode, base_path):
   else:
     FORMAT = '%(message)s'
     handler = RichHandler(**rich_config)
+  handler.setFormatter(logging.Formatter(FORMAT, datefmt="%Y-%m-%d %H:%M:%S"))
+
+  root_handler = handler
+  if queued:
+    log_queue = queue.Queue(-1)
+    root_handler = logging.handlers.QueueHandler(log_queue)
+    # only the message is merged in the logging thread, the handler adds time and name in the listener
+    root_handler.setFormatter(logging.Formatter('%(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
   # setting the level parameter with basicConfig will set the level for all python modules
   logging.basicConfig(
-      format=FORMAT, datefmt="%Y-%m-%d %H:%M:%S", handlers=[handler])
+      format=FORMAT, datefmt="%Y-%m-%d %H:%M:%S", handlers=[root_handler])
 
   # handler.setFormatter(formatter)
   return handler
@@ -113,14 +153,15 @@ def createLogger(name, level=None):
 
   Args:
       name (str): name of the logging module
-      level (str): logging level
+      level (str): logging level, None to follow the level given to createHandler
 
   Returns:
       (obj): logger object
     """
   logger = logging.getLogger(name)
   if level is None:
-    lvl_to_set = 'DEBUG'
+    project_loggers.add(name)
+    lvl_to_set = log_level
   else:
     lvl_to_set = level
   logger.setLevel(lvl_to_set)
@@ -130,7 +171,7 @@ def createLogger(name, level=None):
 ###############################################################################
 # Webcam Functions
 #
-def saveWebcamImage(path='', name='webcam', ext='.jpg', camera=0, show=False, yolo_hw=False, verbose=False):
+def saveWebcamImage(path='', name='webcam', ext='.jpg', camera=0, show=False, yolo_hw=False, verbose=False, webcam=None, image=None):
   """ Launch webcam and save one image to disk
 
   Args:
@@ -140,16 +181,24 @@ def saveWebcamImage(path='', name='webcam', ext='.jpg', camera=0, show=False, yo
       camera (int, optional): Identifier for camera to use (only if multiple cameras available). Defaults to 0.
       show (bool, optional): Show image with cv2. Defaults to False.
       verbose (bool, optional): More output. Defaults to False.
+      webcam (obj, optional): Opened camera.Camera object, the device is opened and released per call if None. Defaults to None.
+      image (obj, optional): Frame already captured, saved instead of reading the camera. Defaults to None.
 
   Returns:
       str: Path of saved file
   """
   fpath = os.path.abspath(os.path.join(path, datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + name + ext))
-  if yolo_hw:
-    webcam = cv2.VideoCapture(camera)
+  if image is not None:
+    frame = image
+  elif webcam is not None:
+    ret, frame = webcam.read()
   else:
-    webcam = cv2.VideoCapture(camera, cv2.CAP_DSHOW)
-  ret, frame = webcam.read()
+    if yolo_hw:
+      capture = cv2.VideoCapture(camera)
+    else:
+      capture = cv2.VideoCapture(camera, cv2.CAP_DSHOW)
+    ret, frame = capture.read()
+    capture.release()
   if show:
     cv2.imshow('frame', frame)
   if verbose:
@@ -159,18 +208,23 @@ def saveWebcamImage(path='', name='webcam', ext='.jpg', camera=0, show=False, yo
   return fpath
 
 
-def getWebcamImage(camera=0, show=False):
+def getWebcamImage(camera=0, show=False, webcam=None):
   """ Launch webcam and return image
 
   Args:
       camera (int, optional):Identifier for camera to use (only if multiple cameras available). Defaults to 0.
       show (bool, optional): Show image with cv2. Defaults to False.
+      webcam (obj, optional): Opened camera.Camera object, the device is opened and released per call if None. Defaults to None.
 
   Returns:
       image: captures frame object
   """
-  webcam = cv2.VideoCapture(camera, cv2.CAP_DSHOW)
-  ret, frame = webcam.read()
+  if webcam is not None:
+    ret, frame = webcam.read()
+  else:
+    capture = cv2.VideoCapture(camera, cv2.CAP_DSHOW)
+    ret, frame = capture.read()
+    capture.release()
   if show:
     cv2.imshow('frame', frame)
   return frame
@@ -208,6 +262,50 @@ def convertFileToBase64(image_path):
     return -1
 
 
+def convertImageToJpeg(image, quality=95):
+  """ Encode image as jpeg bytes for binary transmission
+
+  Args:
+      image (obj): opencv image object
+      quality (int, optional): jpeg quality. Defaults to 95.
+  Returns:
+      (bytes): jpeg encoded image
+  """
+  _, im_arr = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+  return im_arr.tobytes()
+
+
+def convertFileToBytes(image_path):
+  """ Read image file for binary transmission
+
+  Args:
+      image_path (str): path to the image
+  Returns:
+      (bytes): file content, empty if the file does not exist
+  """
+  if os.path.isfile(image_path):
+    with open(image_path, "rb") as image_file:
+      return image_file.read()
+  return b""
+
+
+def packDetections(location, frames):
+  """ Pack detections and images into one binary message
+
+      Layout: DETECTION_MAGIC, json length (uint32 little endian), compact json, images concatenated.
+      The json contains the location and one entry per frame, 'image' is the byte length of its image.
+
+  Args:
+      location (str): identification of image location
+      frames (list): list of (frame dict, image bytes) tuples
+  Returns:
+      (bytes): binary message
+  """
+  header = {'location': location, 'frames': [dict(frame, image=len(image)) for frame, image in frames]}
+  meta = json.dumps(header, separators=(',', ':')).encode()
+  return b"".join([DETECTION_MAGIC, struct.pack('<I', len(meta)), meta] + [image for frame, image in frames])
+
+
 def displayFileNotebook(fname):
   """ Open image and display it in a notebook
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - letterbox
+
+NumPy/OpenCV replacement of the darknet load_image/letterbox_image preprocessing of YoloHW.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import numpy as np
+import cv2
+
+
+###############################################################################
+# Letterbox Class
+#
+class Letterbox:
+  """ Aspect preserving resize of a BGR frame into preallocated net_size x net_size float buffers
+
+      Same geometry as darknet letterbox_image: the image is scaled to fit, centered and the border
+      is filled with 0.5. The result is RGB in [0, 1] in the (A, B, C) = (x, y, channel) layout of
+      YoloHW.loadFile which conv0 consumes, as a transposed view of the buffer.
+
+      The buffers are used round robin, a returned image stays valid for the next count - 1 calls.
+  """
+
+  def __init__(self, net_size=416, count=1, dtype=np.float32):
+    """ Constructor for the letterbox, allocates the buffers
+
+    Args:
+        net_size (int, optional): network input size. Defaults to 416.
+        count (int, optional): number of buffers, frames in flight. Defaults to 1.
+        dtype (obj, optional): buffer data type. Defaults to np.float32.
+    """
+    self.net_size = net_size
+    self.dtype = dtype
+    self.buffers = []
+    self.next = 0
+    # geometry of the last frame size, the resized buffer and border only change with it
+    self.geometry = None
+    self.resized = None
+    self.reserve(count)
+
+  def reserve(self, count):
+    """ Grow the number of buffers
+
+    Args:
+        count (int): minimal number of buffers
+    """
+    while len(self.buffers) < count:
+      self.buffers.append({'canvas': np.full((self.net_size, self.net_size, 3), 0.5, dtype=self.dtype), 'geometry': None})
+
+  def fit(self, w, h):
+    """ Size and offset of the resized image like darknet letterbox_image (integer arithmetic)
+
+    Args:
+        w (int): image width
+        h (int): image height
+
+    Returns:
+        (tuple): (new_w, new_h, dx, dy)
+    """
+    n = self.net_size
+    if n / w < n / h:
+      (new_w, new_h) = (n, (h * n) // w)
+    else:
+      (new_w, new_h) = ((w * n) // h, n)
+    return (new_w, new_h, (n - new_w) // 2, (n - new_h) // 2)
+
+  def __call__(self, image):
+    """ Letterbox a frame
+
+    Args:
+        image (obj): BGR uint8 image (H, W, 3) as returned by OpenCV
+
+    Returns:
+        (obj): RGB float image (x, y, channel) net_size x net_size in [0, 1], view of an internal buffer
+    """
+    (h, w) = image.shape[:2]
+    if self.geometry is None or self.geometry[0:2] != (w, h):
+      self.geometry = (w, h) + self.fit(w, h)
+      self.resized = np.empty((self.geometry[3], self.geometry[2], 3), dtype=np.uint8)
+    (new_w, new_h, dx, dy) = self.geometry[2:]
+
+    buffer = self.buffers[self.next]
+    self.next = (self.next + 1) % len(self.buffers)
+    canvas = buffer['canvas']
+    if buffer['geometry'] != self.geometry:
+      # the border is only refilled if the frame size changes
+      canvas.fill(0.5)
+      buffer['geometry'] = self.geometry
+
+    cv2.resize(image, (new_w, new_h), dst=self.resized, interpolation=cv2.INTER_LINEAR)
+    # BGR -> RGB and scaling to [0, 1] in one pass straight into the canvas
+    np.multiply(self.resized[:, :, ::-1], 1.0 / 255, out=canvas[dy:dy + new_h, dx:dx + new_w], casting='unsafe')
+    return canvas.transpose(1, 0, 2)
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - metrics
+
+Metrics registry of the people detection: counters, gauges and histograms, exposed in the Prometheus
+text format on a local http endpoint and pushed as compact json to a $SYS-style mqtt topic.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import os
+import time
+import json
+import bisect
+import platform
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import helpers
+
+# Histogram buckets in seconds, 0.5 ms to 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+###############################################################################
+# Functions
+#
+def rssBytes():
+  """ Resident set size of the process
+
+  Returns:
+      (int): bytes, the peak resident size where /proc is missing
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError, AttributeError):
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def escape(value):
+  """ Escape a label value for the Prometheus text format
+
+  Args:
+      value (str): label value
+
+  Returns:
+      (str): escaped value
+  """
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatNumber(value):
+  """ Number in the Prometheus text format
+
+  Args:
+      value (float): value
+
+  Returns:
+      (str): integers without decimals, +Inf for infinity
+  """
+  if value == float('inf'):
+    return "+Inf"
+  if float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+
+###############################################################################
+# Metric Classes
+#
+class Metric:
+  """ Base class of the metrics, one series per value of the optional label
+
+      The series are updated under a lock, the capture, inference and publish threads share the metrics.
+  """
+  kind = "untyped"
+
+  def __init__(self, name, help="", label=None):
+    """ Constructor for a metric
+
+    Args:
+        name (str): metric name, e.g. yolo_frames_total
+        help (str, optional): description. Defaults to "".
+        label (str, optional): label name of the series, None for a single series. Defaults to None.
+    """
+    self.name = name
+    self.help = help
+    self.label = label
+    self.lock = threading.Lock()
+    self.series = {}
+
+  def selector(self, value, extra=None):
+    """ Label selector of a series
+
+    Args:
+        value (str): label value, None for the series without label
+        extra (str, optional): additional label, e.g. le="0.5". Defaults to None.
+
+    Returns:
+        (str): {label="value"} or an empty string
+    """
+    labels = []
+    if self.label is not None and value is not None:
+      labels.append('%s="%s"' % (self.label, escape(value)))
+    if extra is not None:
+      labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+  def values(self):
+    """ Copy of the series
+
+    Returns:
+        (dict): {label value: value}
+    """
+    with self.lock:
+      return dict(self.series)
+
+  def expose(self):
+    """ Lines of the metric in the Prometheus text format
+
+    Returns:
+        (list): text lines
+    """
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+    for (value, number) in sorted(self.values().items(), key=lambda item: str(item[0])):
+      lines.append("%s%s %s" % (self.name, self.selector(value), formatNumber(number)))
+    return lines
+
+  def compact(self):
+    """ Series for the mqtt push
+
+    Returns:
+        (obj): {label value: value}, the value itself for a metric without label
+    """
+    values = self.values()
+    if self.label is None:
+      return values.get(None, 0)
+    return dict((str(value), number) for (value, number) in values.items())
+
+
+class Counter(Metric):
+  """ Monotonic counter, e.g. frames processed
+  """
+  kind = "counter"
+
+  def inc(self, amount=1, value=None):
+    """ Increment the counter
+
+    Args:
+        amount (float, optional): increment. Defaults to 1.
+        value (str, optional): label value. Defaults to None.
+    """
+    with self.lock:
+      self.series[value] = self.series.get(value, 0) + amount
+
+
+class Gauge(Metric):
+  """ Current value, set by the application or read from a function when the metrics are collected
+  """
+  kind = "gauge"
+
+  def __init__(self, name, help="", label=None):
+    super().__init__(name, help, label)
+    self.functions = {}
+
+  def set(self, number, value=None):
+    """ Set the gauge
+
+    Args:
+        number (float): current value
+        value (str, optional): label value. Defaults to None.
+    """
+    with self.lock:
+      self.series[value] = number
+
+  def setFunction(self, function, value=None):
+    """ Read the gauge from a function at collection time, costs nothing on the hot path
+
+    Args:
+        function (function): function() returning the current value
+        value (str, optional): label value. Defaults to None.
+    """
+    with self.lock:
+      self.functions[value] = function
+
+  def values(self):
+    with self.lock:
+      series = dict(self.series)
+      functions = dict(self.functions)
+    for (value, function) in functions.items():
+      try:
+        series[value] = function()
+      except Exception:
+        # e.g. a queue already released at the shutdown
+        pass
+    return series
+
+
+class Histogram(Metric):
+  """ Distribution of observed values in fixed buckets, e.g. stage durations
+
+      A series is a list of non cumulative bucket counts (the last one is +Inf) followed by the sum,
+      an observation is one bisect and two additions.
+  """
+  kind = "histogram"
+
+  def __init__(self, name, help="", label=None, buckets=DEFAULT_BUCKETS):
+    """ Constructor for a histogram
+
+    Args:
+        name (str): metric name, e.g. yolo_stage_seconds
+        help (str, optional): description. Defaults to "".
+        label (str, optional): label name of the series. Defaults to None.
+        buckets (tuple, optional): ascending upper bounds. Defaults to DEFAULT_BUCKETS.
+    """
+    super().__init__(name, help, label)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, number, value=None):
+    """ Add an observation
+
+    Args:
+        number (float): observed value, e.g. seconds
+        value (str, optional): label value. Defaults to None.
+    """
+    i = bisect.bisect_left(self.buckets, number)
+    with self.lock:
+      series = self.series.get(value)
+      if series is None:
+        series = [0] * (len(self.buckets) + 1) + [0.0]
+        self.series[value] = series
+      series[i] += 1
+      series[-1] += number
+
+  def values(self):
+    with self.lock:
+      return dict((value, list(series)) for (value, series) in self.series.items())
+
+  def quantile(self, series, q):
+    """ Upper bucket bound of a quantile
+
+    Args:
+        series (list): bucket counts and sum
+        q (float): quantile, 0.0 <= q <= 1.0
+
+    Returns:
+        (float): upper bound of the bucket holding the quantile, None without observations
+    """
+    count = sum(series[:-1])
+    if count == 0:
+      return None
+    total = 0
+    for (bound, n) in zip(self.buckets + (float('inf'),), series[:-1]):
+      total += n
+      if total >= q * count:
+        return bound
+
+  def expose(self):
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+    for (value, series) in sorted(self.values().items(), key=lambda item: str(item[0])):
+      total = 0
+      for (bound, n) in zip(self.buckets + (float('inf'),), series[:-1]):
+        total += n
+        lines.append("%s_bucket%s %d" % (self.name, self.selector(value, 'le="%s"' % formatNumber(bound)), total))
+      lines.append("%s_sum%s %s" % (self.name, self.selector(value), formatNumber(series[-1])))
+      lines.append("%s_count%s %d" % (self.name, self.selector(value), total))
+    return lines
+
+  def compact(self):
+    """ Count, sum and p95 bucket bound per series for the mqtt push
+
+    Returns:
+        (obj): {label value: [count, sum, p95]}, the list itself for a histogram without label
+    """
+    out = {}
+    for (value, series) in self.values().items():
+      p95 = self.quantile(series, 0.95)
+      out[str(value) if value is not None else None] = [sum(series[:-1]), round(series[-1], 6), p95 if p95 != float('inf') else None]
+    if self.label is None:
+      return out.get(None, [0, 0.0, None])
+    return out
+
+
+###############################################################################
+# Registry Class
+#
+class Registry:
+  """ All metrics of the process by name
+
+      counter(), gauge() and histogram() return the existing metric of a name, so the modules can
+      share a metric without passing it around.
+  """
+
+  def __init__(self, prefix="yolo"):
+    """ Constructor for the registry
+
+    Args:
+        prefix (str, optional): prefix of the metric names. Defaults to "yolo".
+    """
+    self.prefix = prefix
+    self.metrics = {}
+    self.lock = threading.Lock()
+
+  def register(self, cls, name, help, label, **kwargs):
+    """ Get or create a metric
+
+    Args:
+        cls (class): Counter, Gauge or Histogram
+        name (str): metric name without prefix
+        help (str): description
+        label (str): label name or None
+
+    Returns:
+        (obj): the metric
+    """
+    name = self.prefix + "_" + name if self.prefix else name
+    with self.lock:
+      metric = self.metrics.get(name)
+      if metric is None:
+        metric = cls(name, help, label, **kwargs)
+        self.metrics[name] = metric
+      elif not isinstance(metric, cls):
+        raise ValueError("Metric %s is already registered as %s" % (name, metric.kind))
+    return metric
+
+  def counter(self, name, help="", label=None):
+    return self.register(Counter, name, help, label)
+
+  def gauge(self, name, help="", label=None):
+    return self.register(Gauge, name, help, label)
+
+  def histogram(self, name, help="", label=None, buckets=DEFAULT_BUCKETS):
+    return self.register(Histogram, name, help, label, buckets=buckets)
+
+  def expose(self):
+    """ All metrics in the Prometheus text format
+
+    Returns:
+        (str): text exposition
+    """
+    with self.lock:
+      metrics = list(self.metrics.values())
+    lines = []
+    for metric in metrics:
+      lines += metric.expose()
+    return "\n".join(lines) + "\n"
+
+  def compact(self):
+    """ All metrics as compact json for the mqtt push
+
+    Returns:
+        (str): json {'time': s, 'node': name, 'counter': {...}, 'gauge': {...}, 'histogram': {name: [count, sum, p95]}}
+    """
+    with self.lock:
+      metrics = list(self.metrics.values())
+    out = {'time': round(time.time(), 3), 'node': platform.node()}
+    for metric in metrics:
+      name = metric.name[len(self.prefix) + 1:] if self.prefix else metric.name
+      out.setdefault(metric.kind, {})[name] = metric.compact()
+    return json.dumps(out, separators=(',', ':'))
+
+  def measureOverhead(self, n=10000):
+    """ Cost of one counter increment and one histogram observation, on throw-away metrics
+
+    Args:
+        n (int, optional): number of updates. Defaults to 10000.
+
+    Returns:
+        (tuple): tuple containing:
+
+            counter (float): seconds per increment
+            histogram (float): seconds per observation
+    """
+    counter = Counter("overhead_total", label="stage")
+    histogram = Histogram("overhead_seconds", label="stage")
+    start = time.perf_counter()
+    for i in range(n):
+      counter.inc(1, "stage")
+    counter_time = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for i in range(n):
+      histogram.observe(0.01, "stage")
+    histogram_time = (time.perf_counter() - start) / n
+    return (counter_time, histogram_time)
+
+
+###############################################################################
+# Export Classes
+#
+class MetricsServer:
+  """ Local http endpoint, GET /metrics returns the Prometheus text format
+
+      A plain HTTPServer in a daemon thread, scrapes are rare and answered one after the other.
+  """
+
+  def __init__(self, registry, address="127.0.0.1", port=9108):
+    """ Constructor for the metrics server
+
+    Args:
+        registry (obj): Registry with the metrics
+        address (str, optional): listening address, 0.0.0.0 for all interfaces. Defaults to "127.0.0.1".
+        port (int, optional): listening port. Defaults to 9108.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.registry = registry
+    self.address = address
+    self.port = port
+    self.server = None
+    self.thread = None
+
+  def start(self):
+    """ Start listening
+
+    Returns:
+        (obj): the server itself
+    """
+    registry = self.registry
+    log = self.log
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        body = registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        log.debug("Metrics request: " + format % args)
+
+    self.server = HTTPServer((self.address, self.port), Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+    self.thread.start()
+    self.log.info("Metrics on http://%s:%d/metrics" % (self.address, self.server.server_port))
+    return self
+
+  def close(self):
+    """ Stop listening
+    """
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+
+class MetricsPush:
+  """ Publishes the compact metrics every interval seconds from a daemon thread
+  """
+
+  def __init__(self, registry, publish, interval=10.0):
+    """ Constructor for the metrics push
+
+    Args:
+        registry (obj): Registry with the metrics
+        publish (function): publish(message), e.g. sends to the metrics topic
+        interval (float, optional): seconds between two pushes. Defaults to 10.0.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.registry = registry
+    self.publish = publish
+    self.interval = interval
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def start(self):
+    """ Start the push thread
+
+    Returns:
+        (obj): the push itself
+    """
+    self.thread = threading.Thread(target=self.pushLoop, name="metrics-push", daemon=True)
+    self.thread.start()
+    return self
+
+  def pushLoop(self):
+    """ Push thread
+    """
+    while not self.stopped.wait(self.interval):
+      try:
+        self.publish(self.registry.compact())
+      except Exception:
+        self.log.exception("Unable to push the metrics")
+
+  def close(self):
+    """ Stop the push thread
+    """
+    if self.thread is not None:
+      self.stopped.set()
+      self.thread.join()
+      self.thread = None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - motion
+
+Cheap change detector in front of the neural net, frames of a static scene skip the inference.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import time
+import numpy as np
+import cv2
+import helpers
+
+
+###############################################################################
+# MotionGate Class
+#
+class MotionGate:
+  """ Frame difference against a running background model on a downscaled grayscale frame
+
+      * the frame is reduced to width pixels, converted to grayscale and blurred
+      * pixels differing more than pixel_threshold from the background count as changed
+      * the frame passes if the changed fraction exceeds area_threshold
+      * a frame passes anyway if the last inference is older than force_interval seconds
+      * the background follows slow changes (light) with the learning rate alpha
+  """
+
+  def __init__(self, width=160, pixel_threshold=25, area_threshold=0.01, alpha=0.05, force_interval=60.0):
+    """ Constructor for the motion gate
+
+    Args:
+        width (int, optional): width of the downscaled frame. Defaults to 160.
+        pixel_threshold (int, optional): gray value difference of a changed pixel. Defaults to 25.
+        area_threshold (float, optional): fraction of changed pixels to run the inference. Defaults to 0.01.
+        alpha (float, optional): learning rate of the background model. Defaults to 0.05.
+        force_interval (float, optional): max seconds without inference, -1 to disable. Defaults to 60.0.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.width = width
+    self.pixel_threshold = pixel_threshold
+    self.area_threshold = area_threshold
+    self.alpha = alpha
+    self.force_interval = force_interval
+    self.background = None
+    self.last_inference = None
+    self.changed = 0.0
+    self.frames = 0
+    self.skipped = 0
+    # running mean of the inference duration, saved time per skipped frame
+    self.inference_time = None
+
+  def preprocess(self, image):
+    """ Downscaled blurred grayscale frame
+
+    Args:
+        image (obj): BGR image as numpy array
+
+    Returns:
+        (obj): float32 grayscale image
+    """
+    (h, w) = image.shape[:2]
+    small = cv2.resize(image, (self.width, max(1, h * self.width // w)), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+      small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    return small.astype(np.float32)
+
+  def check(self, image):
+    """ Decide if the frame has to go through the neural net, updates the background model
+
+    Args:
+        image (obj): BGR image as numpy array
+
+    Returns:
+        (bool): True to run the inference, False to keep the previous detection
+    """
+    self.frames += 1
+    gray = self.preprocess(image)
+    now = time.monotonic()
+    if self.background is None or self.background.shape != gray.shape:
+      self.background = gray
+      self.changed = 1.0
+    else:
+      self.changed = np.count_nonzero(cv2.absdiff(gray, self.background) > self.pixel_threshold) / gray.size
+      cv2.accumulateWeighted(gray, self.background, self.alpha)
+
+    forced = self.force_interval >= 0 and (self.last_inference is None or now - self.last_inference >= self.force_interval)
+    if self.changed > self.area_threshold or forced:
+      if forced and self.changed <= self.area_threshold:
+        self.log.debug("Forced inference after %.0f seconds", self.force_interval)
+      self.last_inference = now
+      return True
+    self.skipped += 1
+    return False
+
+  def inferenceDone(self, duration):
+    """ Report the duration of a full inference, used to estimate the saved latency
+
+    Args:
+        duration (float): inference duration in seconds
+    """
+    if self.inference_time is None:
+      self.inference_time = duration
+    else:
+      self.inference_time += 0.1 * (duration - self.inference_time)
+
+  def savedTime(self):
+    """ Estimated latency saved by one skipped frame
+
+    Returns:
+        (float): seconds
+    """
+    return self.inference_time if self.inference_time is not None else 0.0
+
+  def skipRate(self):
+    """ Fraction of the frames which skipped the inference
+
+    Returns:
+        (float): skip rate 0..1
+    """
+    return self.skipped / self.frames if self.frames > 0 else 0.0
@@ -12,10 +12,14 @@ Copyright (C) 2021 FFHS - All Rights Reserved
 # Import
 #
 import math
+import base64
 import paho.mqtt.client as mqtt
 import helpers
+import outbox
 import json
 import os
+import time
+import threading
 
 
 class MqttClient:
@@ -32,6 +36,18 @@ class MqttClient:
     topic_detection (str): Default="v/detection". Topic were detection outputs are published
     lastWill (str): Default="yolo/status". Topic were the last will is published
     location (str): Default="not defined". identification of image location
+    wire_format (str): Default="json". "json" for base64 images in json, "binary" for compact json with raw jpeg bytes (opt-in, see helpers.packDetections)
+    batch_window (float): Default=0. Seconds to coalesce binary detections into one publish, 0 publishes immediately
+    batch_size (int): Default=8. Max number of detections in one batch
+    metrics (obj): Default=None. metrics.Registry for the publish latency and failures
+    topic_status (str): Default="yolo/detection/latest". Retained compact status of the last detection, empty to disable it
+    qos (int): Default=1. Quality of service of the published messages
+    inflight (int): Default=20. Max messages sent and not acknowledged by the broker
+    queue_size (int): Default=1000. Max queued messages in memory
+    queue_bytes (int): Default=16000000. Max queued payload bytes in memory
+    spool_path (str): Default=None. Folder for the queued messages beyond the memory bounds, None to drop the oldest
+    spool_bytes (int): Default=256000000. Max queued payload bytes on disk
+    max_retain_bytes (int): Default=4096. Larger messages are never retained, e.g. images
   Returns:
     None
   """
@@ -47,7 +63,19 @@ class MqttClient:
                topic_detection="yolo/detection",
                topic_state="yolo/state",
                lastWill="yolo/status",
-               location="not defined"
+               location="not defined",
+               wire_format="json",
+               batch_window=0,
+               batch_size=8,
+               metrics=None,
+               topic_status="yolo/detection/latest",
+               qos=1,
+               inflight=20,
+               queue_size=1000,
+               queue_bytes=16000000,
+               spool_path=None,
+               spool_bytes=256000000,
+               max_retain_bytes=4096
                ):
     # default config, no address given as we don't want to spread code everywhere
     self.address = address
@@ -61,9 +89,37 @@ class MqttClient:
     self.password = password
     self.packetsize = packetsize
     self.location = location
+    self.wire_format = wire_format
+    self.batch_window = batch_window
+    self.batch_size = batch_size
+    self.batch = []
+    self.batch_lock = threading.Lock()
+    self.batch_timer = None
     self.client = mqtt.Client()
     self.log = helpers.createLogger(__name__)
     self.running = False
+    self.state_changed = threading.Event()
+    self.state_listeners = []
+    self.topic_status = str(topic_status).replace('"', '')
+    self.qos = qos
+    self.inflight = inflight
+    self.max_retain_bytes = max_retain_bytes
+    # queued messages, sent in order by the sender thread while connected, kept until acknowledged
+    self.outbox = outbox.Outbox(queue_size, queue_bytes, spool_path or None, spool_bytes)
+    self.outbox_lock = threading.Condition()
+    self.sent = {}
+    self.acknowledged = set()
+    self.connected = False
+    self.stopping = False
+    self.sender = None
+    self.publish_seconds = None
+    self.publish_failures = None
+    if metrics is not None:
+      self.publish_seconds = metrics.histogram("mqtt_publish_seconds", "Time from queuing to the acknowledgement per topic", "topic")
+      self.publish_failures = metrics.counter("mqtt_publish_failures_total", "Failed publish calls per topic", "topic")
+      outbox_gauge = metrics.gauge("mqtt_outbox", "Queued messages resp. bytes", "stat")
+      for stat in ['pending', 'inflight', 'memory_bytes', 'disk_bytes', 'dropped']:
+        outbox_gauge.setFunction(lambda stat=stat: self.outbox.stats()[stat], stat)
 
   def createConnection(self):
     """Create connection to MQTT broker.
@@ -76,16 +132,76 @@ class MqttClient:
       None
     """
     self.client.on_connect = self.on_connect
+    self.client.on_disconnect = self.on_disconnect
     self.client.on_message = self.on_message
+    self.client.on_publish = self.on_publish
     self.client.username_pw_set(
         username=self.username, password=self.password)
-    self.client.connect(self.address, self.port, self.keepAlive)
-    self.client.subscribe(self.topic_state)
-    self.client.loop_start()
+    # the will is only sent to the broker with the connect
     self.client.will_set(
     self.lastWill, "The people detection stopped surreptitiously", retain=True)
-
+    self.client.max_inflight_messages_set(self.inflight)
     self.client.message_callback_add(self.topic_state, self.changeState)
+    self.client.connect(self.address, self.port, self.keepAlive)
+    self.client.loop_start()
+    self.startSender()
+
+  def startSender(self):
+    """Start the thread sending the queued messages.
+
+    Args:
+      None
+    Returns:
+      None
+    """
+    self.stopping = False
+    self.sender = threading.Thread(target=self.sendLoop, name="mqtt-outbox", daemon=True)
+    self.sender.start()
+
+  def sendLoop(self):
+    """Send the queued messages in order while connected, at most inflight messages unacknowledged.
+    The messages in flight during a disconnect are resent by paho after the reconnect.
+
+    Args:
+      None
+    Returns:
+      None
+    """
+    while True:
+      with self.outbox_lock:
+        while not self.stopping and not (self.connected and len(self.sent) < self.inflight and len(self.outbox.pending) > 0):
+          self.outbox_lock.wait()
+        if self.stopping:
+          return
+        entry = self.outbox.next()
+      # outside of the lock, paho holds its own locks while calling on_publish
+      msginfo = self.client.publish(entry['topic'], entry['payload'], qos=entry['qos'], retain=entry['retain'])
+      with self.outbox_lock:
+        if msginfo.rc == mqtt.MQTT_ERR_SUCCESS or (msginfo.rc == mqtt.MQTT_ERR_NO_CONN and entry['qos'] > 0):
+          # paho keeps the qos 1 messages of a lost connection and resends them after the reconnect
+          if msginfo.mid in self.acknowledged:
+            self.acknowledged.discard(msginfo.mid)
+            self.delivered(entry)
+          else:
+            self.sent[msginfo.mid] = entry
+        else:
+          self.log.error("Fail to publish to topic: '%s'. Error code: %s" % (entry['topic'], msginfo.rc))
+          if self.publish_failures is not None:
+            self.publish_failures.inc(1, entry['topic'])
+          self.outbox.done(entry)
+
+  def delivered(self, entry):
+    """Remove an acknowledged message from the queue, the outbox lock must be held.
+
+    Args:
+      entry (dict): message sent by sendLoop
+    Returns:
+      None
+    """
+    self.outbox.done(entry)
+    if self.publish_seconds is not None:
+      self.publish_seconds.observe(time.time() - entry['time'], entry['topic'])
+    self.outbox_lock.notify_all()
 
 
   def changeState(self, client, userdata, msg):
@@ -107,6 +223,31 @@ class MqttClient:
         self.running = True
       else:
         self.running = False
+      self.state_changed.set()
+      for listener in self.state_listeners:
+        listener(self.running)
+
+  def addStateListener(self, listener):
+    """Register a function called from the network thread on every state message
+
+    Args:
+      listener (function): listener(running)
+    Returns:
+      None
+    """
+    self.state_listeners.append(listener)
+
+  def waitState(self, timeout=None):
+    """Block until a state message arrives
+
+    Args:
+      timeout (float): max seconds to wait, None to wait forever
+    Returns:
+      bool: current running state
+    """
+    if self.state_changed.wait(timeout):
+      self.state_changed.clear()
+    return self.running
 
 
   def on_connect(self, client, userdata, flags, rc):
@@ -119,6 +260,41 @@ class MqttClient:
       None
     """
     self.log.info("Connected with result code " + str(rc))
+    if rc == 0:
+      # the session starts clean after every reconnect
+      self.client.subscribe(self.topic_state)
+      with self.outbox_lock:
+        self.connected = True
+        self.outbox_lock.notify_all()
+
+  def on_disconnect(self, client, userdata, rc):
+    """Disconnection callback, the queued messages wait for the reconnect of the paho loop.
+
+    Args:
+      None
+    Returns:
+      None
+    """
+    with self.outbox_lock:
+      self.connected = False
+    if rc != 0:
+      self.log.warning("Connection lost with result code %s, %d messages queued" % (rc, len(self.outbox)))
+
+  def on_publish(self, client, userdata, mid):
+    """Acknowledgement callback, the message leaves the queue.
+
+    Args:
+      None
+    Returns:
+      None
+    """
+    with self.outbox_lock:
+      entry = self.sent.pop(mid, None)
+      if entry is not None:
+        self.delivered(entry)
+      else:
+        # acknowledged before publish returned to the sender
+        self.acknowledged.add(mid)
 
   def on_message(self, client, userdata, msg):
     """Message callback.
@@ -129,24 +305,46 @@ class MqttClient:
     Returns:
       None
     """
-    self.log.debug(msg.topic + " " + str(msg.payload))
+    self.log.debug("%s %s", msg.topic, msg.payload)
     self.log.debug("received an input...")
 
-  def publishMessage(self, message, topicOut):
-    """Send a message to the broker using predefined channel.
+  def publishMessage(self, message, topicOut, retain=None, qos=None):
+    """Queue a message for the broker, sent in order by the sender thread and kept until acknowledged.
 
     Args:
-        message (str): Message to publish.
+        message (str|bytes): Message to publish.
+        topicOut (str): Topic to publish on.
+        retain (bool): Default=None. Retain flag, None for the client default. Messages above max_retain_bytes are never retained.
+        qos (int): Default=None. Quality of service, None for the client default.
     Returns:
         None
     """
+    if isinstance(message, str):
+      message = message.encode('utf-8')
+    if retain is None:
+      retain = self.retain
+    if retain and len(message) > self.max_retain_bytes:
+      # a retained image would be sent again to every new subscriber
+      retain = False
+    self.log.debug("Publish message on topic '%s'", topicOut)
+    with self.outbox_lock:
+      self.outbox.put(topicOut, message, self.qos if qos is None else qos, retain)
+      self.outbox_lock.notify_all()
+
+  def publishStatus(self, labels, location):
+    """Publish the compact retained status of the last detection, new subscribers get it at once.
 
-    self.log.debug("Publish message on topic '%s'" % topicOut)
-    msginfo = self.client.publish(topicOut, message, retain=self.retain)
-    if not msginfo.is_published() and int(msginfo.rc) != 0:
-      self.log.error("Fail to publish to topic: '%s'. Error code: %s" % (topicOut, msginfo.rc))
+    Args:
+      labels (list): labels of the detections
+      location (str): location of the camera
+    Returns:
+      None
+    """
+    if self.topic_status:
+      status = {'time': time.time(), 'location': location, 'count': len(labels), 'labels': sorted(set(labels))}
+      self.publishMessage(json.dumps(status), self.topic_status, retain=True)
 
-  def publishDetection(self, labels=[], confidences=[], boxes=None, fpath="", image=None):
+  def publishDetection(self, labels=[], confidences=[], boxes=None, fpath="", image=None, location=None, image_bytes=None):
     """Create the json object for image detection.
 
     Args:
@@ -154,27 +352,108 @@ class MqttClient:
       boxes (list): list of coordinates of detection boxes
       confidences (list): list of confidences of the boxes
       fpath (str): filepath to image
+      image (obj): opencv image, encoded here if no image_bytes are given
+      location (str): location of the camera, defaults to the client location
+      image_bytes (bytes): jpeg encoded image, sent as is instead of the image resp. the file, empty to send no image
     Returns:
       None
     """
+    if location is None:
+      location = self.location
     json_elements = {}
     detections = []
-    if len(labels) > 0 and (os.path.exists(fpath) or image is not None):
+    if len(labels) > 0 and (os.path.exists(fpath) or image is not None or image_bytes is not None):
       for i in range(len(labels)):
         if boxes is None:
           detections.append({'labels':labels[i], 'confidences': confidences[i], 'box': -1})
         else:
           detections.append({'labels':labels[i], 'confidences': confidences[i], 'box': boxes[i]})
-      json_elements['location'] = self.location
+      if self.wire_format == "binary":
+        if image_bytes is None and image is not None:
+          image_bytes = helpers.convertImageToJpeg(image)
+        elif image_bytes is None:
+          image_bytes = helpers.convertFileToBytes(fpath)
+        self.queueDetection({'time': time.time(), 'location': location, 'detections': detections}, image_bytes)
+        self.publishStatus(labels, location)
+        return
+      json_elements['location'] = location
       json_elements['detections'] = detections
-      if image is not None:
+      if image_bytes is not None:
+        json_elements['image'] = base64.b64encode(image_bytes).decode('utf-8')
+      elif image is not None:
         json_elements['image'] = helpers.convertImageToBase64(image)
       else:
         json_elements['image'] = helpers.convertFileToBase64(fpath)
       jsonString = json.dumps(json_elements, indent=4)
-      self.publishMessage(jsonString, self.topic_detection)
+      self.publishMessage(jsonString, self.topic_detection, retain=False)
+      self.publishStatus(labels, location)
     else:
-      self.log.info("Nothing detected")
+      self.log.debug("Nothing detected")
+
+  def queueDetection(self, frame, image_bytes):
+    """Add a detection to the batch, publish when the batch is full or the batch window elapsed.
+
+    Args:
+      frame (dict): detection metadata
+      image_bytes (bytes): jpeg encoded image
+    Returns:
+      None
+    """
+    with self.batch_lock:
+      self.batch.append((frame, image_bytes))
+      flush_now = self.batch_window <= 0 or len(self.batch) >= self.batch_size
+      if not flush_now and self.batch_timer is None:
+        self.batch_timer = threading.Timer(self.batch_window, self.flush)
+        self.batch_timer.daemon = True
+        self.batch_timer.start()
+    if flush_now:
+      self.flush()
+
+  def flush(self):
+    """Publish all batched detections as one binary message.
+
+    Args:
+      None
+    Returns:
+      None
+    """
+    with self.batch_lock:
+      frames = self.batch
+      self.batch = []
+      if self.batch_timer is not None:
+        self.batch_timer.cancel()
+        self.batch_timer = None
+    if len(frames) > 0:
+      self.publishMessage(helpers.packDetections(self.location, frames), self.topic_detection, retain=False)
 
-  def disconnect(self):
+  def drain(self, timeout=None):
+    """Wait until the broker acknowledged all queued messages.
+
+    Args:
+      timeout (float): max seconds to wait, None to wait forever
+    Returns:
+      bool: True if the queue is empty
+    """
+    with self.outbox_lock:
+      return self.outbox_lock.wait_for(lambda: len(self.outbox) == 0, timeout)
+
+  def disconnect(self, timeout=5.0):
+    """Send the queued messages and disconnect, the messages not acknowledged within timeout are spooled.
+
+    Args:
+      timeout (float): max seconds to wait for the acknowledgements
+    Returns:
+      None
+    """
+    self.flush()
+    if self.connected and not self.drain(timeout):
+      self.log.warning("%d messages not acknowledged after %.0f s" % (len(self.outbox), timeout))
+    with self.outbox_lock:
+      self.stopping = True
+      self.outbox_lock.notify_all()
+    if self.sender is not None:
+      self.sender.join()
+      self.sender = None
+    self.outbox.close()
     self.client.disconnect()
+    self.client.loop_stop()
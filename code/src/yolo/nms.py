@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - nms
+
+Non maximum suppression in NumPy shared by YoloSW, YoloHW and YoloRef, so all back ends filter the same way.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import time
+import numpy as np
+
+METHODS = ("greedy", "class", "soft", "soft_linear")
+# boxes above which the iou is computed per kept box instead of the full matrix, the matrix is O(n^2)
+MATRIX_LIMIT = 256
+
+
+###############################################################################
+# Box Functions
+#
+def xywhToCorners(boxes):
+  """ Convert boxes [x, y, width, height] to corners
+
+  Args:
+      boxes (obj): boxes array or list (n, 4) [x, y, width, height]
+
+  Returns:
+      (obj): float array (n, 4) [x1, y1, x2, y2]
+  """
+  boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+  return np.concatenate([boxes[:, 0:2], boxes[:, 0:2] + boxes[:, 2:4]], axis=1)
+
+
+def iouMatrix(a, b):
+  """ Intersection over union of every box of a against every box of b
+
+  Args:
+      a (obj): boxes array (n, 4) [x1, y1, x2, y2]
+      b (obj): boxes array (m, 4) [x1, y1, x2, y2]
+
+  Returns:
+      (obj): iou array (n, m)
+  """
+  # x and y separately and in place, no (n, m, 2) temporaries
+  inter = np.minimum(a[:, np.newaxis, 2], b[np.newaxis, :, 2])
+  inter -= np.maximum(a[:, np.newaxis, 0], b[np.newaxis, :, 0])
+  np.maximum(inter, 0, out=inter)
+  h = np.minimum(a[:, np.newaxis, 3], b[np.newaxis, :, 3])
+  h -= np.maximum(a[:, np.newaxis, 1], b[np.newaxis, :, 1])
+  np.maximum(h, 0, out=h)
+  inter *= h
+  area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+  area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+  union = area_a[:, np.newaxis] + area_b[np.newaxis, :]
+  union -= inter
+  np.maximum(union, 1e-9, out=union)
+  inter /= union
+  return inter
+
+
+def topK(scores, top_k=None):
+  """ Indexes of the best scores, the weaker boxes never enter the iou matrix
+
+  Args:
+      scores (obj): scores array (n,)
+      top_k (int, optional): max number of boxes, None or 0 for all. Defaults to None.
+
+  Returns:
+      (obj): indexes sorted by descending score
+  """
+  order = np.argsort(-scores, kind="stable")
+  return order[:top_k] if top_k else order
+
+
+def overlapsRow(boxes, order, i, rest, class_ids=None):
+  """ Iou of one sorted box against some others, boxes of different classes never overlap if class_ids are given
+
+  Args:
+      boxes (obj): boxes array (n, 4) [x1, y1, x2, y2]
+      order (obj): indexes of the sorted boxes
+      i (int): position of the box in order
+      rest (obj): positions of the other boxes in order
+      class_ids (obj, optional): class id array (n,). Defaults to None.
+
+  Returns:
+      (obj): iou array (len(rest),)
+  """
+  ious = iouMatrix(boxes[order[i:i + 1]], boxes[order[rest]])[0]
+  if class_ids is not None:
+    ious[class_ids[order[rest]] != class_ids[order[i]]] = 0.0
+  return ious
+
+
+def overlaps(boxes, order, class_ids=None):
+  """ Iou matrix of the sorted boxes, boxes of different classes never overlap if class_ids are given
+
+  Args:
+      boxes (obj): boxes array (n, 4) [x1, y1, x2, y2]
+      order (obj): indexes of the boxes to compare
+      class_ids (obj, optional): class id array (n,). Defaults to None.
+
+  Returns:
+      (obj): iou array (len(order), len(order))
+  """
+  ious = iouMatrix(boxes[order], boxes[order])
+  if class_ids is not None:
+    ious[class_ids[order][:, np.newaxis] != class_ids[order][np.newaxis, :]] = 0.0
+  return ious
+
+
+###############################################################################
+# Suppression Functions
+#
+def greedy(boxes, scores, threshold=0.45, class_ids=None, top_k=200):
+  """ Greedy non maximum suppression, class aware if class_ids are given
+
+      Up to MATRIX_LIMIT boxes the iou matrix is computed once and the loop only ORs its rows, beyond
+      only the rows of the kept boxes against the remaining ones are computed.
+
+  Args:
+      boxes (obj): boxes array (n, 4) [x1, y1, x2, y2]
+      scores (obj): scores array (n,)
+      threshold (float, optional): iou above which the weaker box is dropped. Defaults to 0.45.
+      class_ids (obj, optional): class id array (n,), None to suppress across classes like cv2.dnn.NMSBoxes. Defaults to None.
+      top_k (int, optional): boxes with the best scores considered, None or 0 for all. Defaults to 200.
+
+  Returns:
+      (obj): indexes of the kept boxes, sorted by descending score
+  """
+  order = topK(scores, top_k)
+  suppressed = np.zeros(len(order), dtype=bool)
+  keep = []
+  if len(order) > MATRIX_LIMIT:
+    for i in range(len(order)):
+      if not suppressed[i]:
+        keep.append(i)
+        rest = np.flatnonzero(~suppressed[i + 1:]) + i + 1
+        suppressed[rest[overlapsRow(boxes, order, i, rest, class_ids) > threshold]] = True
+    return order[np.array(keep, dtype=int)]
+  suppress = overlaps(boxes, order, class_ids) > threshold
+  for i in range(len(order)):
+    if not suppressed[i]:
+      keep.append(i)
+      suppressed |= suppress[i]
+  return order[np.array(keep, dtype=int)]
+
+
+def soft(boxes, scores, threshold=0.45, class_ids=None, top_k=200, sigma=0.5, score_threshold=0.3, linear=False):
+  """ Soft non maximum suppression (Bodla et al.), overlapping boxes lose score instead of being dropped
+
+      * gaussian: score *= exp(-iou^2 / sigma)
+      * linear: score *= 1 - iou for iou above threshold
+      * boxes are kept while their decayed score is above score_threshold
+
+  Args:
+      boxes (obj): boxes array (n, 4) [x1, y1, x2, y2]
+      scores (obj): scores array (n,)
+      threshold (float, optional): iou above which the linear decay applies. Defaults to 0.45.
+      class_ids (obj, optional): class id array (n,), only boxes of the same class decay. Defaults to None.
+      top_k (int, optional): boxes with the best scores considered, None or 0 for all. Defaults to 200.
+      sigma (float, optional): width of the gaussian decay. Defaults to 0.5.
+      score_threshold (float, optional): min decayed score of a kept box. Defaults to 0.3.
+      linear (bool, optional): linear instead of gaussian decay. Defaults to False.
+
+  Returns:
+      (tuple): tuple containing:
+
+          keep (obj): indexes of the kept boxes, sorted by descending decayed score
+          scores (obj): decayed scores of the kept boxes
+  """
+  order = topK(scores, top_k)
+  # the full matrix up to MATRIX_LIMIT boxes, beyond one row per kept box
+  ious = overlaps(boxes, order, class_ids) if len(order) <= MATRIX_LIMIT else None
+  decayed = scores[order].astype(np.float64)
+  active = np.ones(len(order), dtype=bool)
+  keep = []
+  while True:
+    i = int(np.argmax(np.where(active, decayed, -1.0)))
+    if not active[i] or decayed[i] < score_threshold:
+      break
+    keep.append(i)
+    active[i] = False
+    rest = np.flatnonzero(active)
+    row = ious[i, rest] if ious is not None else overlapsRow(boxes, order, i, rest, class_ids)
+    if linear:
+      decayed[rest] *= np.where(row > threshold, 1.0 - row, 1.0)
+    else:
+      decayed[rest] *= np.exp(-(row * row) / sigma)
+  keep = np.array(keep, dtype=int)
+  return (order[keep], decayed[keep])
+
+
+def createSuppressor(section):
+  """ Suppression configured by the [NMS] section of the ini file
+
+  Args:
+      section (obj): configparser section with method, threshold, top_k, sigma and score_threshold
+
+  Returns:
+      (obj): NonMaxSuppression object
+  """
+  return NonMaxSuppression(method=section['method'].strip().lower(),
+                           threshold=float(section['threshold']),
+                           top_k=int(section['top_k']),
+                           sigma=float(section['sigma']),
+                           score_threshold=float(section['score_threshold']))
+
+
+###############################################################################
+# NonMaxSuppression Class
+#
+class NonMaxSuppression:
+  """ Configured suppression of the back ends, measures its own cost
+
+      * greedy: one box of overlapping boxes is kept across all classes, like cv2.dnn.NMSBoxes
+      * class: greedy per class, like the darknet region layer
+      * soft: class aware soft-NMS with gaussian decay
+      * soft_linear: class aware soft-NMS with linear decay above the threshold
+  """
+
+  def __init__(self, method="class", threshold=0.45, top_k=200, sigma=0.5, score_threshold=0.3):
+    """ Constructor for the suppression
+
+    Args:
+        method (str, optional): greedy, class, soft or soft_linear. Defaults to "class".
+        threshold (float, optional): iou above which the weaker box is dropped. Defaults to 0.45.
+        top_k (int, optional): boxes with the best scores considered, 0 for all. Defaults to 200.
+        sigma (float, optional): width of the gaussian decay of soft-NMS. Defaults to 0.5.
+        score_threshold (float, optional): min decayed score of soft-NMS. Defaults to 0.3.
+    """
+    if method not in METHODS:
+      raise ValueError("Unknown NMS method '%s', one of %s" % (method, ", ".join(METHODS)))
+    self.method = method
+    self.threshold = threshold
+    self.top_k = top_k
+    self.sigma = sigma
+    self.score_threshold = score_threshold
+    self.calls = 0
+    self.boxes_in = 0
+    self.boxes_out = 0
+    self.seconds = 0.0
+
+  def __call__(self, boxes, scores, class_ids, threshold=None):
+    """ Suppress the overlapping boxes
+
+    Args:
+        boxes (obj): boxes array (n, 4) [x1, y1, x2, y2]
+        scores (obj): scores array (n,)
+        class_ids (obj): class id array (n,)
+        threshold (float, optional): iou threshold, None for the configured one. Defaults to None.
+
+    Returns:
+        (tuple): tuple containing:
+
+            keep (obj): indexes of the kept boxes, sorted by descending score
+            scores (obj): scores of the kept boxes, decayed by soft-NMS
+    """
+    start = time.perf_counter()
+    scores = np.asarray(scores, dtype=np.float32)
+    if threshold is None:
+      threshold = self.threshold
+    if len(scores) == 0:
+      (keep, kept_scores) = (np.zeros(0, dtype=int), scores)
+    elif self.method in ("soft", "soft_linear"):
+      (keep, kept_scores) = soft(boxes, scores, threshold, np.asarray(class_ids), self.top_k, self.sigma, self.score_threshold, self.method == "soft_linear")
+    else:
+      keep = greedy(boxes, scores, threshold, np.asarray(class_ids) if self.method == "class" else None, self.top_k)
+      kept_scores = scores[keep]
+    self.calls += 1
+    self.boxes_in += len(scores)
+    self.boxes_out += len(keep)
+    self.seconds += time.perf_counter() - start
+    return (keep, kept_scores)
+
+  def stats(self):
+    """ Cost of the suppression so far
+
+    Returns:
+        (dict): calls, boxes_in, boxes_out and mean seconds per call
+    """
+    return {'calls': self.calls, 'boxes_in': self.boxes_in, 'boxes_out': self.boxes_out,
+            'mean': self.seconds / self.calls if self.calls > 0 else 0.0}
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - outbox
+
+Bounded queue of the outgoing mqtt messages, kept until the broker acknowledged them. Beyond the memory
+bound the messages are spilled to disk, so a broker or uplink outage doesn't lose the detections.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import os
+import json
+import time
+import collections
+import helpers
+
+
+###############################################################################
+# Outbox Class
+#
+class Outbox:
+  """ Messages in publish order, from put() over next() (in flight) to done() (acknowledged)
+
+      * the payloads stay in memory up to max_messages resp. max_bytes, the following ones are written to
+        the spool folder, one file per message named by its sequence number
+      * a pending retained message is replaced by a newer one of the same topic, only the latest counts
+      * beyond spool_bytes the oldest spilled messages are dropped, without spool folder the oldest pending ones
+      * close() spills the messages not acknowledged yet, they are replayed after the next start
+
+      Not thread safe, the mqtt client guards it with its lock.
+  """
+
+  def __init__(self, max_messages=1000, max_bytes=16000000, spool_path=None, spool_bytes=256000000):
+    """ Constructor for the outbox
+
+    Args:
+        max_messages (int, optional): max messages with the payload in memory. Defaults to 1000.
+        max_bytes (int, optional): max payload bytes in memory. Defaults to 16000000.
+        spool_path (str, optional): folder for the spilled messages, None to keep memory only. Defaults to None.
+        spool_bytes (int, optional): max payload bytes on disk. Defaults to 256000000.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.max_messages = max_messages
+    self.max_bytes = max_bytes
+    self.spool_path = spool_path
+    self.spool_bytes = spool_bytes
+    # entries {'seq', 'topic', 'payload', 'qos', 'retain', 'size', 'file', 'time'}, payload None if spilled
+    self.pending = collections.deque()
+    self.inflight = {}
+    self.retained = {}
+    self.seq = 0
+    self.memory_messages = 0
+    self.memory_bytes = 0
+    self.disk_messages = 0
+    self.disk_bytes = 0
+    self.spilled = 0
+    self.dropped = 0
+    if spool_path is not None:
+      os.makedirs(spool_path, exist_ok=True)
+      self.load()
+
+  def __len__(self):
+    return len(self.pending) + len(self.inflight)
+
+  def load(self):
+    """ Queue the messages spilled by the last run, in their order
+    """
+    for name in sorted(os.listdir(self.spool_path)):
+      if not name.endswith(".msg"):
+        continue
+      file = os.path.join(self.spool_path, name)
+      try:
+        with open(file, 'rb') as f:
+          line = f.readline()
+        header = json.loads(line.decode('utf-8'))
+      except (OSError, ValueError):
+        self.log.warning("Dropping unreadable spooled message %s" % file)
+        os.remove(file)
+        continue
+      size = os.path.getsize(file) - len(line)
+      self.seq = max(self.seq, int(name[:-4]) + 1)
+      self.disk_messages += 1
+      self.pending.append({'seq': int(name[:-4]), 'topic': header['topic'], 'payload': None, 'qos': header['qos'], 'retain': header['retain'],
+                           'size': size, 'file': file, 'time': time.time()})
+      self.disk_bytes += size
+    if len(self.pending) > 0:
+      self.log.info("Replaying %d spooled messages (%.1f MB)" % (len(self.pending), self.disk_bytes / 1e6))
+
+  def put(self, topic, payload, qos=1, retain=False):
+    """ Queue a message
+
+    Args:
+        topic (str): topic to publish on
+        payload (bytes|str): message
+        qos (int, optional): mqtt quality of service. Defaults to 1.
+        retain (bool, optional): retain flag. Defaults to False.
+
+    Returns:
+        (bool): False if the message replaced a pending retained message of the same topic
+    """
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    size = len(payload)
+    if retain:
+      entry = self.retained.get(topic)
+      if entry is not None and entry['payload'] is not None:
+        self.memory_bytes += size - entry['size']
+        (entry['payload'], entry['size'], entry['qos'], entry['time']) = (payload, size, qos, time.time())
+        return False
+    entry = {'seq': self.seq, 'topic': topic, 'payload': payload, 'qos': qos, 'retain': retain, 'size': size, 'file': None, 'time': time.time()}
+    self.seq += 1
+    full = self.memory_messages >= self.max_messages or self.memory_bytes + size > self.max_bytes
+    if self.spool_path is not None and (full or self.disk_messages > 0):
+      # once spilling, all newer messages go to disk until the spool is drained, the order is kept
+      while self.disk_bytes + size > self.spool_bytes and self.dropOldest(spilled=True):
+        pass
+      self.spill(entry)
+    else:
+      while (self.memory_messages >= self.max_messages or self.memory_bytes + size > self.max_bytes) and self.dropOldest():
+        pass
+      self.memory_messages += 1
+      self.memory_bytes += size
+    self.pending.append(entry)
+    if retain:
+      self.retained[topic] = entry
+    return True
+
+  def spill(self, entry):
+    """ Write a message not counted in memory to the spool folder and release its payload
+
+    Args:
+        entry (dict): queued message
+    """
+    file = os.path.join(self.spool_path, "%012d.msg" % entry['seq'])
+    header = json.dumps({'topic': entry['topic'], 'qos': entry['qos'], 'retain': entry['retain']})
+    with open(file, 'wb') as f:
+      f.write(header.encode('utf-8') + b"\n")
+      f.write(entry['payload'])
+    entry['payload'] = None
+    entry['file'] = file
+    self.disk_messages += 1
+    self.disk_bytes += entry['size']
+    self.spilled += 1
+
+  def dropOldest(self, spilled=False):
+    """ Drop the oldest pending message
+
+    Args:
+        spilled (bool, optional): drop the oldest message in the spool folder, frees disk space. Defaults to False.
+
+    Returns:
+        (bool): False if nothing is pending resp. spilled
+    """
+    if spilled:
+      entry = next((entry for entry in self.pending if entry['file'] is not None), None)
+      if entry is None:
+        return False
+      self.pending.remove(entry)
+    elif len(self.pending) > 0:
+      entry = self.pending.popleft()
+    else:
+      return False
+    self.release(entry)
+    self.dropped += 1
+    if self.dropped == 1 or self.dropped % 100 == 0:
+      self.log.warning("Outbox full, %d messages dropped" % self.dropped)
+    return True
+
+  def release(self, entry):
+    """ Forget a message, remove its spool file
+
+    Args:
+        entry (dict): dropped or acknowledged message
+    """
+    if self.retained.get(entry['topic']) is entry:
+      del self.retained[entry['topic']]
+    if entry['payload'] is not None:
+      self.memory_messages -= 1
+      self.memory_bytes -= entry['size']
+    else:
+      self.disk_messages -= 1
+    if entry['file'] is not None:
+      try:
+        os.remove(entry['file'])
+      except OSError:
+        pass
+      self.disk_bytes -= entry['size']
+
+  def next(self):
+    """ Oldest pending message, moved to the messages in flight
+
+    Returns:
+        (dict): message {'seq', 'topic', 'payload', 'qos', 'retain', 'time'}, None if nothing is pending
+    """
+    if len(self.pending) == 0:
+      return None
+    entry = self.pending.popleft()
+    if self.retained.get(entry['topic']) is entry:
+      # in flight, a newer retained message is queued separately
+      del self.retained[entry['topic']]
+    if entry['payload'] is None:
+      # the spool file is kept until the acknowledgement
+      with open(entry['file'], 'rb') as f:
+        f.readline()
+        entry['payload'] = f.read()
+      self.disk_messages -= 1
+      self.memory_messages += 1
+      self.memory_bytes += entry['size']
+    self.inflight[entry['seq']] = entry
+    return entry
+
+  def done(self, entry):
+    """ Forget a message acknowledged by the broker
+
+    Args:
+        entry (dict): message returned by next()
+    """
+    if self.inflight.pop(entry['seq'], None) is not None:
+      self.release(entry)
+
+  def close(self):
+    """ Spill the messages in flight and pending to the spool folder, they are replayed after the next start
+    """
+    if self.spool_path is None:
+      if len(self) > 0:
+        self.log.warning("%d messages not delivered" % len(self))
+      return
+    entries = list(self.inflight.values()) + list(self.pending)
+    for entry in entries:
+      if entry['file'] is None:
+        self.spill(entry)
+    if len(entries) > 0:
+      self.log.info("%d messages spooled for the next start" % len(entries))
+    self.pending = collections.deque()
+    self.inflight = {}
+    self.retained = {}
+    self.memory_messages = 0
+    self.memory_bytes = 0
+    self.disk_messages = 0
+
+  def stats(self):
+    """ Size of the outbox
+
+    Returns:
+        (dict): pending, inflight, memory_bytes, disk_bytes, spilled and dropped messages
+    """
+    return {'pending': len(self.pending), 'inflight': len(self.inflight), 'memory_bytes': self.memory_bytes,
+            'disk_bytes': self.disk_bytes, 'spilled': self.spilled, 'dropped': self.dropped}
@@ -14,28 +14,410 @@ Copyright (C) 2021 FFHS - All Rights Reserved
 from config import *
 import helpers
 import mqtt_client
+import camera
+import motion
+import async_loop
+import store
+import roi
+import nms
+import adaptive
+import metrics
+import render
 import timer
 import time
+import atexit
+import functools
 import os
 import sys
 import platform
 from datetime import datetime
-if use_yolo_hw:
+if use_yolo_ref:
+  import yolo_ref
+  import pipeline
+elif use_yolo_hw:
   import yolo_hw
+  import pipeline
 else:
   import yolo_sw
 
 # Create log modules
-handler = helpers.createHandler(dev_mode, config['PATH']['log_path'])
+handler = helpers.createHandler(dev_mode, config['PATH']['log_path'], config['APP']['log_level'])
 log = helpers.createLogger(__name__)
 
 log.debug("Base dir: %s" % BASE_PATH)
 
 
+###############################################################################
+# Detection Steps
+#
+def outputPath(fpath, suffix, ext=None):
+  """ Path of the detection image of an input image
+
+  Args:
+      fpath (str): path of the input image
+      suffix (str): suffix added to the file name
+      ext (str, optional): file extension. Defaults to the configured extension.
+
+  Returns:
+      str: path in the detection image folder
+  """
+  if ext is None:
+    ext = config['PATH']['extension']
+  return config['PATH']['detection_image_path'] + os.sep + os.path.basename(os.path.splitext(fpath)[0]) + suffix + ext
+
+
+def renderFrame(nn, image, frame, suffix, boxes, confidences, class_ids):
+  """ Draw and encode a detection image in the background, the inference goes on meanwhile
+
+  Args:
+      nn (obj): neural net with the labels and colors of the classes
+      image (obj): opencv image the detections belong to, owned by the renderer from now on
+      frame (dict): captured frame, names the detection image
+      suffix (str): suffix of the detection image file name
+      boxes (list): box coordinates [x, y, width, height]
+      confidences (list): confidences for each box
+      class_ids (list): id of classes found
+
+  Returns:
+      (obj): future of the JPEG bytes, written to the detection image folder if save_images
+  """
+  # copies of the detections, the neural net overwrites its own with the next frame
+  draw = functools.partial(nn.draw_detection, boxes=list(boxes), confidences=list(confidences), class_ids=list(class_ids))
+  future = renderer.submit(image, draw, outputPath(frame['fpath'], suffix, '.jpg') if save_images else None)
+  if show_images:
+    future.result()
+    helpers.displayImageCv2(image)
+  return future
+
+
+def captureFrame():
+  """ Capture the next frame from the webcam or the static image folder
+
+  Returns:
+      (dict): frame {'fpath', 'image', 'time', 'camera', 'location'}, 'skipped' is set if the motion gate keeps
+      the previous detection or no camera delivered a frame, None at the end of the static images
+  """
+  global current_file
+  if static_images:
+    if current_file >= len(input_files):
+      return None
+    log.debug("Image %d of %d analysed", current_file, len(input_files))
+    current_file += 1
+    return {'fpath': input_files[current_file - 1], 'image': None, 'time': time.time(), 'camera': None, 'location': locations[0]}
+
+  # Get the frame of the next camera, kept in memory, the file is only written as archive
+  (index, location, image, timestamp) = webcam.read()
+  name = "webcam" if len(cameras) == 1 else "webcam-" + location
+  fpath = os.path.abspath(os.path.join(config['PATH']['raw_image_path'], datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + name + config['PATH']['extension']))
+  if image is None:
+    skipped_counter.inc(1, "camera")
+    return {'fpath': fpath, 'image': None, 'time': time.time(), 'camera': None, 'location': None, 'skipped': True}
+  frame = {'fpath': fpath, 'image': image, 'time': timestamp, 'camera': index, 'location': location}
+
+  if motion_gates is not None:
+    start = time.perf_counter()
+    changed = motion_gates[index].check(image)
+    timer.add(time.perf_counter() - start, "Motion Gate")
+    if not changed:
+      # Keep the previous detection, the scene did not change
+      timer.add(motion_gates[index].savedTime(), "Motion Gate Saved")
+      log.debug("Scene %s unchanged (%.2f%% changed), inference skipped, skip rate %.1f%%", location, 100 * motion_gates[index].changed, 100 * motion_gates[index].skipRate())
+      skipped_counter.inc(1, "motion")
+      frame['skipped'] = True
+      return frame
+
+  if save_images:
+    frame['fpath'] = helpers.saveWebcamImage(path=config['PATH']['raw_image_path'], name=name, ext=config['PATH']['extension'], yolo_hw=use_yolo_hw, image=image)
+    if dev_mode and not use_yolo_hw:
+      helpers.displayFileCv2(frame['fpath'], False)
+  elif show_images:
+    helpers.displayImageCv2(image, waitKey=False)
+  return frame
+
+
+def roiInput(frame):
+  """ Network input of a frame, cropped to the zone of its location
+
+  Args:
+      frame (dict): captured frame, frame['image'] is loaded from frame['fpath'] for a zone
+
+  Returns:
+      (tuple): tuple containing:
+
+          crop (obj): image for the neural net, frame['image'] for a location without zone
+          offset (tuple): (x, y) of the crop in the frame image
+          keep (function): filter of the detections inside the zone, None for a location without zone
+  """
+  zone = rois.get(frame['location'])
+  if zone is None:
+    return (frame['image'], (0, 0), None)
+  if frame['image'] is None:
+    frame['image'] = helpers.getImage(frame['fpath'])
+  (crop, offset) = zone.crop(frame['image'])
+  (h, w) = frame['image'].shape[:2]
+  return (crop, offset, functools.partial(zone.inside, image_size=(w, h)))
+
+
+def captureBatch():
+  """ Capture the frames of the next forward pass, up to sw_batch_size frames or until sw_batch_timeout
+
+  Returns:
+      (list): captured frames without the skipped ones, may be empty, None at the end of the static images
+  """
+  frames = []
+  end = time.monotonic() + sw_batch_timeout
+  while len(frames) < sw_batch_size:
+    frame = captureFrame()
+    if frame is None:
+      # the frames collected so far are still processed, the next call ends the input
+      return frames if frames else None
+    if not frame.get('skipped'):
+      frames.append(frame)
+    if time.monotonic() >= end:
+      break
+  return frames
+
+
+def pipelineResult(frame):
+  """ Results of a frame which went through all pipeline stages
+
+  Args:
+      frame (dict): processed pipeline frame
+
+  Returns:
+      (list): results to publish, empty if nothing was detected
+  """
+  yolo_pipeline.report(timer, frame)
+  if len(frame.get('classes', [])) == 0:
+    return []
+  result = {'labels': frame['classes'], 'confidences': frame['confidences'], 'time': frame['time'], 'times': frame['times'], 'camera': frame['camera'], 'location': frame['location']}
+  if region_numpy:
+    image_in = frame['image'].copy() if frame.get('image') is not None else helpers.getImage(frame['fpath'])
+    result['jpeg'] = renderFrame(yolo_hw_nn, image_in, frame, '_hw_detection', frame['boxes'], frame['confidences'], frame['class_ids'])
+    result['boxes'] = frame['boxes']
+  else:
+    result['fpath'] = frame['fpath_out']
+    result['boxes'] = None
+  return [result]
+
+
+def detectFrame(frame):
+  """ Run the neural net on a captured frame
+
+  Args:
+      frame (dict): frame returned by captureFrame
+
+  Returns:
+      (list): results to publish, dicts with the publishDetection arguments. The pipeline returns the frames finished meanwhile.
+  """
+  start = time.perf_counter()
+  results = []
+  if use_yolo_hw and use_pipeline:
+    (frame['crop'], frame['offset'], frame['keep']) = roiInput(frame)
+    # Feed the frame, blocks if the first stage is still busy
+    yolo_pipeline.put(frame)
+    # Publish all frames which went through all stages
+    done = yolo_pipeline.get(block=False)
+    while done is not None:
+      results += pipelineResult(done)
+      done = yolo_pipeline.get(block=False)
+    return results
+
+  elif use_yolo_hw:
+    timer.trigger("load image begin")
+    (crop, offset, keep) = roiInput(frame)
+    if crop is not None:
+      yolo_hw_nn.getImage(crop)
+    else:
+      yolo_hw_nn.getFile(frame['fpath'])
+    timer.end("load image end", "Image Loading")
+
+    timer.trigger("yolo sw conv layer 0 begin")
+    yolo_hw_nn.execute_yolo_sw_firstlayer()
+    timer.end("yolo sw conv layer 0 end", "Apply YOLO SW Conv Layer 0")
+
+    timer.trigger("yolo hw conv layers 1-7 begin")
+    yolo_hw_nn.execute_yolo_hw()
+    timer.end("yolo hw conv layers 1-7 end", "Apply YOLO HW Conv Layer 1-7")
+
+    timer.trigger("yolo sw conv layer 8 begin")
+    yolo_hw_nn.execute_yolo_sw_lastlayer()
+    timer.end("yolo sw conv layer 8 end", "Apply YOLO SW Conv Layer 8")
+
+    if region_numpy:
+      timer.trigger("region detection begin")
+      yolo_hw_nn.region_detection(offset=offset, keep=keep)
+      timer.end("region detection end", "Decode Detections")
+
+      # The boxes are only drawn if something was detected
+      if len(yolo_hw_nn.classes) > 0:
+        image_in = frame['image'].copy() if frame['image'] is not None else helpers.getImage(frame['fpath'])
+        jpeg = renderFrame(yolo_hw_nn, image_in, frame, '_hw_detection', yolo_hw_nn.boxes, yolo_hw_nn.confidences, yolo_hw_nn.class_ids)
+        results.append({'labels': list(yolo_hw_nn.classes), 'confidences': list(yolo_hw_nn.confidences), 'boxes': list(yolo_hw_nn.boxes), 'jpeg': jpeg})
+    else:
+      timer.trigger("darknet detection begin")
+      (fpath_out, fpath_probs) = yolo_hw_nn.darknet_detection(frame['fpath'], config['PATH']['detection_image_path'])
+      timer.end("darknet detection begin", "Draw Detection Boxes")
+
+      if len(yolo_hw_nn.classes) > 0:
+        results.append({'labels': list(yolo_hw_nn.classes), 'confidences': list(yolo_hw_nn.confidences), 'boxes': None, 'fpath': fpath_out})
+
+  else:
+    timer.trigger("load image begin")
+    (crop, offset, keep) = roiInput(frame)
+    if crop is not None:
+      yolo_sw_nn.loadImg(crop)
+      # the boxes are drawn into a copy, the camera frame stays untouched
+      image = frame['image'].copy()
+    else:
+      (image, layer_outputs) = yolo_sw_nn.loadFile(frame['fpath'])
+      crop = image
+    timer.end("load image end", "Image Loading")
+
+    timer.trigger("yolo sw conv layers begin")
+    yolo_sw_nn.execute_yolo_sw(crop, offset=offset, keep=keep)
+    timer.end("yolo sw conv layers end", "Apply YOLO SW Conv Layers")
+
+    if keep is not None and len(yolo_sw_nn.class_ids) == 0:
+      # Nothing in the zone, no drawing and nothing to publish
+      log.debug("Nothing detected in the zone of %s", frame['location'])
+    elif len(yolo_sw_nn.class_ids) > 0 or save_images or show_images:
+      jpeg = renderFrame(yolo_sw_nn, image, frame, '_sw_detection', yolo_sw_nn.boxes, yolo_sw_nn.confidences, yolo_sw_nn.class_ids)
+      if len(yolo_sw_nn.class_ids) > 0:
+        detection_labels = [yolo_sw_nn.labels[class_id] for class_id in yolo_sw_nn.class_ids]
+        results.append({'labels': detection_labels, 'confidences': yolo_sw_nn.confidences, 'boxes': yolo_sw_nn.boxes, 'jpeg': jpeg})
+
+  duration = time.perf_counter() - start
+  for result in results:
+    result['time'] = frame['time']
+    result['times'] = {'Detection': duration}
+    result['camera'] = frame['camera']
+    result['location'] = frame['location']
+  timer.add(duration, "Detection per Frame")
+  if motion_gates is not None:
+    motion_gates[frame['camera']].inferenceDone(duration)
+  timer.nextIndex()
+  return results
+
+
+def detectBatch(frames):
+  """ Run the neural net on a batch of captured frames, one YoloSW forward pass for all frames
+
+  Args:
+      frames (list): frames returned by captureBatch
+
+  Returns:
+      (list): results to publish, dicts with the publishDetection arguments
+  """
+  if sw_batch_size == 1:
+    results = []
+    for frame in frames:
+      results += detectFrame(frame)
+    return results
+
+  start = time.perf_counter()
+  timer.trigger("load image begin")
+  inputs = [roiInput(frame) for frame in frames]
+  # the boxes are drawn into the images, the camera frames stay untouched
+  images = [frame['image'].copy() if frame['image'] is not None else helpers.getImage(frame['fpath']) for frame in frames]
+  crops = [crop if crop is not None else image for ((crop, offset, keep), image) in zip(inputs, images)]
+  timer.end("load image end", "Image Loading")
+
+  timer.trigger("yolo sw conv layers begin")
+  detections = yolo_sw_nn.detect_batch(crops, offsets=[offset for (crop, offset, keep) in inputs], keeps=[keep for (crop, offset, keep) in inputs])
+  timer.end("yolo sw conv layers end", "Apply YOLO SW Conv Layers")
+
+  results = []
+  for (frame, image, (crop, offset, keep), (boxes, confidences, class_ids)) in zip(frames, images, inputs, detections):
+    if keep is not None and len(class_ids) == 0:
+      # Nothing in the zone, no drawing and nothing to publish
+      log.debug("Nothing detected in the zone of %s", frame['location'])
+      continue
+    if len(class_ids) == 0 and not (save_images or show_images):
+      continue
+    jpeg = renderFrame(yolo_sw_nn, image, frame, '_sw_detection', boxes, confidences, class_ids)
+    if len(class_ids) > 0:
+      results.append({'labels': [yolo_sw_nn.labels[class_id] for class_id in class_ids], 'confidences': confidences, 'boxes': boxes,
+                      'time': frame['time'], 'camera': frame['camera'], 'location': frame['location'], 'jpeg': jpeg})
+
+  # every frame of the batch waited for the whole batch
+  duration = time.perf_counter() - start
+  timer.add(duration / len(frames), "Detection per Frame")
+  log.debug("Batch of %d frames in %.3f s, %.2f frames/sec", len(frames), duration, len(frames) / duration)
+  for result in results:
+    result['times'] = {'Detection': duration}
+  if motion_gates is not None:
+    for frame in frames:
+      motion_gates[frame['camera']].inferenceDone(duration / len(frames))
+  timer.nextIndex()
+  return results
+
+
+def detectStep(frames):
+  """ Detection step of the main loop, the detections drive the adaptive capture interval
+
+  Args:
+      frames (list): frames returned by captureBatch
+
+  Returns:
+      (list): results to publish
+  """
+  results = detectBatch(frames)
+  for frame in frames:
+    frames_counter.inc(1, frame['location'])
+  for result in results:
+    for label in result['labels']:
+      detections_counter.inc(1, label)
+  if adaptive_interval is not None:
+    adaptive_interval.update(any(label in adaptive_labels for result in results for label in result['labels']))
+  return results
+
+
+def publishResult(result):
+  """ Publish a detection result
+
+  Args:
+      result (dict): result returned by detectFrame
+  """
+  global stats_time
+  image_bytes = None
+  if 'jpeg' in result:
+    try:
+      image_bytes = result['jpeg'].result()
+    except Exception:
+      # the detections are published anyway, without image
+      log.exception("Rendering the detection image of %s failed" % result['location'])
+      image_bytes = b""
+  mqttClient.publishDetection(labels=result['labels'], confidences=result['confidences'], boxes=result['boxes'], fpath=result.get('fpath', ""),
+                               image_bytes=image_bytes, location=result['location'])
+  if detection_store is not None:
+    detection_store.add(result['location'], result['labels'], result['confidences'], result['boxes'], result.get('times'), result.get('time'))
+  if result['camera'] is not None:
+    latency = time.time() - result['time']
+    webcam.addLatency(result['camera'], latency)
+    timer.add(latency, "Latency " + result['location'])
+    if time.monotonic() - stats_time > 60:
+      stats_time = time.monotonic()
+      webcam.report()
+
+
 if __name__ == "__main__":
 
   log.info("[blue]---------------- People Detection started ----------------[/]")
 
+  # Metrics of the hot path, always collected in memory, exposed over http and mqtt if enabled
+  registry = metrics.Registry()
+  frames_counter = registry.counter("frames_total", "Frames processed by the neural net per location", "location")
+  skipped_counter = registry.counter("frames_skipped_total", "Captures without inference per reason", "reason")
+  detections_counter = registry.counter("detections_total", "Detections per class", "label")
+  queue_depth = registry.gauge("queue_depth", "Items waiting in a queue", "queue")
+  registry.gauge("rss_bytes", "Resident set size of the process").setFunction(metrics.rssBytes)
+  (counter_time, histogram_time) = registry.measureOverhead()
+  overhead = registry.gauge("metrics_overhead_seconds", "Cost of one metric update", "metric")
+  overhead.set(counter_time, "counter")
+  overhead.set(histogram_time, "histogram")
+  log.info("Metrics overhead: %.2f us per counter increment, %.2f us per histogram observation" % (counter_time * 1e6, histogram_time * 1e6))
+
   # Create MQTT Client
   mqttClient = mqtt_client.MqttClient(address=config['MQTT']['address'],
                                       port=int(config['MQTT']['port']),
@@ -44,7 +426,19 @@ if __name__ == "__main__":
                                       keepAlive=int(config['MQTT']['keepalive']),
                                       topic_detection=config['MQTT']['topic_detection'],
                                       lastWill=config['MQTT']['topic_lastwill'],
-                                      location=config['APP']['location'])
+                                      location=locations[0],
+                                      wire_format=config['MQTT']['wire_format'],
+                                      batch_window=float(config['MQTT']['batch_window']),
+                                      batch_size=int(config['MQTT']['batch_size']),
+                                      metrics=registry,
+                                      topic_status=config['MQTT']['topic_status'],
+                                      qos=int(config['MQTT']['qos']),
+                                      inflight=int(config['MQTT']['inflight']),
+                                      queue_size=int(config['MQTT']['queue_size']),
+                                      queue_bytes=int(config['MQTT']['queue_bytes']),
+                                      spool_path=config['MQTT']['spool_path'],
+                                      spool_bytes=int(config['MQTT']['spool_bytes']),
+                                      max_retain_bytes=int(config['MQTT']['max_retain_bytes']))
 
   # Create timer module
   if use_yolo_hw:
@@ -52,7 +446,13 @@ if __name__ == "__main__":
   else:
     title = "sw-yolo_test"
   log.debug(config['PATH']['timelog_path']+os.sep+title+".csv")
-  timer = timer.Timer(title=title, verbose=False, report=True, filewrite=dev_mode, file=config['PATH']['timelog_path']+os.sep+title+".csv")
+  timer = timer.Timer(title=title, verbose=False, report=True, filewrite=dev_mode, file=config['PATH']['timelog_path']+os.sep+title+".csv",
+                      histogram=registry.histogram("stage_seconds", "Stage durations recorded by the timer", "stage"))
+  queue_depth.setFunction(lambda: timer.head - timer.flushed, "timer")
+
+  # Detection images are drawn and encoded once in the background, the bytes are saved and published
+  renderer = render.Renderer(quality=int(config['RENDER']['quality']), max_width=int(config['RENDER']['max_width']),
+                             workers=int(config['RENDER']['workers']), maxsize=int(config['RENDER']['queue_size']), timer=timer)
 
   # Connect MQTT
   try:
@@ -61,17 +461,44 @@ if __name__ == "__main__":
     log.exception("Unable to connect to MQTT broker!")
     raise SystemExit
 
-  # Setup Yolo
+  # Scrape endpoint and periodic push of the metrics
+  metrics_server = None
+  metrics_push = None
+  if use_metrics:
+    if int(config['METRICS']['port']) > 0:
+      metrics_server = metrics.MetricsServer(registry, config['METRICS']['address'], int(config['METRICS']['port'])).start()
+    if float(config['METRICS']['push_interval']) > 0:
+      metrics_topic = config['METRICS']['topic'].rstrip('/') + "/" + platform.node() + "/metrics"
+      metrics_push = metrics.MetricsPush(registry, functools.partial(mqttClient.publishMessage, topicOut=metrics_topic, retain=False), float(config['METRICS']['push_interval'])).start()
+      log.info("Metrics pushed to {} every {} s".format(metrics_topic, config['METRICS']['push_interval']))
+
+  # Setup Yolo, all engines share the configured non maximum suppression
+  suppressor = nms.createSuppressor(config['NMS'])
+  nms_gauge = registry.gauge("nms", "Non maximum suppression calls, boxes in and out, mean seconds per call", "stat")
+  for stat in ['calls', 'boxes_in', 'boxes_out', 'mean']:
+    nms_gauge.setFunction(lambda stat=stat: suppressor.stats()[stat], stat)
   if use_yolo_hw:
-    # This will reprogram the FPGA partially
+    # YoloHW reprograms the FPGA partially, YoloRef runs the whole network on the CPU
     timer.trigger("setup yolo begin")
-    yolo_hw_nn = yolo_hw.YoloHW(config['PYTHON']['python_path'], config['DARKNET_HW']['darknet_path'])
+    if use_yolo_ref:
+      params_path = config['DARKNET_HW']['params_path'] or None
+      yolo_hw_nn = yolo_ref.YoloRef(params_path,
+                                    weights_cache=config['DARKNET_HW']['weights_cache'] if params_path else None,
+                                    suppressor=suppressor)
+    else:
+      yolo_hw_nn = yolo_hw.YoloHW(config['PYTHON']['python_path'], config['DARKNET_HW']['darknet_path'], config['DARKNET_HW']['weights_cache'], conv0_numpy, suppressor)
     timer.end("setup yolo end", "Setup YOLO")
+    if use_pipeline:
+      yolo_pipeline = pipeline.createYoloHWPipeline(yolo_hw_nn, config['PATH']['detection_image_path'], maxsize=pipeline_queue_size, region_numpy=region_numpy).start()
+      for i, (name, func) in enumerate(yolo_pipeline.stages):
+        queue_depth.setFunction(yolo_pipeline.queues[i].qsize, "pipeline " + name)
+      queue_depth.setFunction(yolo_pipeline.queues[-1].qsize, "pipeline output")
   else:
     timer.trigger("setup yolo begin")
     yolo_sw_nn = yolo_sw.YoloSW(config['DARKNET_SW']['darknet_path'],
                                 config['DARKNET_SW']['darknet_cfg_path'],
-                                config['DARKNET_SW']['darknet_weights_path'])
+                                config['DARKNET_SW']['darknet_weights_path'],
+                                suppressor)
     timer.end("setup yolo end", "Setup YOLO")
 
   # Get static images
@@ -80,133 +507,125 @@ if __name__ == "__main__":
     current_file = 0
     log.debug("Static image folder: {}".format(config['PATH']['input_image_path']))
     log.debug("Number of image files found: {}".format(len(input_files)))
+  else:
+    # Open every camera once, background threads keep the newest frame of each
+    webcam = camera.CameraScheduler(cameras, locations, yolo_hw=use_yolo_hw and not use_yolo_ref, min_interval=float(config['APP']['camera_interval'])).start()
+    atexit.register(webcam.release)
+    stats_time = time.monotonic()
+
+  # Keep all detections queryable, written in batches by a background thread
+  detection_store = None
+  if use_store:
+    detection_store = store.DetectionStore(config['STORE']['path'], batch_size=int(config['STORE']['batch_size']), flush_interval=float(config['STORE']['flush_interval']))
+    queue_depth.setFunction(detection_store.queue.qsize, "store")
+
+  # Crop the frames to the zone of their location, detections outside the zone are dropped
+  rois = {}
+  if use_roi:
+    for location in locations:
+      if config.has_option('ROI', location):
+        rois[location] = roi.Roi(config['ROI'][location], margin=float(config['ROI']['margin']), mask=config['ROI']['mask'].lower() in ['true', '1', 'y', 'yes'])
+        log.info("Zone of {}: {}".format(location, config['ROI'][location]))
+    if rois and use_yolo_hw and not region_numpy:
+      log.warning("Zones need the region decoding in NumPy (region_numpy = 1), zones disabled")
+      rois = {}
+
+  # Skip the inference on static scenes, one background model per camera
+  motion_gates = None
+  if use_motion_gate and not static_images:
+    motion_gates = [motion.MotionGate(width=int(config['MOTION']['width']),
+                                      pixel_threshold=int(config['MOTION']['pixel_threshold']),
+                                      area_threshold=float(config['MOTION']['area_threshold']),
+                                      alpha=float(config['MOTION']['alpha']),
+                                      force_interval=float(config['MOTION']['force_interval'])) for c in cameras]
 
   ###############################################################################
   # Main Loop
   #
-  running = False
-  while True:
-    while running is True:
-      if not static_images:
-        # Get Webcam Image
-        if save_images:
-          fpath = helpers.saveWebcamImage(path=config['PATH']['raw_image_path'], ext=config['PATH']['extension'], camera=int(config['APP']['camera']), yolo_hw=use_yolo_hw)
-          if dev_mode and not use_yolo_hw:
-            helpers.displayFileCv2(fpath, False)
-        else:
-          fpath = os.path.abspath(os.path.join(config['PATH']['raw_image_path'], datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + "webcam" + config['PATH']['extension']))
-          image = helpers.getWebcamImage(int(config['APP']['camera']))
-          if show_images:
-            helpers.displayImageCv2(image, waitKey=False)
-      else:
-        if save_images:
-          fpath = os.path.abspath(os.path.join(config['PATH']['raw_image_path'], datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + "webcam" + config['PATH']['extension']))
-          #fpath = helpers.saveWebcamImage(path=config['PATH']['raw_image_path'], ext=config['PATH']['extension'], camera=int(config['APP']['camera']), yolo_hw=use_yolo_hw)
-        else:
-          fpath = os.path.abspath(os.path.join(config['PATH']['raw_image_path'], datetime.now().strftime("%Y%m%d%H%M%S") + "-" + platform.node() + "-" + "webcam" + config['PATH']['extension']))
-      # Yolo Test
-      if use_yolo_hw:
-        timer.trigger("load image begin")
-        if static_images:
-          if current_file >= len(input_files):
-            running = False
-            pass
-          log.debug("Image {} of {} analysed".format(current_file,len(input_files)))
-          yolo_hw_nn.getFile(input_files[current_file])
-          current_file += 1
-        else:
-          if save_images:
-            yolo_hw_nn.getFile(fpath)
-          else:
-            yolo_hw_nn.getImage(image)
-
-        timer.end("load image end", "Image Loading")
-
-        timer.trigger("yolo sw conv layer 0 begin")
-        yolo_hw_nn.execute_yolo_sw_firstlayer()
-        timer.end("yolo sw conv layer 0 end", "Apply YOLO SW Conv Layer 0")
-
-        timer.trigger("yolo hw conv layers 1-7 begin")
-        yolo_hw_nn.execute_yolo_hw()
-        timer.end("yolo hw conv layers 1-7 end", "Apply YOLO HW Conv Layer 1-7")
-
-        timer.trigger("yolo sw conv layer 8 begin")
-        yolo_hw_nn.execute_yolo_sw_lastlayer()
-        timer.end("yolo sw conv layer 8 end", "Apply YOLO SW Conv Layer 8")
-
-        timer.trigger("darknet detection begin")
-        (fpath_out, fpath_probs) = yolo_hw_nn.darknet_detection(fpath, config['PATH']['detection_image_path'])
-        timer.end("darknet detection begin", "Draw Detection Boxes")
-        #image_out = helpers.getImage(fpath_out)
-
-        # Publish detection yolo hw
-        if len(yolo_hw_nn.classes) > 0:
-          mqttClient.publishDetection(yolo_hw_nn.classes, yolo_hw_nn.confidences, None, fpath_out)
-
-      else:
-        fpath_out = config['PATH']['detection_image_path'] + os.sep + os.path.basename(os.path.splitext(fpath)[0]) + '_sw_detection' + os.path.splitext(fpath)[1]
-        timer.trigger("load image begin")
-        if static_images:
-          (image, layer_outputs) = yolo_sw_nn.loadFile(input_files[current_file])
-          current_file += 1
-        else:
-          if save_images:
-            (image, layer_outputs) = yolo_sw_nn.loadFile(fpath)
-          else:
-            layer_outputs = yolo_sw_nn.loadImg(image)
-
-        timer.end("load image end", "Image Loading")
-
-        timer.trigger("yolo sw conv layers begin")
-        yolo_sw_nn.execute_yolo_sw(image)
-        timer.end("yolo sw conv layers end", "Apply YOLO SW Conv Layers")
-
-        timer.trigger("darknet detection begin")
-        image_out = yolo_sw_nn.darknet_detection_sw(image, save_images, fpath_out)
-        timer.end("darknet detection begin", "Draw Detection Boxes")
-
-        # Publish detection yolo sw
-        if len(yolo_sw_nn.class_ids) > 0:
-          detection_labels = []
-          for class_id in yolo_sw_nn.class_ids:
-            detection_labels.append(yolo_sw_nn.labels[class_id])
-          if save_images:
-            mqttClient.publishDetection(labels=detection_labels, confidences=yolo_sw_nn.confidences, boxes=yolo_sw_nn.boxes, fpath=fpath_out)
-          else:
-            mqttClient.publishDetection(labels=detection_labels, confidences=yolo_sw_nn.confidences, boxes=yolo_sw_nn.boxes, image=image_out)
-
-        # display images
-        if show_images:
-          if save_images:
-            helpers.displayFileCv2(fpath_out)
-          else:
-            helpers.displayImageCv2(image_out)
-
-      if running:
-        timer.nextIndex()
+  capture_interval = int(config['APP']['capture_interval'])
+  # Sample an empty scene slowly, at the maximal frame rate while people are detected
+  adaptive_interval = None
+  if use_adaptive_interval:
+    adaptive_labels = [label.strip() for label in config['ADAPTIVE']['labels'].split(',')]
+    adaptive_file = config['PATH']['timelog_path'] + os.sep + time.strftime("%Y%m%d%H%M", time.localtime()) + "-" + platform.node() + "-capture-interval.csv"
+    adaptive_interval = adaptive.AdaptiveInterval(timer,
+                                                  min_interval=float(config['ADAPTIVE']['min_interval']),
+                                                  max_interval=float(config['ADAPTIVE']['max_interval']),
+                                                  hold=float(config['ADAPTIVE']['hold']),
+                                                  decay=float(config['ADAPTIVE']['decay']),
+                                                  latency_budget=float(config['ADAPTIVE']['latency_budget']),
+                                                  file=adaptive_file)
+    log.info("Adaptive capture interval, decisions in {}".format(adaptive_file))
+
+  if use_asyncio:
+    # Capture, inference and publishing as tasks, the mqtt state messages start and stop the capture
+    detection_loop = async_loop.DetectionLoop(captureBatch, detectStep, publishResult, adaptive_interval.next if adaptive_interval is not None else capture_interval, pipeline_queue_size)
+    mqttClient.addStateListener(detection_loop.setRunning)
+    queue_depth.setFunction(lambda: detection_loop.queues['frames'].qsize(), "loop frames")
+    queue_depth.setFunction(lambda: detection_loop.queues['results'].qsize(), "loop results")
+    detection_loop.setRunning(mqttClient.running)
+    detection_loop.run()
+  else:
+    running = False
+    finished = False
+    while not finished:
+      while running is True:
+        frames = captureBatch()
+        if frames is None:
+          log.debug("Loop done, finishing")
+          finished = True
+          break
+        if frames:
+          for result in detectStep(frames):
+            publishResult(result)
+
         log.debug("Loop done")
         if running != mqttClient.running:
           log.info("Stopping YOLO detection")
           running = mqttClient.running
         else:
-          log.debug("Waiting %d seconds before the next cycle..." % int(config['APP']['capture_interval']))
-          if int(config['APP']['capture_interval']) != -1:
-            time.sleep(int(config['APP']['capture_interval']))
-      else:
-        log.debug("Loop done, finishing")
+          interval = adaptive_interval.next() if adaptive_interval is not None else capture_interval
+          log.debug("Waiting %.2f seconds before the next cycle...", interval)
+          if interval != -1:
+            time.sleep(interval)
 
-    if running != mqttClient.running:
-      log.info("Starting YOLO detection")
-      running = mqttClient.running
+      # Sleep until the next state message instead of polling
+      if not finished and running == mqttClient.running:
+        mqttClient.waitState(1.0)
+      if running != mqttClient.running:
+        log.info("Starting YOLO detection")
+        running = mqttClient.running
 
 
   #if dev_mode:
   #  log.debug("Dump Timer Logs to CSV")
   #  timer.dumpToCsv()
+  # Publish the frames still in the pipeline
+  if use_yolo_hw and use_pipeline:
+    for frame in yolo_pipeline.stop():
+      for result in pipelineResult(frame):
+        publishResult(result)
+  renderer.close()
+  if metrics_push is not None:
+    metrics_push.close()
+  if metrics_server is not None:
+    metrics_server.close()
   mqttClient.disconnect()
+  if motion_gates is not None:
+    for location, motion_gate in zip(locations, motion_gates):
+      log.info("Motion gate {} skipped {} of {} frames ({:.1%})".format(location, motion_gate.skipped, motion_gate.frames, motion_gate.skipRate()))
+  nms_stats = suppressor.stats()
+  log.info("NMS %s: %d calls, %d of %d boxes kept, %.3f ms per call" % (suppressor.method, nms_stats['calls'], nms_stats['boxes_out'], nms_stats['boxes_in'], nms_stats['mean'] * 1000))
+  timer.close()
+  if detection_store is not None:
+    detection_store.close()
+  if not static_images:
+    webcam.report()
+    webcam.release()
 
   # Delete objects
   if use_yolo_hw:
+    log.info("Accelerator buffer allocations: %d" % yolo_hw_nn.allocations)
     del yolo_hw_nn
   else:
     del yolo_sw_nn
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - pipeline
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import queue
+import threading
+import time
+from datetime import timedelta
+import numpy as np
+import helpers
+
+# Marker passed through the queues to stop the stage threads
+_STOP = object()
+
+
+###############################################################################
+# Pipeline Class
+#
+class Pipeline:
+  """ Multi-stage executor, every stage runs in its own thread connected by bounded queues.
+      Consecutive frames overlap: while frame N is in stage k, frame N+1 can already be in stage k-1.
+      Frames are dicts which are passed from stage to stage, the order of the frames is preserved.
+  """
+
+  def __init__(self, stages, maxsize=2):
+    """ Constructor for the pipeline class
+
+    Args:
+        stages (list): list of (name, function) tuples, function(frame) returns the updated frame dict
+        maxsize (int, optional): max number of frames waiting in front of each stage. Defaults to 2.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.stages = stages
+    self.maxsize = maxsize
+    # the output queue is unbounded so stop() can always drain it
+    self.queues = [queue.Queue(maxsize=maxsize) for i in range(len(stages))] + [queue.Queue()]
+    self.threads = []
+    self.frames_in = 0
+    self.frames_out = 0
+    self.stage_time = dict((name, 0.0) for name, func in stages)
+    self.first_out = None
+    self.last_out = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def start(self):
+    """ Start one thread per stage
+
+    Returns:
+        (obj): pipeline object
+    """
+    if not self.threads:
+      for i, (name, func) in enumerate(self.stages):
+        thread = threading.Thread(target=self.worker, args=(i, name, func), name="pipeline-" + name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+      self.log.info("Pipeline started with %d stages" % len(self.stages))
+    return self
+
+  def worker(self, i, name, func):
+    """ Stage thread loop
+
+    Args:
+        i (int): stage index
+        name (str): stage name, used as key in frame['times']
+        func (function): stage function
+    """
+    qin = self.queues[i]
+    qout = self.queues[i + 1]
+    while True:
+      frame = qin.get()
+      if frame is _STOP:
+        qout.put(_STOP)
+        break
+      # Frames which failed in a previous stage are passed through untouched
+      if 'error' not in frame:
+        start = time.perf_counter()
+        try:
+          frame = func(frame)
+        except Exception as e:
+          self.log.exception("Pipeline stage '%s' failed on frame %s" % (name, frame.get('index')))
+          frame['error'] = e
+        frame['times'][name] = time.perf_counter() - start
+      qout.put(frame)
+
+  def put(self, frame, block=True, timeout=None):
+    """ Feed a frame into the first stage, blocks if the first queue is full (backpressure)
+
+    Args:
+        frame (dict): frame to process, e.g. {'fpath': ...} or {'image': ...}
+        block (bool, optional): wait for a free slot. Defaults to True.
+        timeout (float, optional): max seconds to wait. Defaults to None.
+    """
+    frame.setdefault('index', self.frames_in)
+    frame.setdefault('times', {})
+    self.queues[0].put(frame, block, timeout)
+    self.frames_in += 1
+
+  def get(self, block=True, timeout=None):
+    """ Get the next processed frame
+
+    Args:
+        block (bool, optional): wait for a frame. Defaults to True.
+        timeout (float, optional): max seconds to wait. Defaults to None.
+
+    Returns:
+        (dict): processed frame or None if no frame is ready or the pipeline is stopped
+    """
+    try:
+      frame = self.queues[-1].get(block, timeout)
+    except queue.Empty:
+      return None
+    if frame is _STOP:
+      return None
+    now = time.perf_counter()
+    if self.first_out is None:
+      self.first_out = now
+    self.last_out = now
+    self.frames_out += 1
+    for name, duration in frame['times'].items():
+      self.stage_time[name] += duration
+    return frame
+
+  def pending(self):
+    """ Number of frames fed but not yet collected
+
+    Returns:
+        (int): number of frames in flight
+    """
+    return self.frames_in - self.frames_out
+
+  def stop(self):
+    """ Drain the pipeline and stop all stage threads
+
+    Returns:
+        (list): frames which were still in flight
+    """
+    if not self.threads:
+      return []
+    self.queues[0].put(_STOP)
+    frames = []
+    while True:
+      frame = self.queues[-1].get()
+      if frame is _STOP:
+        break
+      frames.append(frame)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+    self.log.info("Pipeline stopped")
+    return frames
+
+  def stats(self):
+    """ Throughput statistics of the collected frames
+
+    Returns:
+        (dict): dict containing:
+
+            frames (int): number of collected frames
+            stage_mean (dict): mean duration per stage in seconds
+            sequential_period (float): sum of the mean stage durations, frame period without pipelining
+            pipeline_period (float): measured time between two output frames
+            gain (float): frame rate gain sequential_period / pipeline_period
+    """
+    stats = {'frames': self.frames_out, 'stage_mean': {}, 'sequential_period': 0.0, 'pipeline_period': 0.0, 'gain': 0.0}
+    if self.frames_out == 0:
+      return stats
+    for name, total in self.stage_time.items():
+      stats['stage_mean'][name] = total / self.frames_out
+    stats['sequential_period'] = sum(stats['stage_mean'].values())
+    if self.frames_out > 1:
+      stats['pipeline_period'] = (self.last_out - self.first_out) / (self.frames_out - 1)
+      stats['gain'] = stats['sequential_period'] / stats['pipeline_period'] if stats['pipeline_period'] > 0 else 0.0
+    return stats
+
+  def report(self, timer, frame=None):
+    """ Write the stage durations of a frame and the frame rate gain to the timer
+
+    Args:
+        timer (obj): timer.Timer object
+        frame (dict, optional): processed frame, its stage durations are recorded. Defaults to None.
+    """
+    if frame is not None:
+      for name, duration in frame['times'].items():
+        timer.add(timedelta(seconds=duration), name)
+    stats = self.stats()
+    if stats['pipeline_period'] > 0:
+      timer.add(timedelta(seconds=stats['pipeline_period']), "Pipeline Frame Period")
+      timer.add(timedelta(seconds=stats['sequential_period']), "Sequential Frame Period")
+      self.log.debug("Pipeline %.2f fps, sequential %.2f fps, gain %.2fx", 1 / stats['pipeline_period'], 1 / stats['sequential_period'], stats['gain'])
+
+
+###############################################################################
+# Accelerator Stand-in
+#
+class SimulatedAccelerator:
+  """ Stand-in for the FPGA offload of the conv layers 1-7.
+      Used to run the pipeline without qnn/pynq, it waits like the accelerator and returns a conv7 shaped output.
+  """
+
+  def __init__(self, delay=0.03, out_ch=512, out_dim=13):
+    """ Constructor for the simulated accelerator
+
+    Args:
+        delay (float, optional): simulated inference time in seconds. Defaults to 0.03.
+        out_ch (int, optional): output channels of conv7. Defaults to 512.
+        out_dim (int, optional): output dimension of conv7. Defaults to 13.
+    """
+    self.delay = delay
+    self.out_ch = out_ch
+    self.out_dim = out_dim
+
+  def __call__(self, conv0_output_quant):
+    """ Simulated inference, the sleep releases the GIL like the real accelerator does
+
+    Args:
+        conv0_output_quant (obj): quantized output of convolutional layer 0
+
+    Returns:
+        (obj): conv7 output as flat numpy array
+    """
+    time.sleep(self.delay)
+    return np.zeros(self.out_dim * self.out_dim * self.out_ch, dtype=np.float32)
+
+
+###############################################################################
+# YoloHW Pipeline
+#
+def createYoloHWPipeline(yolo_hw_nn, output_folder, accelerator=None, maxsize=2, region_numpy=False):
+  """ Create a pipeline running the YoloHW stages overlapped over consecutive frames
+
+      * Image Loading: frame['crop'] (region of interest), frame['image'] (opencv frame) or frame['fpath']
+      * Conv Layer 0 on the ARM
+      * Conv Layers 1-7 on the FPGA
+      * Conv Layer 8 on the ARM
+      * Region detection and drawing, or only region decoding in NumPy
+
+      A frame['crop'] needs the region decoding in NumPy, its frame['offset'] and frame['keep'] are
+      passed to YoloHW.region_detection.
+
+  Args:
+      yolo_hw_nn (obj): yolo_hw.YoloHW object
+      output_folder (str): folder for all detection output files
+      accelerator (function, optional): stand-in for the FPGA stage, e.g. SimulatedAccelerator. Defaults to yolo_hw_nn.execute_yolo_hw.
+      maxsize (int, optional): bounded queue size in front of each stage. Defaults to 2.
+      region_numpy (bool, optional): decode the detections in NumPy, drawing is left to the caller. Defaults to False.
+
+  Returns:
+      (obj): pipeline object, not started
+  """
+  if accelerator is None:
+    accelerator = yolo_hw_nn.execute_yolo_hw
+    # one DMA input buffer per frame between conv0 and the end of the accelerator stage
+    yolo_hw_nn.init_buffers(maxsize + 2)
+  # letterbox buffers of the frames between the start of loading and the end of conv0
+  yolo_hw_nn.letterbox.reserve(maxsize + 2)
+
+  def load(frame):
+    image = frame.pop('crop', None)
+    if image is None:
+      image = frame.get('image')
+    if image is not None:
+      # the opencv frame stays in the frame dict for drawing the detections
+      frame['npimg'] = yolo_hw_nn.getImage(image)
+    else:
+      frame['npimg'] = yolo_hw_nn.loadFile(frame['fpath'])
+    frame['image_size'] = yolo_hw_nn.image_size
+    return frame
+
+  def conv0(frame):
+    frame['conv0'] = yolo_hw_nn.execute_yolo_sw_firstlayer(frame.pop('npimg'))
+    return frame
+
+  def conv1_7(frame):
+    frame['conv7'] = accelerator(frame.pop('conv0'))
+    return frame
+
+  def conv8(frame):
+    frame['conv8'] = yolo_hw_nn.execute_yolo_sw_lastlayer(frame.pop('conv7'))
+    return frame
+
+  def region_detection(frame):
+    (frame['boxes'], frame['confidences'], frame['class_ids']) = yolo_hw_nn.region_detection(frame.pop('conv8'), frame['image_size'],
+                                                                                             offset=frame.get('offset', (0, 0)), keep=frame.pop('keep', None))
+    frame['classes'] = list(yolo_hw_nn.classes)
+    return frame
+
+  def detection(frame):
+    (frame['fpath_out'], frame['fpath_probs']) = yolo_hw_nn.darknet_detection(frame['fpath'], output_folder, frame.pop('conv8'))
+    frame['classes'] = list(yolo_hw_nn.classes)
+    frame['confidences'] = list(yolo_hw_nn.confidences)
+    return frame
+
+  return Pipeline([("Image Loading", load),
+                   ("Apply YOLO SW Conv Layer 0", conv0),
+                   ("Apply YOLO HW Conv Layer 1-7", conv1_7),
+                   ("Apply YOLO SW Conv Layer 8", conv8),
+                   ("Decode Detections", region_detection) if region_numpy else ("Draw Detection Boxes", detection)], maxsize=maxsize)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - region
+
+Darknet region layer decoding (tiny-yolo VOC) in NumPy, without any file I/O.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import numpy as np
+import nms
+
+###############################################################################
+# Constants
+#
+# anchors of the region layer of tinier-yolo-bwn-3bit-relu-nomaxpool.cfg (tiny-yolo-voc)
+VOC_ANCHORS = np.array([[1.08, 1.19], [3.42, 4.41], [6.63, 11.38], [9.42, 5.11], [16.62, 10.52]], dtype=np.float32)
+VOC_CLASSES = 20
+VOC_NAMES = ["aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
+             "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
+NET_SIZE = 416
+
+
+###############################################################################
+# Activation Functions
+#
+def sigmoid(x):
+  """ Logistic activation
+
+  Args:
+      x (obj): numpy array
+
+  Returns:
+      (obj): numpy array
+  """
+  return 1.0 / (1.0 + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+  """ Softmax activation along an axis
+
+  Args:
+      x (obj): numpy array
+      axis (int, optional): axis to normalize. Defaults to -1.
+
+  Returns:
+      (obj): numpy array
+  """
+  e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+  return e / np.sum(e, axis=axis, keepdims=True)
+
+
+###############################################################################
+# Region Functions
+#
+def correctBoxes(boxes, image_size, net_size=NET_SIZE):
+  """ Undo the letterboxing, scale relative boxes to pixels of the original image
+
+  Args:
+      boxes (obj): relative boxes array (n, 4) [cx, cy, w, h] in the network input
+      image_size (tuple): (width, height) of the original image, None to keep network input pixels
+      net_size (int, optional): network input size. Defaults to 416.
+
+  Returns:
+      (obj): boxes array (n, 4) [cx, cy, w, h] in pixels
+  """
+  if image_size is None:
+    return boxes * net_size
+  (w, h) = image_size
+  if net_size / w < net_size / h:
+    new_w, new_h = net_size, h * net_size / w
+  else:
+    new_w, new_h = w * net_size / h, net_size
+  boxes = boxes.copy()
+  boxes[:, 0] = (boxes[:, 0] - (net_size - new_w) / 2 / net_size) / (new_w / net_size) * w
+  boxes[:, 1] = (boxes[:, 1] - (net_size - new_h) / 2 / net_size) / (new_h / net_size) * h
+  boxes[:, 2] *= net_size / new_w * w
+  boxes[:, 3] *= net_size / new_h * h
+  return boxes
+
+
+def decodeRegion(output, image_size=None, threshold=0.3, nms_threshold=None, anchors=VOC_ANCHORS, classes=VOC_CLASSES, offset=(0, 0), keep=None, suppressor=None):
+  """ Decode the output of the last conv layer like the darknet region layer
+
+      * sigmoid on x, y and objectness, exp on w, h scaled by the anchors
+      * softmax over the class scores, probability = objectness * class score
+      * detections outside the region of interest are dropped
+      * non maximum suppression, class aware by default
+
+  Args:
+      output (obj): conv8 output, numpy array or ctypes float pointer, layout (anchors * (5 + classes), grid, grid)
+      image_size (tuple, optional): (width, height) of the original image. Defaults to network input pixels.
+      threshold (float, optional): minimal probability to keep a detection. Defaults to 0.3.
+      nms_threshold (float, optional): iou threshold for the non maximum suppression. Defaults to the suppressor threshold.
+      anchors (obj, optional): anchor sizes (n, 2) in grid cells. Defaults to VOC_ANCHORS.
+      classes (int, optional): number of classes. Defaults to 20.
+      offset (tuple, optional): (x, y) added to the boxes, position of the analysed crop in the image. Defaults to (0, 0).
+      keep (function, optional): keep(boxes) returns a boolean mask of the boxes [x, y, width, height] to keep. Defaults to None.
+      suppressor (obj, optional): nms.NonMaxSuppression. Defaults to class aware greedy NMS.
+
+  Returns:
+      (tuple): tuple containing:
+
+          boxes (list): list of box coordinates found [x, y, width, height] in pixels
+          confidences (list): list of probabilities for each box
+          class_id (list): id of classes found
+  """
+  num = len(anchors)
+  size = num * (5 + classes)
+  if not isinstance(output, np.ndarray):
+    output = np.ctypeslib.as_array(output, shape=(size * 13 * 13,))
+  grid = int(round(np.sqrt(output.size // size)))
+  output = output.reshape(num, 5 + classes, grid, grid)
+
+  objectness = sigmoid(output[:, 4])
+  probs = softmax(output[:, 5:], axis=1) * objectness[:, np.newaxis]
+  # (num, classes, grid, grid) -> one row per anchor and cell
+  probs = probs.transpose(0, 2, 3, 1).reshape(-1, classes)
+  mask = probs > threshold
+  (rows, class_ids) = np.nonzero(mask)
+  if rows.size == 0:
+    return ([], [], [])
+
+  (n, row, col) = np.unravel_index(rows, (num, grid, grid))
+  raw = output[n, 0:4, row, col]
+  boxes = np.empty((rows.size, 4), dtype=np.float32)
+  boxes[:, 0] = (col + sigmoid(raw[:, 0])) / grid
+  boxes[:, 1] = (row + sigmoid(raw[:, 1])) / grid
+  boxes[:, 2] = np.exp(raw[:, 2]) * anchors[n, 0] / grid
+  boxes[:, 3] = np.exp(raw[:, 3]) * anchors[n, 1] / grid
+  boxes = correctBoxes(boxes, image_size)
+  scores = probs[rows, class_ids]
+
+  boxes[:, 0:2] += np.array(offset, dtype=np.float32)
+  corners = np.concatenate([boxes[:, 0:2] - boxes[:, 2:4] / 2, boxes[:, 0:2] + boxes[:, 2:4] / 2], axis=1)
+  if keep is not None:
+    inside = keep(np.concatenate([corners[:, 0:2], boxes[:, 2:4]], axis=1))
+    if not np.any(inside):
+      return ([], [], [])
+    (boxes, corners, scores, class_ids) = (boxes[inside], corners[inside], scores[inside], class_ids[inside])
+  if suppressor is None:
+    suppressor = nms.NonMaxSuppression()
+  (kept, scores) = suppressor(corners, scores, class_ids, nms_threshold)
+  xywh = np.concatenate([corners[kept, 0:2], boxes[kept, 2:4]], axis=1).astype(int)
+  return (xywh.tolist(), scores.tolist(), class_ids[kept].tolist())
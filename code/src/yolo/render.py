@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - render
+
+Background rendering of the detection images: the boxes are drawn and the frame is encoded as JPEG once,
+the same bytes are written to disk and published over mqtt.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import helpers
+
+
+###############################################################################
+# Renderer Class
+#
+class Renderer:
+  """ Draws the detections and encodes the frames in worker threads
+
+      * submit() returns a future of the JPEG bytes, the inference loop never waits for the encoding
+      * at most maxsize frames wait for a worker, submit() blocks beyond (backpressure, bounded memory)
+      * the image passed to submit() is drawn in place and must not be used by the caller meanwhile
+
+      OpenCV releases the GIL while drawing and encoding, the workers run in parallel to the inference.
+  """
+
+  def __init__(self, quality=85, max_width=0, workers=1, maxsize=4, timer=None):
+    """ Constructor for the renderer
+
+    Args:
+        quality (int, optional): JPEG quality 0-100. Defaults to 85.
+        max_width (int, optional): wider frames are scaled down before the encoding, 0 to keep the size. Defaults to 0.
+        workers (int, optional): number of worker threads. Defaults to 1.
+        maxsize (int, optional): max frames submitted and not yet encoded. Defaults to 4.
+        timer (obj, optional): timer.Timer for the durations of the drawing and the encoding. Defaults to None.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.quality = quality
+    self.max_width = max_width
+    self.timer = timer
+    self.slots = threading.BoundedSemaphore(maxsize)
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+    self.frames = 0
+    self.bytes = 0
+
+  def submit(self, image, draw=None, outfile=None):
+    """ Queue a frame for the rendering
+
+    Args:
+        image (obj): opencv image owned by the renderer from now on
+        draw (function, optional): draw(image) draws the detections in place and returns the image. Defaults to None.
+        outfile (str, optional): file the JPEG bytes are written to, not written if None. Defaults to None.
+
+    Returns:
+        (obj): concurrent.futures.Future of the JPEG bytes
+    """
+    self.slots.acquire()
+    try:
+      future = self.executor.submit(self.render, image, draw, outfile)
+    except BaseException:
+      self.slots.release()
+      raise
+    future.add_done_callback(lambda future: self.slots.release())
+    return future
+
+  def render(self, image, draw=None, outfile=None):
+    """ Draw, scale and encode a frame, in a worker thread
+
+    Args:
+        image (obj): opencv image, drawn in place
+        draw (function, optional): draw(image) returns the image with the detections. Defaults to None.
+        outfile (str, optional): file the JPEG bytes are written to. Defaults to None.
+
+    Returns:
+        (bytes): JPEG encoded image
+    """
+    start = time.perf_counter()
+    if draw is not None:
+      image = draw(image)
+    drawn = time.perf_counter()
+    (h, w) = image.shape[:2]
+    if self.max_width > 0 and w > self.max_width:
+      image = cv2.resize(image, (self.max_width, int(round(h * self.max_width / w))), interpolation=cv2.INTER_AREA)
+    (ok, encoded) = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+    if not ok:
+      raise IOError("Unable to encode the detection image")
+    image_bytes = encoded.tobytes()
+    if outfile is not None:
+      with open(outfile, 'wb') as f:
+        f.write(image_bytes)
+    self.frames += 1
+    self.bytes += len(image_bytes)
+    if self.timer is not None:
+      self.timer.add(drawn - start, "Draw Detection Boxes")
+      self.timer.add(time.perf_counter() - drawn, "JPEG Encoding")
+    return image_bytes
+
+  def close(self):
+    """ Wait for the submitted frames and stop the workers
+    """
+    self.executor.shutdown(wait=True)
+    if self.frames > 0:
+      self.log.info("Renderer: %d frames, %.1f kB per frame" % (self.frames, self.bytes / self.frames / 1000))
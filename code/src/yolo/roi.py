@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - roi
+
+Region of interest of a location: the frame is cropped to the zone before the inference
+and detections outside the zone are dropped before the non maximum suppression.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import numpy as np
+import cv2
+
+
+###############################################################################
+# Polygon Functions
+#
+def parsePolygon(text):
+  """ Parse a polygon of the ini file
+
+  Args:
+      text (str): relative points "x,y x,y x,y ..." with 0.0 <= x, y <= 1.0
+
+  Returns:
+      (obj): numpy array (n, 2) of relative points
+  """
+  points = [[float(v) for v in point.split(',')] for point in text.split()]
+  polygon = np.array(points, dtype=np.float32)
+  if polygon.ndim != 2 or polygon.shape[1] != 2 or len(polygon) < 3:
+    raise ValueError("Invalid polygon '%s', at least 3 points x,y required" % text)
+  return polygon
+
+
+def pointsInPolygon(points, polygon):
+  """ Even-odd rule point in polygon test for many points at once
+
+  Args:
+      points (obj): numpy array (n, 2) of points
+      polygon (obj): numpy array (m, 2) of polygon corners
+
+  Returns:
+      (obj): boolean numpy array (n,), True for points inside the polygon
+  """
+  x = points[:, 0:1]
+  y = points[:, 1:2]
+  (x1, y1) = (polygon[:, 0], polygon[:, 1])
+  (x2, y2) = (np.roll(x1, -1), np.roll(y1, -1))
+  # edges crossing the horizontal line through the point, horizontal edges never cross
+  spans = (y1 > y) != (y2 > y)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    crossing = x < x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+  return np.count_nonzero(spans & crossing, axis=1) % 2 == 1
+
+
+###############################################################################
+# Roi Class
+#
+class Roi:
+  """ Zone polygon of a location in relative image coordinates
+
+      * crop(): bounding rectangle of the zone plus a margin, the network input only contains the zone
+        which raises the effective resolution
+      * inside(): a detection is in the zone if its foot point (bottom center) is inside the polygon
+  """
+
+  def __init__(self, polygon, margin=0.05, mask=False):
+    """ Constructor for the region of interest
+
+    Args:
+        polygon (obj): relative points (n, 2) or string "x,y x,y x,y ..."
+        margin (float, optional): margin around the polygon bounds, fraction of the image size. Defaults to 0.05.
+        mask (bool, optional): fill the pixels outside the polygon with gray. Defaults to False.
+    """
+    if isinstance(polygon, str):
+      polygon = parsePolygon(polygon)
+    self.polygon = np.clip(np.asarray(polygon, dtype=np.float32), 0.0, 1.0)
+    self.margin = margin
+    self.mask = mask
+    # crop rectangle and mask only change with the image size
+    self.size = None
+    self.bounds = None
+    self.outside = None
+
+  def resize(self, w, h):
+    """ Compute the crop rectangle and the mask for an image size
+
+    Args:
+        w (int): image width
+        h (int): image height
+    """
+    (x1, y1) = np.clip(self.polygon.min(axis=0) - self.margin, 0.0, 1.0)
+    (x2, y2) = np.clip(self.polygon.max(axis=0) + self.margin, 0.0, 1.0)
+    self.bounds = (int(x1 * w), int(y1 * h), max(int(np.ceil(x2 * w)), int(x1 * w) + 1), max(int(np.ceil(y2 * h)), int(y1 * h) + 1))
+    self.size = (w, h)
+    if self.mask:
+      (bx1, by1, bx2, by2) = self.bounds
+      inside = np.zeros((by2 - by1, bx2 - bx1), dtype=np.uint8)
+      corners = np.round(self.polygon * np.array([w, h]) - np.array([bx1, by1])).astype(np.int32)
+      cv2.fillPoly(inside, [corners], 1)
+      self.outside = inside == 0
+
+  def crop(self, image):
+    """ Crop an image to the zone
+
+    Args:
+        image (obj): opencv image (H, W, 3)
+
+    Returns:
+        (tuple): tuple containing:
+
+            crop (obj): view of the zone, a masked copy if mask is set
+            offset (tuple): (x, y) of the crop in the image
+    """
+    (h, w) = image.shape[:2]
+    if self.size != (w, h):
+      self.resize(w, h)
+    (x1, y1, x2, y2) = self.bounds
+    crop = image[y1:y2, x1:x2]
+    if self.mask:
+      crop = crop.copy()
+      crop[self.outside] = 127
+    return (crop, (x1, y1))
+
+  def inside(self, boxes, image_size):
+    """ Check which detections are in the zone
+
+    Args:
+        boxes (obj): numpy array (n, 4) [x, y, width, height] in image pixels
+        image_size (tuple): (width, height) of the image
+
+    Returns:
+        (obj): boolean numpy array (n,)
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    feet = np.stack([boxes[:, 0] + boxes[:, 2] / 2, boxes[:, 1] + boxes[:, 3]], axis=1)
+    return pointsInPolygon(feet, self.polygon * np.array(image_size, dtype=np.float32))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - store
+
+Append-only detection store in SQLite (WAL mode) with time and class indexes.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import sqlite3
+import json
+import time
+import queue
+import threading
+import atexit
+import helpers
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+  id INTEGER PRIMARY KEY,
+  time REAL NOT NULL,
+  location TEXT NOT NULL,
+  timings TEXT
+);
+CREATE TABLE IF NOT EXISTS detections (
+  frame_id INTEGER NOT NULL REFERENCES frames(id),
+  time REAL NOT NULL,
+  location TEXT NOT NULL,
+  class TEXT NOT NULL,
+  confidence REAL NOT NULL,
+  x INTEGER, y INTEGER, w INTEGER, h INTEGER
+);
+CREATE INDEX IF NOT EXISTS frames_time ON frames (time);
+CREATE INDEX IF NOT EXISTS detections_time ON detections (time);
+CREATE INDEX IF NOT EXISTS detections_class ON detections (class, time);
+CREATE INDEX IF NOT EXISTS detections_class_location ON detections (class, location, time);
+"""
+
+# Marker to stop the writer thread
+_STOP = object()
+
+
+###############################################################################
+# DetectionStore Class
+#
+class DetectionStore:
+  """ Detection results of all frames in one SQLite database
+
+      * add() only queues the frame, a writer thread inserts the queued frames in one transaction per batch
+      * WAL mode, queries run on their own connection concurrently to the writer
+      * detections are denormalized (time, location, class) so the (class, location, time) index answers
+        "class at location between t1 and t2" without a join
+  """
+
+  def __init__(self, path, batch_size=256, flush_interval=1.0, maxsize=10000):
+    """ Constructor for the store, creates the database if missing and starts the writer thread
+
+    Args:
+        path (str): database file
+        batch_size (int, optional): max frames per transaction. Defaults to 256.
+        flush_interval (float, optional): max seconds a frame waits in the queue. Defaults to 1.0.
+        maxsize (int, optional): max queued frames, further frames are dropped if the disk can't keep up. Defaults to 10000.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.path = path
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.queue = queue.Queue(maxsize=maxsize)
+    self.dropped = 0
+    self.written = 0
+    with self.connect() as db:
+      db.executescript(SCHEMA)
+    self.writer = threading.Thread(target=self.writeLoop, name="detection-store", daemon=True)
+    self.writer.start()
+    atexit.register(self.close)
+
+  def connect(self):
+    """ Open a connection in WAL mode
+
+    Returns:
+        (obj): sqlite3 connection
+    """
+    db = sqlite3.connect(self.path, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL with NORMAL sync only loses the last transactions on a power loss, never corrupts
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+  def add(self, location, labels, confidences, boxes=None, timings=None, timestamp=None):
+    """ Queue the detections of a frame, never blocks
+
+    Args:
+        location (str): identification of the image location
+        labels (list): class names of the detections
+        confidences (list): confidence of each detection
+        boxes (list, optional): [x, y, width, height] of each detection. Defaults to None.
+        timings (dict, optional): stage durations in seconds. Defaults to None.
+        timestamp (float, optional): frame capture time in seconds since epoch. Defaults to now.
+    """
+    frame = (timestamp if timestamp is not None else time.time(), location, labels, confidences, boxes, timings)
+    try:
+      self.queue.put_nowait(frame)
+    except queue.Full:
+      self.dropped += 1
+
+  def writeLoop(self):
+    """ Writer thread, inserts batches of queued frames
+    """
+    db = self.connect()
+    running = True
+    while running:
+      try:
+        frames = [self.queue.get(timeout=self.flush_interval)]
+      except queue.Empty:
+        continue
+      while len(frames) < self.batch_size:
+        try:
+          frames.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+      if _STOP in frames:
+        running = False
+        frames = [frame for frame in frames if frame is not _STOP]
+      try:
+        self.insert(db, frames)
+      except sqlite3.Error:
+        self.log.exception("Unable to store %d frames" % len(frames))
+    db.close()
+
+  def insert(self, db, frames):
+    """ Insert frames in one transaction
+
+    Args:
+        db (obj): sqlite3 connection
+        frames (list): queued frames
+    """
+    with db:
+      for (timestamp, location, labels, confidences, boxes, timings) in frames:
+        frame_id = db.execute("INSERT INTO frames (time, location, timings) VALUES (?, ?, ?)",
+                              (timestamp, location, json.dumps(timings) if timings is not None else None)).lastrowid
+        rows = []
+        for i in range(len(labels)):
+          (x, y, w, h) = [int(v) for v in boxes[i]] if boxes is not None else (None, None, None, None)
+          rows.append((frame_id, timestamp, location, labels[i], float(confidences[i]), x, y, w, h))
+        db.executemany("INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    self.written += len(frames)
+
+  def query(self, label=None, location=None, start=None, end=None, limit=None):
+    """ Detections by class, location and time range, oldest first
+
+    Args:
+        label (str, optional): class name. Defaults to all classes.
+        location (str, optional): image location. Defaults to all locations.
+        start (float, optional): first time in seconds since epoch. Defaults to None.
+        end (float, optional): last time (excluded). Defaults to None.
+        limit (int, optional): max number of rows. Defaults to None.
+
+    Returns:
+        (list): rows (time, location, class, confidence, x, y, w, h)
+    """
+    where = []
+    args = []
+    for (condition, value) in [("class = ?", label), ("location = ?", location), ("time >= ?", start), ("time < ?", end)]:
+      if value is not None:
+        where.append(condition)
+        args.append(value)
+    sql = "SELECT time, location, class, confidence, x, y, w, h FROM detections"
+    if where:
+      sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY time"
+    if limit is not None:
+      sql += " LIMIT ?"
+      args.append(limit)
+    db = self.connect()
+    try:
+      return db.execute(sql, args).fetchall()
+    finally:
+      db.close()
+
+  def close(self):
+    """ Write the queued frames and stop the writer thread
+    """
+    if self.writer is None:
+      return
+    self.queue.put(_STOP)
+    self.writer.join()
+    self.writer = None
+    self.log.info("Detection store closed, %d frames written, %d dropped" % (self.written, self.dropped))
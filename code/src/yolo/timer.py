@@ -14,16 +14,26 @@ Copyright (C) 2021 FFHS - All Rights Reserved
 import csv
 import os
 import platform
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
+import threading
+import atexit
+import logging
+from array import array
+import numpy as np
 import helpers
 
 
 class Timer:
-  """ Class to save and export measured timing down to a ms precision
+  """ Class to save and export measured timing down to a ns precision
+
+      Timestamps are taken with the monotonic time.perf_counter_ns() and recorded into a preallocated ring buffer
+      of int64 rows [index, type, ns, stage id]. Stage texts are interned to ids. A background thread writes
+      the new rows in batches to the csv file, the measurement itself never opens a file. Durations are also
+      observed by the optional metrics histogram, labeled with the stage text.
   """
 
-  def __init__(self, title=None, verbose=False, report=False, filewrite=True, file=None, index=0):
+  def __init__(self, title=None, verbose=False, report=False, filewrite=True, file=None, index=0, capacity=4096, flush_interval=5.0, histogram=None):
     """Constructor for timer class
 
     Args:
@@ -32,8 +42,10 @@ class Timer:
         report (bool, optional): console output of timings. Defaults to False.
         filewrite (bool, optional): write to csv file. Defaults to True.
         file (str, optional): filepath for csv file. Defaults to None.
+        capacity (int, optional): number of rows kept in memory. Defaults to 4096.
+        flush_interval (float, optional): seconds between two csv writes. Defaults to 5.0.
+        histogram (obj, optional): metrics.Histogram of the stage durations. Defaults to None.
     """
-    self.times = []
     self.verbose = verbose
     self.report = report
     self.title = title
@@ -53,8 +65,76 @@ class Timer:
       self.file += ".csv"
     self.file = os.path.split(self.file)[0] + os.sep + time.strftime("%Y%m%d%H%M", time.localtime()) + "-" + platform.node() + "-" + os.path.split(self.file)[1]
     self.log = helpers.createLogger(__name__)
+
+    # ring buffer
+    self.capacity = capacity
+    # flat preallocated buffer for cheap writes, numpy view on the same memory for the statistics
+    self.buffer = array('q', bytes(8 * 4 * capacity))
+    self.rows = np.frombuffer(self.buffer, dtype=np.int64).reshape(capacity, 4)
+    self.head = 0
+    self.flushed = 0
+    self.overruns = 0
+    self.stage_ids = {}
+    self.stage_names = []
+    self.last_ns = None
+    self.prev_ns = None
+    self.lock = threading.Lock()
+    # wall clock reference to convert the monotonic timestamps for the csv file
+    self.wall_ns = time.time_ns()
+    self.ref_ns = time.perf_counter_ns()
+
+    self.histogram = histogram
+    self.flush_interval = flush_interval
+    self.flush_event = threading.Event()
+    self.stopped = threading.Event()
+    self.flusher = None
     if self.filewrite:
       self.writeCsvHeader()
+      self.flusher = threading.Thread(target=self.flushLoop, name="timer-flush", daemon=True)
+      self.flusher.start()
+      atexit.register(self.close)
+
+  def stageId(self, text):
+    """ Interned id of a stage text
+
+    Args:
+        text (str): stage text
+
+    Returns:
+        int: stage id
+    """
+    stage_id = self.stage_ids.get(text)
+    if stage_id is None:
+      stage_id = len(self.stage_names)
+      self.stage_ids[text] = stage_id
+      self.stage_names.append(text)
+    return stage_id
+
+  def record(self, rowtype, value_ns, text):
+    """ Write one row into the ring buffer
+
+    Args:
+        rowtype (int): timetype or durationtype
+        value_ns (int): timestamp or duration in ns
+        text (str): stage text
+    """
+    with self.lock:
+      # interned under the lock, the capture and inference threads record concurrently
+      stage_id = self.stageId(text)
+      if self.head - self.flushed >= self.capacity and self.filewrite:
+        self.overruns += 1
+        self.flushed += 1
+      i = (self.head % self.capacity) * 4
+      self.buffer[i] = self.index
+      self.buffer[i + 1] = rowtype
+      self.buffer[i + 2] = value_ns
+      self.buffer[i + 3] = stage_id
+      self.head += 1
+      pending = self.head - self.flushed
+    if self.histogram is not None and rowtype == self.durationtype:
+      self.histogram.observe(value_ns / 1e9, text)
+    if pending >= self.capacity // 2 and self.flusher is not None:
+      self.flush_event.set()
 
   def nextIndex(self):
     """ Increment the index to indicate the next measurement series
@@ -67,7 +147,10 @@ class Timer:
     Args:
         text (str, optional): Additional text to add to timestamp. Defaults to None.
     """
-    self.times.append([self.index, self.timetype, datetime.now(), text])
+    now = time.perf_counter_ns()
+    self.prev_ns = self.last_ns
+    self.last_ns = now
+    self.record(self.timetype, now, text)
 
   def calc(self, text=None):
     """calculate the time delta from the two previous timestamps
@@ -78,9 +161,9 @@ class Timer:
     Returns:
         datetime: datetime timedelta object
     """
-    duration = self.times[-1][2] - self.times[-2][2]
-    self.times.append([self.index, self.durationtype, duration, text])
-    return duration
+    duration_ns = self.last_ns - self.prev_ns
+    self.record(self.durationtype, duration_ns, text)
+    return timedelta(microseconds=duration_ns / 1000)
 
   def verbose(self, verbose=False):
     """Changing verbosity
@@ -90,22 +173,39 @@ class Timer:
     """
     self.verbose = verbose
 
+  def toRow(self, row):
+    """Convert a ring buffer row to a time entry [index, type, time, text]
+
+    Args:
+        row (obj): ring buffer row
+
+    Returns:
+        list: time entry with datetime for timestamps and timedelta for durations
+    """
+    (index, rowtype, value_ns, stage_id) = (int(v) for v in row)
+    if rowtype == self.timetype:
+      value = datetime.fromtimestamp((self.wall_ns + value_ns - self.ref_ns) / 1e9)
+    else:
+      value = timedelta(microseconds=value_ns / 1000)
+    return [index, rowtype, value, self.stage_names[stage_id]]
+
   def reporting(self):
     """Generate report from the last entry. Timestamp or timedelta.
 
     Returns:
         str: report string from last entry
     """
-    if self.times[-1][1] == self.durationtype:
+    last = self.toRow(self.rows[(self.head - 1) % self.capacity])
+    if last[1] == self.durationtype:
       desc = "Duration"
-    elif self.times[-1][1] == self.timetype:
+    elif last[1] == self.timetype:
       desc = "Timestamp"
 
     out = ""
-    if self.times[-1][3] is not None:
-      out = "{} of {} is {}".format(desc, self.times[-1][3], self.times[-1][2])
+    if last[3] is not None:
+      out = "{} of {} is {}".format(desc, last[3], last[2])
     else:
-      out = "{} is {}".format(str(desc, self.times[-1][2]))
+      out = "{} is {}".format(desc, last[2])
     return out
 
   def end(self, triggertext=None, durationtext=None):
@@ -129,11 +229,104 @@ class Timer:
     else:
       self.calc(self.title)
 
-    if self.report:
+    if self.report and self.log.isEnabledFor(logging.INFO):
       self.log.info(self.reporting())
-    if self.filewrite:
-      self.writeCsvRow(self.times[-3:], append=True)
-      del self.times[-3:]
+
+  def add(self, duration, text=None):
+    """Record a duration measured elsewhere, e.g. by the pipeline stage threads
+
+    Args:
+        duration (timedelta|float): measured duration, float in seconds
+        text (str, optional): text for the timedelta entry. Defaults to None.
+    """
+    if isinstance(duration, timedelta):
+      duration = duration.total_seconds()
+    self.record(self.durationtype, int(duration * 1e9), text)
+    if self.report and self.log.isEnabledFor(logging.INFO):
+      self.log.info(self.reporting())
+
+  def durations(self, text):
+    """Durations of a stage still held in the ring buffer
+
+    Args:
+        text (str): stage text
+
+    Returns:
+        (obj): numpy array of durations in seconds, oldest first
+    """
+    stage_id = self.stage_ids.get(text)
+    if stage_id is None:
+      return np.zeros(0)
+    with self.lock:
+      rows = self.snapshot(max(0, self.head - self.capacity), self.head)
+    mask = (rows[:, 1] == self.durationtype) & (rows[:, 3] == stage_id)
+    return rows[mask, 2] / 1e9
+
+  def percentiles(self, text=None, q=(50, 95, 99)):
+    """p50/p95/p99 of the stage durations held in the ring buffer
+
+    Args:
+        text (str, optional): stage text, all stages if None. Defaults to None.
+        q (tuple, optional): percentiles to compute. Defaults to (50, 95, 99).
+
+    Returns:
+        dict: {stage: {'count': n, 'p50': s, 'p95': s, 'p99': s}} in seconds
+    """
+    stages = [text] if text is not None else list(self.stage_names)
+    out = {}
+    for stage in stages:
+      values = self.durations(stage)
+      if values.size == 0:
+        continue
+      out[stage] = {'count': int(values.size)}
+      for p, v in zip(q, np.percentile(values, q)):
+        out[stage]['p%d' % p] = float(v)
+    return out
+
+  def snapshot(self, start, stop):
+    """Copy the ring buffer rows [start, stop) in order, the lock must be held
+
+    Args:
+        start (int): first absolute row number
+        stop (int): last absolute row number (excluded)
+
+    Returns:
+        (obj): numpy array of rows
+    """
+    idx = np.arange(start, stop) % self.capacity
+    return self.rows[idx].copy()
+
+  def flush(self):
+    """Write all rows not yet written to the csv file in one batch
+    """
+    with self.lock:
+      start = self.flushed
+      stop = self.head
+      rows = self.snapshot(start, stop)
+      self.flushed = stop
+    if len(rows) > 0:
+      self.writeCsvRow([self.toRow(row) for row in rows], append=True)
+
+  def flushLoop(self):
+    """Background thread, flushes every flush_interval seconds or when half of the ring buffer is used
+    """
+    while not self.stopped.is_set():
+      self.flush_event.wait(self.flush_interval)
+      self.flush_event.clear()
+      self.flush()
+
+  def close(self):
+    """Stop the background thread and write the remaining rows
+    """
+    if self.flusher is None:
+      return
+    self.stopped.set()
+    self.flush_event.set()
+    self.flusher.join()
+    self.flusher = None
+    self.flush()
+    if self.overruns > 0:
+      self.log.warning("Timer ring buffer overrun, %d rows lost" % self.overruns)
 
   def dumpToCsv(self):
     """dump timeentries to csv file
@@ -141,7 +334,7 @@ class Timer:
     with open(self.file, 'w+', newline='') as f:
       write = csv.writer(f)
       write.writerow(self.fields)
-      write.writerows(self.times)
+      write.writerows(self.getTimes())
 
   def writeCsvHeader(self):
     """Create or append to csv file the last timeentry recorded
@@ -178,10 +371,12 @@ class Timer:
           write.writerows(rows)
 
   def getTimes(self):
-    """Getter method for all recorded time entries
-    [type, time, text]
+    """Getter method for all time entries still held in the ring buffer
+    [index, type, time, text]
 
     Returns:
         list: time entries
     """
-    return self.times
+    with self.lock:
+      rows = self.snapshot(max(0, self.head - self.capacity), self.head)
+    return [self.toRow(row) for row in rows]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - weights
+
+Weight bundle for the software layers of the tinier-yolo network.
+The conv0/conv8 weights are transposed once and stored contiguous in a single raw file,
+later starts memory map the file instead of loading and transposing the npy files.
+
+Bundle file layout: magic, header length (uint32), json header, 64 byte aligned raw arrays.
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+import helpers
+
+###############################################################################
+# Constants
+#
+MAGIC = b"EPUW0001"
+ALIGN = 64
+# source file, transpose axes (None for no transpose)
+PARAMS = {
+    'conv0_weights': ('tinier-yolo-conv0-W.npy', (3, 2, 1, 0)),
+    'conv0_bias': ('tinier-yolo-conv0-bias.npy', None),
+    'conv8_weights': ('tinier-yolo-conv8-W.npy', (3, 2, 1, 0)),
+    'conv8_bias': ('tinier-yolo-conv8-bias.npy', None),
+}
+
+log = helpers.createLogger(__name__)
+
+
+###############################################################################
+# Bundle Functions
+#
+def sourceSignature(params_path):
+  """ Signature of the source npy files (name, size, modification time) to detect a stale bundle
+
+  Args:
+      params_path (str): folder containing the tinier-yolo npy files
+
+  Returns:
+      (list): signature
+  """
+  signature = []
+  for name in sorted(PARAMS):
+    stat = os.stat(os.path.join(params_path, PARAMS[name][0]))
+    signature.append([PARAMS[name][0], stat.st_size, int(stat.st_mtime)])
+  return signature
+
+
+def loadParams(params_path):
+  """ Load the npy files and transpose them to the layout used by the software layers
+
+  Args:
+      params_path (str): folder containing the tinier-yolo npy files
+
+  Returns:
+      (dict): contiguous numpy arrays by name
+  """
+  arrays = {}
+  for name, (fname, axes) in PARAMS.items():
+    array = np.load(os.path.join(params_path, fname), encoding="latin1", allow_pickle=True)
+    if axes is not None:
+      array = np.transpose(array, axes=axes)
+    arrays[name] = np.ascontiguousarray(array)
+  return arrays
+
+
+def compileWeights(params_path, bundle):
+  """ Compile the weight bundle, one-time step
+
+  Args:
+      params_path (str): folder containing the tinier-yolo npy files
+      bundle (str): path of the bundle file to write
+
+  Returns:
+      (str): sha256 content hash of the bundle arrays
+  """
+  arrays = loadParams(params_path)
+  header = {'source': sourceSignature(params_path), 'arrays': {}}
+  sha = hashlib.sha256()
+  offset = 0
+  for name in sorted(arrays):
+    offset = (offset + ALIGN - 1) // ALIGN * ALIGN
+    header['arrays'][name] = {'dtype': arrays[name].dtype.str, 'shape': arrays[name].shape, 'offset': offset}
+    offset += arrays[name].nbytes
+    sha.update(arrays[name].tobytes())
+  header['hash'] = sha.hexdigest()
+  header_bytes = json.dumps(header).encode()
+  data_start = (len(MAGIC) + 4 + len(header_bytes) + ALIGN - 1) // ALIGN * ALIGN
+
+  tmp = bundle + ".tmp"
+  with open(tmp, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<I', len(header_bytes)))
+    f.write(header_bytes)
+    for name in sorted(arrays):
+      f.seek(data_start + header['arrays'][name]['offset'])
+      f.write(arrays[name].tobytes())
+  # replace atomically, a crash during compile never leaves a broken bundle
+  os.replace(tmp, bundle)
+  log.info("Weight bundle %s compiled, hash %s" % (bundle, header['hash']))
+  return header['hash']
+
+
+def readHeader(bundle):
+  """ Read the json header of a bundle file
+
+  Args:
+      bundle (str): path of the bundle file
+
+  Returns:
+      (tuple): tuple containing:
+
+          header (dict): json header
+          data_start (int): file offset of the first array
+  """
+  with open(bundle, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError("%s is not a weight bundle" % bundle)
+    (length,) = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(length).decode())
+  data_start = (len(MAGIC) + 4 + length + ALIGN - 1) // ALIGN * ALIGN
+  return (header, data_start)
+
+
+def loadWeights(bundle, verify=False):
+  """ Memory map all arrays of a bundle file, read-only
+
+  Args:
+      bundle (str): path of the bundle file
+      verify (bool, optional): check the content hash. Defaults to False.
+
+  Returns:
+      (tuple): tuple containing:
+
+          arrays (dict): numpy memmap arrays by name
+          header (dict): json header
+  """
+  (header, data_start) = readHeader(bundle)
+  arrays = {}
+  for name, info in header['arrays'].items():
+    arrays[name] = np.memmap(bundle, dtype=np.dtype(info['dtype']), mode='r', offset=data_start + info['offset'], shape=tuple(info['shape']))
+  if verify:
+    sha = hashlib.sha256()
+    for name in sorted(arrays):
+      sha.update(arrays[name].tobytes())
+    if sha.hexdigest() != header['hash']:
+      raise ValueError("Weight bundle %s is corrupt" % bundle)
+  return (arrays, header)
+
+
+def loadCachedWeights(params_path, bundle, verify=False):
+  """ Load the weights from the bundle file, compile it first if missing or stale
+
+  Args:
+      params_path (str): folder containing the tinier-yolo npy files
+      bundle (str): path of the bundle file
+      verify (bool, optional): check the content hash. Defaults to False.
+
+  Returns:
+      (dict): numpy arrays by name
+  """
+  try:
+    (arrays, header) = loadWeights(bundle, verify)
+    if header['source'] == sourceSignature(params_path):
+      log.debug("Weight bundle %s loaded" % bundle)
+      return arrays
+    log.info("Weight bundle %s is stale" % bundle)
+  except (OSError, ValueError, KeyError):
+    log.info("No valid weight bundle %s" % bundle)
+  compileWeights(params_path, bundle)
+  return loadWeights(bundle, verify)[0]
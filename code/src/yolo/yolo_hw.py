@@ -13,9 +13,17 @@ Copyright (C) 2021 FFHS - All Rights Reserved
 #
 import sys
 import os
+import queue
+import logging
 import numpy as np
 import ctypes
+import cv2
 import helpers
+import region
+import nms
+import weights
+import conv
+import letterbox
 
 import qnn
 from qnn import TinierYolo
@@ -54,7 +62,7 @@ class YoloHW:
   """ Class for executing Yolo hardware machine learning recognition
   """
 
-  def __init__(self, python_path, darknet_path):
+  def __init__(self, python_path, darknet_path, weights_cache=None, conv0_numpy=False, suppressor=None):
     """ Setup Yolo Deep Neural Network in Hardware and Software
         It instantiates the classifier and performs a partial repogram of the FPGA
 
@@ -64,6 +72,9 @@ class YoloHW:
     Args:
         python_path (str): path to python distribution
         python_path (str): path to darknet distribution
+        weights_cache (str, optional): weight bundle file, memory mapped instead of loading the npy files. Defaults to None.
+        conv0_numpy (bool, optional): run conv0 with conv.Conv0 instead of qnn.utils.conv_layer if it matches bit for bit. Defaults to False.
+        suppressor (obj, optional): nms.NonMaxSuppression of region_detection, darknet_detection uses the darknet NMS. Defaults to class aware greedy NMS.
 
     Returns:
         (tuple): tuple containing
@@ -81,30 +92,57 @@ class YoloHW:
 
 
     self.darknet_path = darknet_path
+    self.suppressor = suppressor if suppressor is not None else nms.NonMaxSuppression()
     sys.path.append(python_path)
     #from darknet import *
 
     self.classifier = TinierYolo()
     self.classifier.init_accelerator()
     self.net = self.classifier.load_network(json_layer=python_path + os.sep + "dist-packages/qnn/params/tinier-yolo-layers.json")
-    conv0_weights = np.load(python_path + os.sep + 'dist-packages/qnn/params/tinier-yolo-conv0-W.npy', encoding="latin1", allow_pickle=True)
-    self.conv0_weights_correct = np.transpose(conv0_weights, axes=(3, 2, 1, 0))
-    conv8_weights = np.load(python_path + os.sep + 'dist-packages/qnn/params/tinier-yolo-conv8-W.npy', encoding="latin1", allow_pickle=True)
-    self.conv8_weights_correct = np.transpose(conv8_weights, axes=(3, 2, 1, 0))
-    conv0_bias = np.load(python_path + os.sep + 'dist-packages/qnn/params/tinier-yolo-conv0-bias.npy', encoding="latin1", allow_pickle=True)
-    self.conv0_bias_broadcast = np.broadcast_to(conv0_bias[:, np.newaxis], (self.net['conv1']['input'][0], self.net['conv1']['input'][1]*self.net['conv1']['input'][1]))
-    conv8_bias = np.load(python_path + os.sep + 'dist-packages/qnn/params/tinier-yolo-conv8-bias.npy', encoding="latin1", allow_pickle=True)
-    self.conv8_bias_broadcast = np.broadcast_to(conv8_bias[:, np.newaxis], (125, 13*13))
+    params_path = python_path + os.sep + 'dist-packages/qnn/params'
+    if weights_cache is not None:
+      params = weights.loadCachedWeights(params_path, weights_cache)
+    else:
+      params = weights.loadParams(params_path)
+    self.conv0_weights_correct = params['conv0_weights']
+    self.conv8_weights_correct = params['conv8_weights']
+    self.conv0_bias_broadcast = np.broadcast_to(params['conv0_bias'][:, np.newaxis], (self.net['conv1']['input'][0], self.net['conv1']['input'][1]*self.net['conv1']['input'][1]))
+    self.conv8_bias_broadcast = np.broadcast_to(params['conv8_bias'][:, np.newaxis], (125, 13*13))
+    # accelerator DMA buffers, allocated once
+    self.allocations = 0
+    self.output_buffer = None
+    self.input_buffers = []
+    self.input_buffer_ids = set()
+    self.free_buffers = queue.Queue()
+    # input buffers allocated once, written in place by conv0 or in input_order by execute_yolo_hw
+    self.preallocated = True
+    self.inplace_input = True
+    self.input_order = None
+    self.levels = None
+    self.init_buffers(1)
+    self.letterbox = letterbox.Letterbox(416)
+    self.conv0 = None
+    if conv0_numpy:
+      self.conv0 = conv.Conv0(self.conv0_weights_correct, params['conv0_bias'])
+      self.check_conv0()
     file_name_cfg = c_encode_char(python_path + os.sep + "dist-packages/qnn/params/tinier-yolo-bwn-3bit-relu-nomaxpool.cfg")
     # Output of CNN created why??
     self.net_darknet = lib.parse_network_cfg(file_name_cfg)
+    self.labels = open(self.darknet_path + os.sep + "data/voc.names").read().splitlines()
+    # Make random colors with a seed, such that they are the same next time
+    np.random.seed(0)
+    self.colors = np.random.randint(0, 255, size=(len(self.labels), 3)).tolist()
     # Create class variables
     self.npimg = None
     self.conv0_output_quant = None
     self.conv7_out = None
     self.conv8_out = None
+    self.conv8_output = None
+    self.image_size = None
     self.classes = None
     self.confidences = None
+    self.boxes = None
+    self.class_ids = None
 
   def __del__(self):
     # deinint classifier
@@ -123,10 +161,16 @@ class YoloHW:
     Returns:
         npimg (obj): image as numpy array
     """
-    self.log.info("Load Image")
+    self.log.debug("Load Image")
+    image = cv2.imread(fname)
+    if image is not None:
+      return self.getImage(image)
+    # formats opencv can't decode go through darknet
     fname = c_char_p(fname.encode())
-    img = load_image(fname, 0, 0)
-    img = letterbox_image(img, 416, 416)
+    orig = load_image(fname, 0, 0)
+    self.image_size = (orig.w, orig.h)
+    img = letterbox_image(orig, 416, 416)
+    free_image(orig)
     self.npimg = np.copy(np.ctypeslib.as_array(img.data, (3, 416, 416)))
     self.npimg = np.swapaxes(self.npimg, 0, 2)
     free_image(img)
@@ -140,16 +184,18 @@ class YoloHW:
     """ 2. Get image as numpy object
 
     Args:
-        image (obj): image to load
+        image (obj): BGR opencv image (numpy array) or letterboxed darknet image
 
     Returns:
-        (tuple): tuple containing:
-
-            fpath (str): path of input file
-            npimg (obj): image as numpy array
+        npimg (obj): image as numpy array, a numpy input is letterboxed into a reused buffer
     """
-    self.log.info("2. Get image")
+    self.log.debug("2. Get image")
 
+    if isinstance(image, np.ndarray):
+      self.image_size = (image.shape[1], image.shape[0])
+      self.npimg = self.letterbox(image)
+      return self.npimg
+    self.image_size = (image.w, image.h)
     self.npimg = np.copy(np.ctypeslib.as_array(image.data, (3, 416, 416)))
     self.npimg = np.swapaxes(self.npimg, 0, 2)
     free_image(image)
@@ -168,23 +214,37 @@ class YoloHW:
             fpath (str): path of input file
             npimg (obj): image as numpy array
     """
-    self.log.info("2. Get image")
-    self.log.debug("  * " + fpath)
+    self.log.debug("2. Get image")
+    self.log.debug("  * %s", fpath)
 
     self.npimg = self.loadFile(fpath)
     return (fpath, self.npimg)
 
-  def execute_yolo_sw_firstlayer(self):
+  def execute_yolo_sw_firstlayer(self, npimg=None):
     """ 3. Execute the first convolutional layer in Python
 
     Args:
-        None
+        npimg (obj, optional): image as numpy array. Defaults to the last loaded image.
 
     Returns:
         (obj): quantized output of convolutional layer 0 conv0_output_quant
     """
-    self.log.info("3. Execute the first convolutional layer in Python")
-    npimg = self.npimg[np.newaxis, :, :, :]
+    self.log.debug("3. Execute the first convolutional layer in Python")
+    if npimg is None:
+      npimg = self.npimg
+    if self.conv0 is not None:
+      buffer = self.acquire_buffer()
+      if buffer is not None:
+        # quantization levels straight into the DMA input buffer
+        self.conv0(npimg, out=buffer)
+        if hasattr(buffer, 'flush'):
+          buffer.flush()
+        self.conv0_output_quant = buffer
+      else:
+        # copy as the kernel reuses its output buffer and the pipeline keeps several frames in flight
+        self.conv0_output_quant = self.conv0(npimg).copy()
+      return self.conv0_output_quant
+    npimg = npimg[np.newaxis, :, :, :]
 
     conv0_ouput = utils.conv_layer(npimg, self.conv0_weights_correct, b=self.conv0_bias_broadcast, stride=2, padding=1)
     self.conv0_output_quant = conv0_ouput.clip(0.0, 4.0)
@@ -192,51 +252,176 @@ class YoloHW:
 
     return self.conv0_output_quant
 
-  def execute_yolo_hw(self):
-    """ 4. HW Offload of the quantized layers
+  def check_conv0(self):
+    """ Compare the NumPy conv0 kernel with the qnn reference on a random image, fall back to qnn on any difference
+
+    Returns:
+        (bool): True if the NumPy kernel is used
+    """
+    npimg = np.random.RandomState(0).rand(416, 416, 3).astype(np.float32)
+    reference = utils.conv_layer(npimg[np.newaxis], self.conv0_weights_correct, b=self.conv0_bias_broadcast, stride=2, padding=1)
+    reference = utils.quantize(reference.clip(0.0, 4.0)/4, 3)
+    result = self.conv0(npimg)
+    mismatches = int(np.sum(np.asarray(reference).ravel() != result.ravel())) if reference.size == result.size else reference.size
+    if mismatches > 0:
+      self.log.warning("NumPy conv0 differs from qnn in %d values, using qnn.utils.conv_layer" % mismatches)
+      self.conv0 = None
+      return False
+    self.log.info("NumPy conv0 matches qnn bit for bit")
+    return True
+
+  def init_buffers(self, count=1):
+    """ Allocate the accelerator output buffer and count input buffers once
+
+        The quantized conv0 output is written in place if prepare_buffer turns out to be a plain copy of the
+        quantization levels. If it reorders them the levels are copied into the preallocated buffers in that
+        order, only a packed layout needs prepare_buffer per frame.
 
     Args:
-        None
+        count (int, optional): number of input buffers, frames in flight between conv0 and the accelerator. Defaults to 1.
+    """
+    if self.output_buffer is None:
+      out_dim = self.net['conv7']['output'][1]
+      out_ch = self.net['conv7']['output'][0]
+      self.output_buffer = self.classifier.get_accel_buffer(out_ch, out_dim)
+      self.allocations += 1
+    in_ch = self.net['conv1']['input'][0]
+    in_dim = self.net['conv1']['input'][1]
+    probe = np.random.RandomState(0).randint(0, 8, size=(1, in_ch, in_dim, in_dim)).astype(np.float32)
+    while self.preallocated and len(self.input_buffers) < count:
+      buffer = self.classifier.prepare_buffer(probe)
+      self.allocations += 1
+      data = np.asarray(buffer)
+      if len(self.input_buffers) == 0 and (data.size != probe.size or not np.array_equal(data.ravel(), probe.ravel().astype(data.dtype))):
+        self.inplace_input = False
+        self.input_order = self.probe_order(probe.shape)
+        if self.input_order is None:
+          self.log.warning("Accelerator input buffer has a packed layout, prepare_buffer allocates a buffer per frame")
+          self.preallocated = False
+          break
+        self.log.info("Accelerator input buffer reorders the levels, they are copied into the preallocated buffers")
+      self.input_buffers.append(buffer)
+      self.input_buffer_ids.add(id(buffer))
+      self.free_buffers.put(buffer)
+
+  def probe_order(self, shape):
+    """ Find the order in which prepare_buffer writes the levels, by probing the base 8 digits of the element indexes
+
+    Args:
+        shape (tuple): shape of the quantization levels
 
     Returns:
-      (obj): ouput of the 7th conv layer conv7_out
+        (obj): index of the level of every buffer element, None if prepare_buffer does more than reordering
     """
-    self.log.info("4. HW Offload of the quantized layers")
-    out_dim = self.net['conv7']['output'][1]
-    out_ch = self.net['conv7']['output'][0]
+    size = int(np.prod(shape))
+    index = np.arange(size, dtype=np.int64)
+    order = np.zeros(size, dtype=np.int64)
+    rng = np.random.RandomState(1)
+    digit = 0
+    while 8**digit < size or digit == 0:
+      probe = ((index // 8**digit) % 8).reshape(shape).astype(np.float32)
+      buffer = self.classifier.prepare_buffer(probe)
+      data = np.asarray(buffer).ravel()
+      if data.size != size:
+        return None
+      order += data.astype(np.int64) * 8**digit
+      if hasattr(buffer, 'freebuffer'):
+        buffer.freebuffer()
+      digit += 1
+    if order.min() < 0 or order.max() >= size or not np.array_equal(np.bincount(order, minlength=size), np.ones(size, dtype=np.int64)):
+      return None
+    probe = rng.randint(0, 8, size=shape).astype(np.float32)
+    buffer = self.classifier.prepare_buffer(probe)
+    matches = np.array_equal(np.asarray(buffer).ravel(), probe.ravel()[order].astype(np.asarray(buffer).dtype))
+    if hasattr(buffer, 'freebuffer'):
+      buffer.freebuffer()
+    return order if matches else None
+
+  def acquire_buffer(self):
+    """ Get a free accelerator input buffer
 
-    conv_output = self.classifier.get_accel_buffer(out_ch, out_dim)
-    conv_input = self.classifier.prepare_buffer(self.conv0_output_quant*7)
+    Returns:
+        (obj): DMA buffer or None if none is free or the buffer can't be written in place
+    """
+    if not self.inplace_input:
+      return None
+    try:
+      return self.free_buffers.get_nowait()
+    except queue.Empty:
+      return None
+
+  def execute_yolo_hw(self, conv0_output_quant=None):
+    """ 4. HW Offload of the quantized layers
 
-    self.classifier.inference(conv_input, conv_output)
+    Args:
+        conv0_output_quant (obj, optional): quantized output of convolutional layer 0. Defaults to the last result.
 
-    self.conv7_out = self.classifier.postprocess_buffer(conv_output)
+    Returns:
+      (obj): ouput of the 7th conv layer conv7_out
+    """
+    self.log.debug("4. HW Offload of the quantized layers")
+    if conv0_output_quant is None:
+      conv0_output_quant = self.conv0_output_quant
+
+    if id(conv0_output_quant) in self.input_buffer_ids:
+      conv_input = conv0_output_quant
+    else:
+      if self.levels is None:
+        self.levels = np.empty_like(conv0_output_quant)
+      np.multiply(conv0_output_quant, 7, out=self.levels)
+      conv_input = None
+      if self.preallocated:
+        try:
+          # released below, the frames queued behind may hold the other buffers
+          conv_input = self.free_buffers.get_nowait()
+        except queue.Empty:
+          pass
+      if conv_input is not None:
+        data = np.asarray(conv_input).reshape(-1)
+        data[...] = self.levels.ravel() if self.input_order is None else self.levels.ravel()[self.input_order]
+        if hasattr(conv_input, 'flush'):
+          conv_input.flush()
+      else:
+        conv_input = self.classifier.prepare_buffer(self.levels)
+        self.allocations += 1
+
+    try:
+      self.classifier.inference(conv_input, self.output_buffer)
+      self.conv7_out = self.classifier.postprocess_buffer(self.output_buffer)
+      if np.may_share_memory(self.conv7_out, self.output_buffer):
+        # the output buffer is overwritten by the next frame
+        self.conv7_out = np.array(self.conv7_out)
+    finally:
+      if id(conv_input) in self.input_buffer_ids:
+        self.free_buffers.put(conv_input)
 
     return self.conv7_out
 
-  def execute_yolo_sw_lastlayer(self):
+  def execute_yolo_sw_lastlayer(self, conv7_out=None):
     """ 5. Execute the last convolutional layer in Python
 
     Args:
-        None
+        conv7_out (obj, optional): output of the 7th conv layer. Defaults to the last result.
 
     Returns:
       (obj): output of last convolutional layer conv8_out
     """
-    self.log.info("5. Execute the last convolutional layer in Python")
+    self.log.debug("5. Execute the last convolutional layer in Python")
     out_dim = self.net['conv7']['output'][1]
     out_ch = self.net['conv7']['output'][0]
+    if conv7_out is None:
+      conv7_out = self.conv7_out
 
-    conv7_out_reshaped = self.conv7_out.reshape(out_dim, out_dim, out_ch)
+    conv7_out_reshaped = conv7_out.reshape(out_dim, out_dim, out_ch)
     conv7_out_swapped = np.swapaxes(conv7_out_reshaped, 0, 1)  # exp 1
     conv7_out_swapped = conv7_out_swapped[np.newaxis, :, :, :]
 
-    conv8_output = utils.conv_layer(conv7_out_swapped, self.conv8_weights_correct, b=self.conv8_bias_broadcast, stride=1)
-    self.conv8_out = conv8_output.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    self.conv8_output = utils.conv_layer(conv7_out_swapped, self.conv8_weights_correct, b=self.conv8_bias_broadcast, stride=1)
+    self.conv8_out = self.conv8_output.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
 
     return self.conv8_out
 
-  def darknet_detection(self, fpath, output_folder):
+  def darknet_detection(self, fpath, output_folder, conv8_out=None):
     """ Execute the darknet detection
 
         * draw detection box with class name over image
@@ -244,6 +429,7 @@ class YoloHW:
     Args:
         fpath (str): saved webcam file
         output_folder (str): folder for all output files
+        conv8_out (obj, optional): output of last convolutional layer. Defaults to the last result.
 
     Returns:
         (tuple): tuple containing
@@ -251,16 +437,16 @@ class YoloHW:
           fpath_out (str): filepath for output image file
           fpath_probs (str): filepath for output probability file
     """
-    self.log.info("6. Draw detection boxes using Darknet")
+    self.log.debug("6. Draw detection boxes using Darknet")
 
     fpath_out = output_folder + os.sep + os.path.basename(os.path.splitext(fpath)[0]) + '_hw_detection'# + os.path.splitext(fpath)[1]
     fpath_probs = os.path.abspath(os.path.splitext(fpath_out)[0] + "_probabilities.txt")
 
-    self.log.debug(fpath)
-    self.log.debug(fpath_out)
-    self.log.debug(fpath_probs)
+    self.log.debug("  * %s -> %s, %s", fpath, fpath_out, fpath_probs)
 
-    lib.forward_region_layer_pointer_nolayer(self.net_darknet, self.conv8_out)
+    if conv8_out is None:
+      conv8_out = self.conv8_out
+    lib.forward_region_layer_pointer_nolayer(self.net_darknet, conv8_out)
     tresh_c = c_encode_float(0.3)
     tresh_hier_c = c_encode_float(0.5)
     fpath_c = c_encode_char(fpath)
@@ -276,8 +462,6 @@ class YoloHW:
 
     lib.draw_detection_python(self.net_darknet, fpath_c, tresh_c, tresh_hier_c, fpath_names_voc_c, darknet_path_c, fpath_out_c, fpath_probs_c)
 
-    # Print probabilities
-    self.log.debug("7. Show Probabilities")
     file_content = open(fpath_probs, "r").read().splitlines()
     detections = []
     self.classes = []
@@ -287,7 +471,68 @@ class YoloHW:
       self.classes.append(name)
       self.confidences.append(probability)
       detections.append((probability, name))
-    for det in sorted(detections, key=lambda tup: tup[0], reverse=True):
-      self.log.debug("class: {}\tprobability: {}".format(det[1], det[0]))
+    # Print probabilities, only sorted if they are logged
+    if self.log.isEnabledFor(logging.DEBUG):
+      self.log.debug("7. Show Probabilities")
+      for det in sorted(detections, key=lambda tup: tup[0], reverse=True):
+        self.log.debug("class: %s\tprobability: %s", det[1], det[0])
 
     return (fpath_out + '.png', fpath_probs)
+
+  def region_detection(self, conv8_out=None, image_size=None, threshold=0.3, nms_threshold=None, offset=(0, 0), keep=None):
+    """ 6. Decode the detections of the last convolutional layer in NumPy
+
+        * same region decoding as darknet but without probabilities and image files
+        * drawing the boxes is deferred to draw_detection
+
+    Args:
+        conv8_out (obj, optional): output of last convolutional layer. Defaults to the last result.
+        image_size (tuple, optional): (width, height) of the original image. Defaults to the last loaded file.
+        threshold (float, optional): minimal probability to keep a detection. Defaults to 0.3.
+        nms_threshold (float, optional): iou threshold for the non maximum suppression. Defaults to the suppressor threshold.
+        offset (tuple, optional): (x, y) position of the analysed crop in the image. Defaults to (0, 0).
+        keep (function, optional): filter of the detections before NMS, see region.decodeRegion. Defaults to None.
+
+    Returns:
+        (tuple): tuple containing:
+
+            boxes (list): list of box coordinates found [x, y, width, height]
+            confidences (list): list of probabilities for each box
+            class_id (list): id of classes found
+    """
+    self.log.debug("6. Decode detections using NumPy")
+    if conv8_out is None:
+      conv8_out = self.conv8_output
+    if image_size is None:
+      image_size = self.image_size
+
+    (self.boxes, self.confidences, self.class_ids) = region.decodeRegion(conv8_out, image_size, threshold, nms_threshold, offset=offset, keep=keep, suppressor=self.suppressor)
+    self.classes = [self.labels[class_id] for class_id in self.class_ids]
+    if self.log.isEnabledFor(logging.DEBUG):
+      for (name, confidence) in zip(self.classes, self.confidences):
+        self.log.debug("class: %s\tprobability: %.2f", name, confidence)
+
+    return (self.boxes, self.confidences, self.class_ids)
+
+  def draw_detection(self, image, outfile=None, boxes=None, confidences=None, class_ids=None):
+    """ Draw detection boxes with class name over the image
+
+    Args:
+        image (obj): opencv image the detections belong to, drawn in place
+        outfile (str, optional): path for the output file, not written if None. Defaults to None.
+        boxes (list, optional): box coordinates [x, y, width, height]. Defaults to the last detection.
+        confidences (list, optional): probabilities for each box. Defaults to the last detection.
+        class_ids (list, optional): id of classes found. Defaults to the last detection.
+
+    Returns:
+        image (obj): image with detection boxes
+    """
+    if boxes is None:
+      (boxes, confidences, class_ids) = (self.boxes, self.confidences, self.class_ids)
+    for (x, y, w, h), confidence, class_id in zip(boxes, confidences, class_ids):
+      cv2.rectangle(image, (x, y), (x + w, y + h), self.colors[class_id], 2)
+      text = "{}: {:.4f}".format(self.labels[class_id], confidence)
+      cv2.putText(image, text, (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colors[class_id], 2)
+    if outfile is not None:
+      cv2.imwrite(outfile, image)
+    return image
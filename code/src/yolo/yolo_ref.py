@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MAS PYNQ Machine Learning Project - yolo ref
+
+Tinier-yolo (tinier-yolo-bwn-3bit-relu-nomaxpool) in NumPy behind the interface of YoloHW.
+Runs without qnn, pynq and libdarknet.so, on CPU-only nodes and as golden model of the accelerator.
+
+Parameters of the qnn package (dist-packages/qnn/params), the files YoloHW and the accelerator load:
+
+* tinier-yolo-conv0-W.npy, tinier-yolo-conv0-bias.npy, tinier-yolo-conv8-W.npy, tinier-yolo-conv8-bias.npy
+* tinier-yolo-layers.json: {'conv1': {'input': [C, dim, dim], 'output': [F, dim, dim], ...}, ...} like TinierYolo.load_network
+* binparam-tinier-yolo-nopool/<layer>-<pe>-weights.bin and <layer>-<pe>-thres.bin: folded weight and threshold
+  memories of the accelerator layers conv1-7 (layer 0-6), one file per processing element
+
+Confidentiality
+---------------
+All information in this document is strictly confidential.
+Copyright (C) 2021 FFHS - All Rights Reserved
+"""
+
+###############################################################################
+# Import
+#
+import os
+import json
+import logging
+import numpy as np
+import cv2
+import helpers
+import region
+import nms
+import weights
+import conv
+import letterbox
+
+###############################################################################
+# Constants
+#
+# tinier-yolo-layers.json of the accelerator layers, [channels, dim]
+TINIER_YOLO_LAYERS = {
+    'conv1': {'input': [16, 208], 'output': [64, 104]},
+    'conv2': {'input': [64, 104], 'output': [64, 52]},
+    'conv3': {'input': [64, 52], 'output': [128, 26]},
+    'conv4': {'input': [128, 26], 'output': [256, 13]},
+    'conv5': {'input': [256, 13], 'output': [512, 13]},
+    'conv6': {'input': [512, 13], 'output': [512, 13]},
+    'conv7': {'input': [512, 13], 'output': [512, 13]},
+}
+HW_LAYERS = ['conv1', 'conv2', 'conv3', 'conv4', 'conv5', 'conv6', 'conv7']
+# folder of the accelerator layer parameters in the qnn params folder
+HW_PARAMS = "binparam-tinier-yolo-nopool"
+# 3 bit activations
+LEVELS = 7
+
+
+###############################################################################
+# Parameter Functions
+#
+def loadLayers(json_layer=None):
+  """ Description of the accelerator layers
+
+  Args:
+      json_layer (str, optional): tinier-yolo-layers.json. Defaults to the tinier-yolo shapes.
+
+  Returns:
+      (dict): {'conv1': {'input': [C, dim], 'output': [F, dim], ...}, ...}
+  """
+  if json_layer is None:
+    return TINIER_YOLO_LAYERS
+  if not os.path.isfile(json_layer):
+    raise IOError("Layer description %s not found" % json_layer)
+  with open(json_layer, 'r') as f:
+    layers = json.load(f)
+  return dict((name, layers[name]) for name in HW_LAYERS)
+
+
+def layerSpec(layer):
+  """ Convolution and max pooling of an accelerator layer from its description
+
+      * kernel, stride and padding default to a 3x3 convolution with stride 1 and same padding
+      * maxpool is the pool size (stride = size) or {'size', 'stride'}, without it the pool is the
+        ratio of the convolution output to the layer output, e.g. 208 -> 104 is a 2x2 pool
+      * the pool follows the threshold activation, max and the monotonic thresholds commute
+
+  Args:
+      layer (dict): layer of the json description, 'input' [C, dim(, dim)] and 'output' [F, dim(, dim)]
+
+  Returns:
+      (dict): channels, dim, filters, kernel, stride, padding, pool, pool_stride, out_dim
+  """
+  (channels, dim) = layer['input'][0:2]
+  (filters, out_dim) = layer['output'][0:2]
+  kernel = int(np.ravel(layer.get('kernel', 3))[0])
+  stride = int(layer.get('stride', 1))
+  padding = int(layer.get('padding', kernel // 2))
+  conv_dim = (dim + 2 * padding - kernel) // stride + 1
+  pool = layer.get('maxpool')
+  if isinstance(pool, dict):
+    (pool, pool_stride) = (int(pool['size']), int(pool.get('stride', pool['size'])))
+  elif pool:
+    (pool, pool_stride) = (int(pool), int(pool))
+  elif conv_dim != out_dim:
+    if conv_dim % out_dim != 0:
+      raise ValueError("Layer %s -> %s is no convolution with max pooling" % (layer['input'], layer['output']))
+    (pool, pool_stride) = (conv_dim // out_dim, conv_dim // out_dim)
+  else:
+    (pool, pool_stride) = (1, 1)
+  return {'channels': channels, 'dim': dim, 'filters': filters, 'kernel': kernel, 'stride': stride, 'padding': padding,
+          'pool': pool, 'pool_stride': pool_stride, 'out_dim': out_dim}
+
+
+def unfoldLayer(weight_words, threshold_words, spec, pe, simd):
+  """ Weights and thresholds of a layer from the folded memories of its processing elements
+
+      Neuron n is computed by PE n % pe in neuron fold n // pe. A weight word holds simd synapses of the
+      fold, bit i is synapse i (1 for +1, 0 for -1), the synapses are ordered (ky, kx, c) like the sliding
+      window of the accelerator. A threshold line holds the thresholds of one neuron as int64.
+
+  Args:
+      weight_words (list): uint64 words of each PE, neuron fold major
+      threshold_words (list): int64 thresholds of each PE, neuron fold major
+      spec (dict): layer returned by layerSpec
+      pe (int): number of processing elements
+      simd (int): synapses per weight word
+
+  Returns:
+      (tuple): tuple containing:
+
+          weights (obj): +-1 weights (KY, KX, C, F)
+          thresholds (obj): ascending thresholds (F, 7)
+  """
+  (k, c, f) = (spec['kernel'], spec['channels'], spec['filters'])
+  synapses = k * k * c
+  neuron_fold = -(-f // pe)
+  synapse_fold = -(-synapses // simd)
+  rows = np.zeros((neuron_fold * pe, synapse_fold * simd), dtype=np.float32)
+  thresholds = np.zeros((neuron_fold * pe, LEVELS), dtype=np.float32)
+  bits = np.arange(simd, dtype=np.uint64)
+  for p in range(pe):
+    words = np.asarray(weight_words[p], dtype=np.uint64)
+    thres = np.asarray(threshold_words[p], dtype=np.int64)
+    if words.size != neuron_fold * synapse_fold or thres.size != neuron_fold * LEVELS:
+      raise ValueError("PE %d holds %d weight words and %d thresholds, expected %d and %d" % (p, words.size, thres.size, neuron_fold * synapse_fold, neuron_fold * LEVELS))
+    unpacked = ((words.reshape(neuron_fold, synapse_fold, 1) >> bits) & np.uint64(1)).astype(np.float32)
+    rows[p::pe] = unpacked.reshape(neuron_fold, synapse_fold * simd) * 2.0 - 1.0
+    thresholds[p::pe] = thres.reshape(neuron_fold, LEVELS)
+  weights = rows[:f, :synapses].reshape(f, k, k, c).transpose(1, 2, 3, 0)
+  return (np.ascontiguousarray(weights), thresholds[:f])
+
+
+def loadHWParams(params_path, layers):
+  """ Load the weights and thresholds of the accelerator layers shipped with qnn
+
+  Args:
+      params_path (str): qnn params folder containing binparam-tinier-yolo-nopool
+      layers (dict): layer description with the 'PE' and 'SIMD' of each layer, see loadLayers
+
+  Raises:
+      IOError: a parameter file is missing
+      ValueError: the files don't match the layer description
+
+  Returns:
+      (dict): {'conv1': (weights (KY, KX, C, F) of +-1, thresholds (F, 7)), ...}
+  """
+  folder = os.path.join(params_path, HW_PARAMS)
+  params = {}
+  for (index, name) in enumerate(HW_LAYERS):
+    if 'PE' not in layers[name] or 'SIMD' not in layers[name]:
+      raise ValueError("Layer %s has no PE and SIMD in the layer description" % name)
+    (pe, simd) = (int(layers[name]['PE']), int(layers[name]['SIMD']))
+    weight_words = []
+    threshold_words = []
+    for p in range(pe):
+      for (suffix, dtype, words) in [("weights", "<u8", weight_words), ("thres", "<i8", threshold_words)]:
+        file = os.path.join(folder, "%d-%d-%s.bin" % (index, p, suffix))
+        if not os.path.isfile(file):
+          raise IOError("Accelerator parameters %s not found" % file)
+        words.append(np.fromfile(file, dtype=dtype))
+    params[name] = unfoldLayer(weight_words, threshold_words, layerSpec(layers[name]), pe, simd)
+  return params
+
+
+def randomParams(layers=TINIER_YOLO_LAYERS, seed=0):
+  """ Random parameters of the full network for tests and benchmarks without the npy files
+
+      The thresholds are spread over the accumulator range, so every layer has active outputs.
+
+  Args:
+      layers (dict, optional): shapes of the accelerator layers. Defaults to TINIER_YOLO_LAYERS.
+      seed (int, optional): random seed. Defaults to 0.
+
+  Returns:
+      (tuple): tuple containing:
+
+          params (dict): conv0/conv8 weights and bias in the layout of weights.loadParams
+          hw_params (dict): accelerator layers in the layout of loadHWParams
+  """
+  rng = np.random.RandomState(seed)
+  c0 = layers['conv1']['input'][0]
+  c7 = layers['conv7']['output'][0]
+  params = {'conv0_weights': (rng.randn(3, 3, 3, c0) * 0.5).astype(np.float32),
+            'conv0_bias': (rng.randn(c0) * 0.1).astype(np.float32),
+            'conv8_weights': (rng.randn(1, 1, c7, 125) * 0.05).astype(np.float32),
+            'conv8_bias': (rng.randn(125) * 0.1).astype(np.float32)}
+  hw_params = {}
+  for name in HW_LAYERS:
+    spec = layerSpec(layers[name])
+    (k, c, f) = (spec['kernel'], spec['channels'], spec['filters'])
+    w = np.where(rng.rand(k, k, c, f) >= 0.5, 1.0, -1.0).astype(np.float32)
+    # accumulator of random +-1 weights and levels: mean 0, std ~ sqrt(k * k * c) * 4
+    spread = np.sqrt(k * k * c) * 4
+    thresholds = np.sort(rng.rand(f, LEVELS) * spread, axis=1).astype(np.float32)
+    hw_params[name] = (w, thresholds)
+  return (params, hw_params)
+
+
+###############################################################################
+# ThresholdConv Class
+#
+class ThresholdConv:
+  """ Binarized weight convolution with a multi-threshold activation, the integer datapath of an accelerator layer
+
+      The input and output are activation levels 0..7 as float32, the accumulation of +-1 weights and
+      levels stays integer valued and exact in float32. The output level is the number of thresholds
+      of the channel reached by the accumulator, batch norm and ReLU are folded into the thresholds.
+  """
+
+  def __init__(self, weights, thresholds, in_shape, stride=1, padding=None):
+    """ Constructor for the layer, allocates all buffers
+
+    Args:
+        weights (obj): +-1 weights (KY, KX, C, F)
+        thresholds (obj): ascending thresholds (F, levels)
+        in_shape (tuple): input shape (Y, X, C)
+        stride (int, optional): convolution stride. Defaults to 1.
+        padding (int, optional): zero padding. Defaults to half the kernel size.
+    """
+    self.conv = conv.Conv(weights, in_shape, stride, padding)
+    self.thresholds = np.ascontiguousarray(np.asarray(thresholds, dtype=np.float32).T)
+    self.out_shape = self.conv.out_shape
+    self.out = np.empty(self.out_shape, dtype=np.float32)
+    self.reached = np.empty(self.out_shape, dtype=bool)
+
+  def __call__(self, levels):
+    """ Execute the layer
+
+    Args:
+        levels (obj): input activation levels (Y, X, C)
+
+    Returns:
+        (obj): output activation levels (Yout, Xout, F), the internal buffer is reused by the next call
+    """
+    acc = self.conv(levels)
+    self.out.fill(0.0)
+    for thresholds in self.thresholds:
+      np.greater_equal(acc, thresholds, out=self.reached)
+      self.out += self.reached
+    return self.out
+
+
+###############################################################################
+# MaxPool Class
+#
+class MaxPool:
+  """ Max pooling of channels last activation levels
+
+      A stride smaller than the size pads the right and bottom border like darknet, the levels are never
+      negative so a zero border doesn't change the maximum.
+  """
+
+  def __init__(self, in_shape, size=2, stride=2):
+    """ Constructor for the layer, allocates all buffers
+
+    Args:
+        in_shape (tuple): input shape (Y, X, C)
+        size (int, optional): pool size. Defaults to 2.
+        stride (int, optional): pool stride. Defaults to 2.
+    """
+    (y, x, c) = in_shape
+    self.size = size
+    self.stride = stride
+    self.out_shape = ((y - 1) // stride + 1, (x - 1) // stride + 1, c) if stride < size else (y // stride, x // stride, c)
+    (out_y, out_x) = self.out_shape[0:2]
+    self.padded = np.zeros(((out_y - 1) * stride + size, (out_x - 1) * stride + size, c), dtype=np.float32)
+    self.out = np.empty(self.out_shape, dtype=np.float32)
+
+  def __call__(self, levels):
+    """ Execute the layer
+
+    Args:
+        levels (obj): input activation levels (Y, X, C)
+
+    Returns:
+        (obj): output activation levels (Yout, Xout, C), the internal buffer is reused by the next call
+    """
+    (y, x) = levels.shape[0:2]
+    (py, px) = (min(y, self.padded.shape[0]), min(x, self.padded.shape[1]))
+    self.padded[:py, :px] = levels[:py, :px]
+    (out_y, out_x) = self.out_shape[0:2]
+    end_y = (out_y - 1) * self.stride + 1
+    end_x = (out_x - 1) * self.stride + 1
+    self.out[...] = self.padded[0:end_y:self.stride, 0:end_x:self.stride]
+    for dy in range(self.size):
+      for dx in range(self.size):
+        if dy > 0 or dx > 0:
+          np.maximum(self.out, self.padded[dy:dy + end_y:self.stride, dx:dx + end_x:self.stride], out=self.out)
+    return self.out
+
+
+###############################################################################
+# YoloRef Class
+#
+class YoloRef:
+  """ Class for executing the tinier-yolo network fully in NumPy, drop-in replacement of YoloHW
+
+      * conv0: conv.Conv0, bit exact with qnn.utils.conv_layer
+      * conv1-7: ThresholdConv and MaxPool layers on channels last activation levels instead of the FPGA,
+        built from the json layer description
+      * conv8 and the region decoding in NumPy, darknet_detection draws with OpenCV instead of libdarknet.so
+  """
+
+  def __init__(self, params_path=None, json_layer=None, weights_cache=None, labels=None, seed=0, suppressor=None):
+    """ Setup the NumPy network
+
+    Args:
+        params_path (str, optional): qnn params folder, all files must exist. Defaults to random weights.
+        json_layer (str, optional): tinier-yolo-layers.json. Defaults to the file in params_path.
+        weights_cache (str, optional): weight bundle file for conv0/conv8 like YoloHW. Defaults to None.
+        labels (str, optional): voc.names file. Defaults to the VOC class names.
+        seed (int, optional): random seed of the random weights. Defaults to 0.
+        suppressor (obj, optional): nms.NonMaxSuppression of region_detection. Defaults to class aware greedy NMS.
+    """
+    self.log = helpers.createLogger(__name__)
+    self.log.info("1. Instantiate the NumPy reference network")
+    self.suppressor = suppressor if suppressor is not None else nms.NonMaxSuppression()
+    if json_layer is None and params_path is not None:
+      json_layer = os.path.join(params_path, "tinier-yolo-layers.json")
+    self.net = loadLayers(json_layer)
+    if params_path is None:
+      self.log.warning("No tinier-yolo parameters, using random weights")
+      (params, hw_params) = randomParams(self.net, seed)
+    else:
+      if weights_cache is not None:
+        params = weights.loadCachedWeights(params_path, weights_cache)
+      else:
+        params = weights.loadParams(params_path)
+      hw_params = loadHWParams(params_path, self.net)
+
+    self.conv0 = conv.Conv0(params['conv0_weights'], params['conv0_bias'])
+    self.layers = []
+    for name in HW_LAYERS:
+      spec = layerSpec(self.net[name])
+      layer = ThresholdConv(hw_params[name][0], hw_params[name][1], (spec['dim'], spec['dim'], spec['channels']), spec['stride'], spec['padding'])
+      self.layers.append(layer)
+      if spec['pool'] > 1:
+        self.layers.append(MaxPool(layer.out_shape, spec['pool'], spec['pool_stride']))
+      if self.layers[-1].out_shape[0] != spec['out_dim']:
+        raise ValueError("Layer %s computes %s instead of the dim %d of the description" % (name, self.layers[-1].out_shape, spec['out_dim']))
+    # conv8 weights are (KX, KY, C, F) like conv0, the NumPy layers are channels last (y, x, c)
+    self.conv8 = conv.Conv(np.transpose(params['conv8_weights'], (1, 0, 2, 3)), self.layers[-1].out_shape, bias=params['conv8_bias'])
+
+    if labels is not None and os.path.isfile(labels):
+      self.labels = open(labels).read().splitlines()
+    else:
+      self.labels = list(region.VOC_NAMES)
+    # Make random colors with a seed, such that they are the same next time
+    np.random.seed(0)
+    self.colors = np.random.randint(0, 255, size=(len(self.labels), 3)).tolist()
+    # same buffer interface as YoloHW, there is no accelerator memory
+    self.allocations = 0
+    self.letterbox = letterbox.Letterbox(416)
+    # Create class variables
+    self.npimg = None
+    self.conv0_output_quant = None
+    self.conv7_out = None
+    self.conv8_out = None
+    self.conv8_output = None
+    self.image_size = None
+    self.classes = None
+    self.confidences = None
+    self.boxes = None
+    self.class_ids = None
+
+  def loadFile(self, fname):
+    """ load saves image
+
+    Args:
+        fname (str): file path of image to load
+
+    Returns:
+        npimg (obj): image as numpy array
+    """
+    self.log.debug("Load Image")
+    image = cv2.imread(fname)
+    if image is None:
+      raise IOError("Unable to read image %s" % fname)
+    return self.getImage(image)
+
+  def getImage(self, image):
+    """ 2. Get image as numpy object
+
+    Args:
+        image (obj): BGR opencv image (numpy array)
+
+    Returns:
+        npimg (obj): image as numpy array, letterboxed into a reused buffer
+    """
+    self.log.debug("2. Get image")
+    self.image_size = (image.shape[1], image.shape[0])
+    self.npimg = self.letterbox(image)
+    return self.npimg
+
+  def getFile(self, fpath):
+    """ 2. Get fileimage as numpy object
+
+    Args:
+        fpath (str): filepath to load
+
+    Returns:
+        (tuple): tuple containing:
+
+            fpath (str): path of input file
+            npimg (obj): image as numpy array
+    """
+    self.log.debug("2. Get image")
+    self.log.debug("  * %s", fpath)
+
+    self.npimg = self.loadFile(fpath)
+    return (fpath, self.npimg)
+
+  def init_buffers(self, count=1):
+    """ Nothing to allocate, same interface as YoloHW
+
+    Args:
+        count (int, optional): number of frames in flight. Defaults to 1.
+    """
+    pass
+
+  def acquire_buffer(self):
+    """ No accelerator input buffers, same interface as YoloHW
+
+    Returns:
+        (obj): None
+    """
+    return None
+
+  def execute_yolo_sw_firstlayer(self, npimg=None):
+    """ 3. Execute the first convolutional layer
+
+    Args:
+        npimg (obj, optional): image as numpy array. Defaults to the last loaded image.
+
+    Returns:
+        (obj): quantized output of convolutional layer 0 conv0_output_quant (1, F, B, A) in [0, 1]
+    """
+    self.log.debug("3. Execute the first convolutional layer in Python")
+    if npimg is None:
+      npimg = self.npimg
+    # copy as the kernel reuses its output buffer and the pipeline keeps several frames in flight
+    self.conv0_output_quant = self.conv0(npimg).copy()
+    return self.conv0_output_quant
+
+  def execute_yolo_hw(self, conv0_output_quant=None):
+    """ 4. Quantized layers 1-7 in NumPy instead of the accelerator
+
+    Args:
+        conv0_output_quant (obj, optional): quantized output of convolutional layer 0. Defaults to the last result.
+
+    Returns:
+      (obj): output of the 7th conv layer conv7_out (y, x, channel) in [0, 1], layout of the accelerator output
+    """
+    self.log.debug("4. Quantized layers in NumPy")
+    if conv0_output_quant is None:
+      conv0_output_quant = self.conv0_output_quant
+    # (1, F, y, x) in [0, 1] -> channels last activation levels
+    levels = np.rint(conv0_output_quant[0].transpose(1, 2, 0) * LEVELS)
+    for layer in self.layers:
+      levels = layer(levels)
+    self.conv7_out = levels / LEVELS
+    return self.conv7_out
+
+  def execute_yolo_sw_lastlayer(self, conv7_out=None):
+    """ 5. Execute the last convolutional layer
+
+    Args:
+        conv7_out (obj, optional): output of the 7th conv layer. Defaults to the last result.
+
+    Returns:
+      (obj): output of last convolutional layer conv8_out (125, 13, 13) in the darknet layout
+    """
+    self.log.debug("5. Execute the last convolutional layer in Python")
+    if conv7_out is None:
+      conv7_out = self.conv7_out
+    out_dim = self.net['conv7']['output'][1]
+    out_ch = self.net['conv7']['output'][0]
+
+    self.conv8_output = np.ascontiguousarray(self.conv8(conv7_out.reshape(out_dim, out_dim, out_ch)).transpose(2, 0, 1))
+    self.conv8_out = self.conv8_output
+    return self.conv8_out
+
+  def darknet_detection(self, fpath, output_folder, conv8_out=None):
+    """ Detection image and probability file like YoloHW.darknet_detection, with region_detection and draw_detection
+
+    Args:
+        fpath (str): saved webcam file
+        output_folder (str): folder for all output files
+        conv8_out (obj, optional): output of last convolutional layer. Defaults to the last result.
+
+    Returns:
+        (tuple): tuple containing
+
+          fpath_out (str): filepath for output image file
+          fpath_probs (str): filepath for output probability file
+    """
+    self.log.debug("6. Draw detection boxes using OpenCV")
+    fpath_out = output_folder + os.sep + os.path.basename(os.path.splitext(fpath)[0]) + '_hw_detection.png'
+    fpath_probs = os.path.abspath(os.path.splitext(fpath_out)[0] + "_probabilities.txt")
+    image = cv2.imread(fpath)
+    if image is None:
+      raise IOError("Unable to read image %s" % fpath)
+    self.region_detection(conv8_out, image_size=(image.shape[1], image.shape[0]))
+    self.draw_detection(image, fpath_out)
+    with open(fpath_probs, 'w') as f:
+      for (name, confidence) in zip(self.classes, self.confidences):
+        f.write("%s: %.0f%%\n" % (name, confidence * 100))
+    return (fpath_out, fpath_probs)
+
+  def region_detection(self, conv8_out=None, image_size=None, threshold=0.3, nms_threshold=None, offset=(0, 0), keep=None):
+    """ 6. Decode the detections of the last convolutional layer in NumPy
+
+    Args:
+        conv8_out (obj, optional): output of last convolutional layer. Defaults to the last result.
+        image_size (tuple, optional): (width, height) of the original image. Defaults to the last loaded file.
+        threshold (float, optional): minimal probability to keep a detection. Defaults to 0.3.
+        nms_threshold (float, optional): iou threshold for the non maximum suppression. Defaults to the suppressor threshold.
+        offset (tuple, optional): (x, y) position of the analysed crop in the image. Defaults to (0, 0).
+        keep (function, optional): filter of the detections before NMS, see region.decodeRegion. Defaults to None.
+
+    Returns:
+        (tuple): tuple containing:
+
+            boxes (list): list of box coordinates found [x, y, width, height]
+            confidences (list): list of probabilities for each box
+            class_id (list): id of classes found
+    """
+    self.log.debug("6. Decode detections using NumPy")
+    if conv8_out is None:
+      conv8_out = self.conv8_output
+    if image_size is None:
+      image_size = self.image_size
+
+    (self.boxes, self.confidences, self.class_ids) = region.decodeRegion(conv8_out, image_size, threshold, nms_threshold, offset=offset, keep=keep, suppressor=self.suppressor)
+    self.classes = [self.labels[class_id] for class_id in self.class_ids]
+    if self.log.isEnabledFor(logging.DEBUG):
+      for (name, confidence) in zip(self.classes, self.confidences):
+        self.log.debug("class: %s\tprobability: %.2f", name, confidence)
+
+    return (self.boxes, self.confidences, self.class_ids)
+
+  def draw_detection(self, image, outfile=None, boxes=None, confidences=None, class_ids=None):
+    """ Draw detection boxes with class name over the image
+
+    Args:
+        image (obj): opencv image the detections belong to, drawn in place
+        outfile (str, optional): path for the output file, not written if None. Defaults to None.
+        boxes (list, optional): box coordinates [x, y, width, height]. Defaults to the last detection.
+        confidences (list, optional): probabilities for each box. Defaults to the last detection.
+        class_ids (list, optional): id of classes found. Defaults to the last detection.
+
+    Returns:
+        image (obj): image with detection boxes
+    """
+    if boxes is None:
+      (boxes, confidences, class_ids) = (self.boxes, self.confidences, self.class_ids)
+    for (x, y, w, h), confidence, class_id in zip(boxes, confidences, class_ids):
+      cv2.rectangle(image, (x, y), (x + w, y + h), self.colors[class_id], 2)
+      text = "{}: {:.4f}".format(self.labels[class_id], confidence)
+      cv2.putText(image, text, (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colors[class_id], 2)
+    if outfile is not None:
+      cv2.imwrite(outfile, image)
+    return image
@@ -15,13 +15,60 @@ import os
 import numpy as np
 import cv2
 import helpers
+import nms
+
+
+###############################################################################
+# Output decoding
+#
+def decodeOutputs(layer_outputs, w, h, threshold=0.3, offset=(0, 0), keep=None):
+  """ Decode the yolo output layers into boxes, confidences and class ids
+      All detections of all layers are processed at once as one array
+
+  Args:
+      layer_outputs (list): output arrays of the neural net, one row per detection [cx, cy, w, h, objectness, scores...]
+      w (int): width of the analysed image
+      h (int): height of the analysed image
+      threshold (float, optional): minimal confidence to keep a detection. Defaults to 0.3.
+      offset (tuple, optional): (x, y) added to the boxes, position of the analysed crop in the image. Defaults to (0, 0).
+      keep (function, optional): keep(boxes) returns a boolean mask of the boxes [x, y, width, height] to keep. Defaults to None.
+
+  Returns:
+      (tuple): tuple containing:
+
+          boxes (list): list of box coordinates found [x, y, width, height]
+          confidences (list): list of confidences for each class resp. box
+          class_id (list): id of classes found
+  """
+  detections = np.concatenate(layer_outputs, axis=0)
+  # The detection first 4 entries contains the object position and size, then the class scores
+  scores = detections[:, 5:]
+  # Take the class with maximal score, the maximal score is the confidence
+  class_ids = np.argmax(scores, axis=1)
+  confidences = scores[np.arange(len(scores)), class_ids]
+
+  # Ensure we have some reasonable confidence, else ignore
+  confident = confidences > threshold
+  # It needs to be scaled up as the result is given in relative size (0.0 to 1.0)
+  boxes = (detections[confident, 0:4] * np.array([w, h, w, h])).astype(int)
+  # Calculate the upper corner from the center
+  boxes[:, 0:2] -= boxes[:, 2:4] // 2 - np.array(offset)
+  confidences = confidences[confident]
+  class_ids = class_ids[confident]
+
+  # Drop the detections outside the region of interest
+  if keep is not None and len(boxes) > 0:
+    inside = keep(boxes)
+    (boxes, confidences, class_ids) = (boxes[inside], confidences[inside], class_ids[inside])
+
+  return (boxes.tolist(), confidences.tolist(), class_ids.tolist())
 
 
 class YoloSW:
   """ Class for executing Yolo software machine learning recognition
   """
 
-  def __init__(self, darknet_path, darknet_cfg, darknet_weights):
+  def __init__(self, darknet_path, darknet_cfg, darknet_weights, suppressor=None):
     """ Setup YoloSW Deep Neural Network
         It performs the following steps
 
@@ -33,6 +80,7 @@ class YoloSW:
         darknet_path (str): Path to darknet library
         darknet_cfg (str): Path to darknet configuration file
         darknet_weights (str): Path to darknet neural net weights
+        suppressor (obj, optional): nms.NonMaxSuppression shared with YoloHW. Defaults to class aware greedy NMS.
 
     Returns:
         (tuple): tuple containing:
@@ -43,6 +91,7 @@ class YoloSW:
           labels (list): labels used on the object
     """
     self.log = helpers.createLogger(__name__)
+    self.suppressor = suppressor if suppressor is not None else nms.NonMaxSuppression()
     # Read labels that are used on object
     self.labels = open(os.path.join(darknet_path, "data", "coco.names")).read().splitlines()
     # Make random colors with a seed, such that they are the same next time
@@ -74,7 +123,7 @@ class YoloSW:
           image (obj): image object loaded
           layer_outputs (list): output of the neural net evaluation
     """
-    self.log.info("YoloSW Load File")
+    self.log.debug("YoloSW Load File")
     # Load the image
     image = cv2.imread(file)
     # Get the shape
@@ -99,7 +148,7 @@ class YoloSW:
 
           layer_outputs (list): output of the neural net evaluation
     """
-    self.log.info("YoloSW Load Image")
+    self.log.debug("YoloSW Load Image")
     # Get the shape
     h, w = image.shape[:2]
     # Load it as a blob and feed it to the network
@@ -111,16 +160,90 @@ class YoloSW:
 
     return self.layer_outputs
 
-  def execute_yolo_sw(self, image, verbose=True):
+  def suppress(self, boxes, confidences, class_ids, nms_threshold=None):
+    """ Only keep the best boxes of the overlapping ones
+
+    Args:
+        boxes (list): box coordinates [x, y, width, height]
+        confidences (list): confidences for each box
+        class_ids (list): id of classes found
+        nms_threshold (float, optional): max overlap of two kept boxes. Defaults to the suppressor threshold.
+
+    Returns:
+        (tuple): boxes, confidences and class_ids of the kept boxes, sorted by descending confidence
+    """
+    (keep, scores) = self.suppressor(nms.xywhToCorners(boxes), confidences, class_ids, nms_threshold)
+    return ([boxes[i] for i in keep], scores.tolist(), [class_ids[i] for i in keep])
+
+  def detect_batch(self, images, threshold=0.3, nms_threshold=None, offsets=None, keeps=None):
+    """ Detect the objects of several images with one forward pass
+        All images go into one NCHW blob, the outputs are split per image
+
+        * one blob of shape (len(images), 3, 416, 416)
+        * one forward pass of the neural net
+        * vectorized decoding and NMS per image
+
+    Args:
+        images (list): opencv images, may have different sizes
+        threshold (float, optional): minimal confidence to keep a detection. Defaults to 0.3.
+        nms_threshold (float, optional): max overlap of two kept boxes. Defaults to the suppressor threshold.
+        offsets (list, optional): (x, y) position of each image if it is a crop, see decodeOutputs. Defaults to None.
+        keeps (list, optional): keep function or None per image, see decodeOutputs. Defaults to None.
+
+    Returns:
+        (list): one tuple (boxes, confidences, class_ids) per image, after NMS
+    """
+    self.log.debug("YoloSW Detect Batch of %d Images", len(images))
+    blob = cv2.dnn.blobFromImages(images, 1 / 255.0, (416, 416), swapRB=True, crop=False)
+    self.net.setInput(blob)
+    layer_outputs = self.net.forward(self.ln)
+    # (rows, values) for a single image, (images, rows, values) or (images * rows, values) for a batch
+    layer_outputs = [output.reshape(len(images), -1, output.shape[-1]) for output in layer_outputs]
+
+    detections = []
+    for i, image in enumerate(images):
+      (h, w) = image.shape[:2]
+      (boxes, confidences, class_ids) = decodeOutputs([output[i] for output in layer_outputs], w, h, threshold,
+                                                      offsets[i] if offsets is not None else (0, 0), keeps[i] if keeps is not None else None)
+      detections.append(self.suppress(boxes, confidences, class_ids, nms_threshold))
+    return detections
+
+  def draw_detection(self, image, outfile=None, boxes=None, confidences=None, class_ids=None):
+    """ Draw detection boxes with class name over the image
+
+    Args:
+        image (obj): opencv image the detections belong to, drawn in place
+        outfile (str, optional): path for the output file, not written if None. Defaults to None.
+        boxes (list, optional): box coordinates [x, y, width, height]. Defaults to the last detection.
+        confidences (list, optional): confidences for each box. Defaults to the last detection.
+        class_ids (list, optional): id of classes found. Defaults to the last detection.
+
+    Returns:
+        image (obj): image with detection boxes
+    """
+    if boxes is None:
+      (boxes, confidences, class_ids) = (self.boxes, self.confidences, self.class_ids)
+    for (x, y, w, h), confidence, class_id in zip(boxes, confidences, class_ids):
+      cv2.rectangle(image, (x, y), (x + w, y + h), self.colors[class_id], 2)
+      text = "{}: {:.4f}".format(self.labels[class_id], confidence)
+      cv2.putText(image, text, (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colors[class_id], 2)
+    if outfile is not None:
+      cv2.imwrite(outfile, image)
+    return image
+
+  def execute_yolo_sw(self, image, verbose=True, offset=(0, 0), keep=None):
     """ Execute the YOLO ml deep neural net model on an image
         Parse the result form layer_outputs
 
         * executes all neural net layers
         * ensure we have some reasonable confidence
+        * only keep the best boxes of the overlapping ones
 
     Args:
         image (obj): image object loaded into the neural net
         verbose (bool): display more informations
+        offset (tuple, optional): (x, y) position of the image if it is a crop, see decodeOutputs. Defaults to (0, 0).
+        keep (function, optional): filter of the detections before NMS, see decodeOutputs. Defaults to None.
 
     Returns:
         (tuple): tuple containing:
@@ -129,41 +252,12 @@ class YoloSW:
             confidences (list): list of confidences for each class resp. box
             class_id (list): id of classes found
     """
-    self.log.info("Execute YoloSW")
-    # Initialize the lists we need to interpret the results
-    self.boxes = []
-    self.confidences = []
-    self.class_ids = []
-
+    self.log.debug("Execute YoloSW")
     # Get the shape
     h, w = image.shape[:2]
 
-    # Loop over the layers
-    for output in self.layer_outputs:
-      # For the layer loop over all detections
-      for detection in output:
-        # The detection first 4 entries contains the object position and size
-        scores = detection[5:]
-        # Then it has detection scores - it takes the one with maximal score
-        class_id = np.argmax(scores).item()
-        # The maximal score is the confidence
-        confidence = scores[class_id].item()
-
-        # Ensure we have some reasonable confidence, else ignore
-        if confidence > 0.3:
-          # The first four entries have the location and size (center, size)
-          # It needs to be scaled up as the result is given in relative size (0.0 to 1.0)
-          box = detection[0:4] * np.array([w, h, w, h])
-          center_x, center_y, width, height = box.astype(int).tolist()
-
-          # Calculate the upper corner
-          x = center_x - width//2
-          y = center_y - height//2
-
-          # Add our findings to the lists
-          self.boxes.append([x, y, width, height])
-          self.confidences.append(confidence)
-          self.class_ids.append(class_id)
+    (boxes, confidences, class_ids) = decodeOutputs(self.layer_outputs, w, h, offset=offset, keep=keep)
+    (self.boxes, self.confidences, self.class_ids) = self.suppress(boxes, confidences, class_ids)
     return (self.boxes, self.confidences, self.class_ids)
 
   def darknet_detection_sw(self, image, save_image=True, outfile=None):
@@ -178,25 +272,6 @@ class YoloSW:
     Returns:
         outfile (str): path for the file with detection boxes
     """
-    self.log.info("Execute Darknet Detection")
-    # Only keep the best boxes of the overlapping ones
-    idxs = cv2.dnn.NMSBoxes(self.boxes, self.confidences, 0.3, 0.3)
-
-    # Ensure at least one detection exists - needed otherwise flatten will fail
-    if len(idxs) > 0:
-      # Loop over the indexes we are keeping
-      for i in idxs.flatten():
-        # Get the box information
-        x, y, w, h = self.boxes[i]
-
-        # Make a rectangle
-        cv2.rectangle(image, (x, y), (x + w, y + h), self.colors[self.class_ids[i]], 2)
-        # Make and add text
-        text = "{}: {:.4f}".format(self.labels[self.class_ids[i]], self.confidences[i])
-        cv2.putText(image, text, (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colors[self.class_ids[i]], 2)
-
-    # Write the image with boxes and text
-    if save_image:
-      cv2.imwrite(outfile, image)
-
-    return image
+    self.log.debug("Execute Darknet Detection")
+    # the boxes of execute_yolo_sw are already suppressed
+    return self.draw_detection(image, outfile if save_image else None)